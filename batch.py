@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import os
+import sys
+
+from rompar.batch import find_jobs, run_batch, MANIFEST
+from rompar.decode import read_jobs, FORMATS
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Decode a directory of die images across all cores, resumable')
+    parser.add_argument('--out-dir', help='Write outputs here instead of next to each image')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='Comma separated output formats: txt, dat, hex, bitplane, npy, json, rompar, sums (default: %(default)s)')
+    parser.add_argument('--layout-file', help='JSON file with extra layout definitions')
+    parser.add_argument('--grid', help='Use this grid for every image instead of a per image grid')
+    parser.add_argument('--jobs', help='File with one "image grid" pair per line, - for stdin')
+    parser.add_argument('--manifest', help='Completed job log used to resume (default: OUT_DIR or DIR/%s)' % MANIFEST)
+    parser.add_argument('--processes', '-j', type=int, help='Worker processes (default: one per core)')
+    parser.add_argument('--auto-thresh', action='store_true', help='Pick the bit threshold per image instead of using the saved one')
+    parser.add_argument('--no-retry', action='store_true', help='Skip jobs that failed in a previous run')
+    parser.add_argument('--verbose', action='store_true', help='Show decoder output from the workers')
+    parser.add_argument('dirs', nargs='*', help='Directories of images with matching .json / .rompar grids')
+    args = parser.parse_args()
+
+    jobs = []
+    for dirname in args.dirs:
+        jobs += find_jobs(dirname, grid_fn=args.grid)
+    if args.jobs:
+        f = sys.stdin if args.jobs == '-' else open(args.jobs)
+        jobs += list(read_jobs(f))
+    if not jobs:
+        parser.error('no jobs')
+
+    manifest = args.manifest
+    if manifest is None:
+        if not args.out_dir and len(args.dirs) != 1:
+            parser.error('--manifest required')
+        manifest = os.path.join(args.out_dir or args.dirs[0], MANIFEST)
+    formats = [fmt for fmt in args.formats.split(',') if fmt]
+
+    def progress(result):
+        if 'error' in result:
+            print 'FAIL %s: %s' % (result['image'], result['error'])
+        else:
+            print 'done %s: %d bits in %0.2f sec' % (result['image'], result['bits'], result['seconds'])
+        sys.stdout.flush()
+
+    print 'Manifest: %s' % manifest
+    summary = run_batch(jobs, manifest, out_dir=args.out_dir, formats=formats,
+                        processes=args.processes, layout_file=args.layout_file,
+                        retry=not args.no_retry, quiet=not args.verbose, callback=progress,
+                        auto_thresh=args.auto_thresh)
+    s = summary.as_dict()
+    print 'Decoded %d images (%d failed), %d bits in %0.1f sec' % (s['images'], s['failed'], s['bits'], s['seconds'])
+    print '  %0.0f bits/s, %0.1f images/min' % (s['bits_per_sec'], s['images_per_min'])
+    for img_fn, error in s['failures']:
+        print '  FAIL %s: %s' % (img_fn, error)
+    if s['failures']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
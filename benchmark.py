@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+'''
+Time the decode path on synthetic ROM images of increasing size
+
+Each size runs in its own process so peak memory (max RSS) is per size
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+DEFAULT_SIZES = '1K,16K,256K,1M,4M'
+# compose_viewport() frames timed per size
+FRAMES = 20
+# Headless tools must be usable within this many seconds of starting
+STARTUP_LIMIT = 1.0
+# What a headless tool needs before it can do any work
+STARTUP_CODE = '''
+import time
+tstart = time.time()
+from rompar.config import Rompar
+import rompar.decode
+Rompar(gui=False)
+print time.time() - tstart
+'''
+
+def parse_size(s):
+    '''"4M" (square, bits), "1K" or "COLSxROWS" => (cols, rows)'''
+    s = s.strip()
+    if 'x' in s:
+        cols, rows = s.split('x')
+        return int(cols), int(rows)
+    mult = {'K': 1 << 10, 'M': 1 << 20}.get(s[-1].upper(), 1)
+    if mult != 1:
+        s = s[:-1]
+    side = int(round((int(s) * mult) ** 0.5))
+    return side, side
+
+def peak_mb():
+    # Linux reports KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_startup():
+    '''(import + setup seconds, whole process seconds) of a fresh interpreter'''
+    tstart = time.time()
+    out = subprocess.check_output([sys.executable, '-c', STARTUP_CODE],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(out.split()[-1]), time.time() - tstart
+
+def bench_size(args):
+    (cols, rows), opts = args
+    if not opts['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+
+    from rompar.config import Rompar
+    from rompar.data import process_image, read_data, get_all_data, save_grid, save_txt, read_grid_file, load_grid
+    from rompar.synth import synth_bits, synth_project
+
+    stages = []
+    def timed(name, f, *a, **kw):
+        tstart = time.time()
+        ret = f(*a, **kw)
+        stages.append((name, time.time() - tstart, peak_mb()))
+        return ret
+
+    bits = synth_bits(cols, rows, seed=opts['seed'])
+    self = Rompar(gui=False)
+    img = timed('synth', synth_project, self, bits, pitch=opts['pitch'],
+                group_cols=opts['group_cols'], group_rows=opts['group_rows'],
+                noise=opts['noise'], blur=opts['blur'], gradient=opts['gradient'], seed=opts['seed'])
+    timed('pipeline', process_image, self)
+    timed('read_data', read_data, self, force=True)
+    errors = int((self.data.to_array() != bits).sum())
+    timed('get_all_data', get_all_data, self)
+
+    tmpdir = tempfile.mkdtemp(prefix='rompar-bench')
+    try:
+        for ext in ('.json', '.rompar'):
+            fn = os.path.join(tmpdir, 'grid' + ext)
+            timed('save_grid' + ext, save_grid, self, fn=fn)
+            other = Rompar(gui=False)
+            timed('load_grid' + ext, lambda: load_grid(other, read_grid_file(fn), gui=False))
+            if (other.data.to_array() != self.data.to_array()).any():
+                raise Exception("%s round trip mismatch" % ext)
+        timed('save_txt', save_txt, self, fn=os.path.join(tmpdir, 'out.txt'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    display = None
+    if opts['display']:
+        try:
+            display = bench_display(self, img, timed)
+        except Exception as e:
+            display = 'skipped: %s' % e
+
+    return {
+        'cols': cols,
+        'rows': rows,
+        'bits': cols * rows,
+        'image': '%dx%d' % (img.shape[1], img.shape[0]),
+        'errors': errors,
+        'stages': stages,
+        'display': display,
+        }
+
+def bench_display(self, img, timed):
+    '''Time grid drawing and per frame viewport composition, no window is opened'''
+    import cv2.cv as cv
+    from rompar.data import process_image, redraw_grid
+    from rompar.gui import compose_viewport
+
+    self.gui = True
+    self.img_original = cv.GetImage(cv.fromarray(img))
+    size = cv.GetSize(self.img_original)
+    self.img_grid = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+    self.img_peephole = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+    self.img_hex = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+    cv.Set(self.img_grid, cv.Scalar(0, 0, 0))
+    cv.Set(self.img_hex, cv.Scalar(0, 0, 0))
+    # Typical window
+    self.config.view.w = 1820
+    self.config.view.h = 980
+    self.img_target_key = None
+    process_image(self)
+    timed('redraw_grid', redraw_grid, self)
+
+    def frames():
+        for i in xrange(FRAMES):
+            self.config.view.x = (i * 97) % max(1, size[0] - self.config.view.w)
+            self.config.view.y = (i * 61) % max(1, size[1] - self.config.view.h)
+            compose_viewport(self)
+    timed('show_image x%d' % FRAMES, frames)
+    return 'ok'
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark decoding synthetic mask ROM images')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated bit counts (1K, 4M) or COLSxROWS (default: %(default)s)')
+    parser.add_argument('--pitch', type=int, default=8, help='Pixels between bits')
+    parser.add_argument('--group-cols', type=int, default=8, help='Columns per group')
+    parser.add_argument('--group-rows', type=int, help='Rows per group (default: all)')
+    parser.add_argument('--noise', type=float, default=8.0, help='Gaussian noise standard deviation')
+    parser.add_argument('--blur', type=int, default=1, help='Box blur radius')
+    parser.add_argument('--gradient', type=float, default=0.2, help='Illumination falloff across the image')
+    parser.add_argument('--seed', type=int, default=0, help='Bit pattern and noise seed')
+    parser.add_argument('--no-display', action='store_true', help='Skip grid drawing and show_image timings')
+    parser.add_argument('--json', help='Also write results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show decoder output')
+    args = parser.parse_args()
+
+    opts = {
+        'pitch': args.pitch,
+        'group_cols': args.group_cols,
+        'group_rows': args.group_rows,
+        'noise': args.noise,
+        'blur': args.blur,
+        'gradient': args.gradient,
+        'seed': args.seed,
+        'display': not args.no_display,
+        'verbose': args.verbose,
+        }
+
+    startup, process = bench_startup()
+    print 'Headless startup: %0.3f sec imports, %0.3f sec process' % (startup, process)
+
+    results = []
+    for size in args.sizes.split(','):
+        if not size:
+            continue
+        # Fresh process so max RSS only covers this size
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(bench_size, ((parse_size(size), opts),))
+        finally:
+            pool.close()
+            pool.join()
+        results.append(result)
+
+        print '%d x %d = %d bits, image %s, %d bit errors' % (
+                result['cols'], result['rows'], result['bits'], result['image'], result['errors'])
+        for name, seconds, peak in result['stages']:
+            print '  %-20s %9.3f sec %9.1f MB peak' % (name, seconds, peak)
+        if result['display'] not in (None, 'ok'):
+            print '  display %s' % result['display']
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'startup': startup, 'sizes': results}, f, indent=4, sort_keys=True)
+    failed = False
+    # Wrong bits are a regression
+    if any(result['errors'] for result in results):
+        print 'FAIL: bit errors'
+        failed = True
+    if process > STARTUP_LIMIT:
+        print 'FAIL: headless startup over %0.1f sec' % STARTUP_LIMIT
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
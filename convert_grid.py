@@ -0,0 +1,23 @@
+#! /usr/bin/env python
+
+from rompar.config import Rompar
+from rompar.data import read_grid_file, load_grid, save_grid
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert saved grids between JSON (version 1) and binary .rompar (version 2)')
+    parser.add_argument('grid_in', help='Input grid file, either format')
+    parser.add_argument('grid_out', help='Output grid file, format chosen by extension (.json or .rompar)')
+    args = parser.parse_args()
+
+    self = Rompar(gui=False)
+    grid_json = read_grid_file(args.grid_in)
+    self.img_fn = grid_json.get('img_fn')
+    self.group_cols = grid_json.get('group_cols')
+    self.group_rows = grid_json.get('group_rows')
+    load_grid(self, grid_json, gui=False)
+    save_grid(self, fn=args.grid_out)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
-from rompar import *
-import rompar
+import pickle
+
+from rompar.config import Rompar
+from rompar.data import load_grid, save_grid
 
 # For reference
 def save_grid_pickle(self, fn=None):
@@ -28,14 +30,14 @@ def main():
     parser.add_argument('json', help='Output json file')
     args = parser.parse_args()
 
-    self = rompar.Rompar()
+    self = Rompar(gui=False)
 
     with open(args.pickle, 'rb') as gridfile:
         apickle = pickle.load(gridfile)
     grid_intersections, data, grid_points_x, grid_points_y, config = apickle
 
     configj = dict(config.__dict__)
-    configj['view'] = configj['view'].__dict__
+    configj['view'] = dict(configj['view'].__dict__)
 
     j = {
         'grid_intersections': grid_intersections,
@@ -48,8 +50,8 @@ def main():
         'config': configj,
         }
 
-    rompar.load_grid(self, grid_json=j, gui=False)
-    rompar.save_grid(self, fn=args.json)
+    load_grid(self, grid_json=j, gui=False)
+    save_grid(self, fn=args.json)
 
 if __name__ == "__main__":
     main()
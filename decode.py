@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+import sys
+import json
+import itertools
+
+from rompar.decode import decode_iter, read_jobs, FORMATS
+from rompar.layout import load_layouts
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Decode mask ROM images from saved grids without a display')
+    parser.add_argument('--out-dir', help='Write outputs here instead of next to each image')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='Comma separated output formats: txt, dat, hex, bitplane, npy, json, rompar, sums (default: %(default)s)')
+    parser.add_argument('--layout-file', help='JSON file with extra layout definitions')
+    parser.add_argument('--auto-thresh', action='store_true', help='Pick the bit threshold per image instead of using the saved one')
+    parser.add_argument('--jobs', help='File with one "image grid" pair per line, - for stdin')
+    parser.add_argument('files', nargs='*', help='image grid [image grid ...]')
+    args = parser.parse_args()
+
+    if args.layout_file:
+        load_layouts(args.layout_file)
+    if len(args.files) % 2:
+        parser.error('files must be image grid pairs')
+    jobs = zip(args.files[0::2], args.files[1::2])
+    if args.jobs:
+        f = sys.stdin if args.jobs == '-' else open(args.jobs)
+        jobs = itertools.chain(jobs, read_jobs(f))
+    formats = [fmt for fmt in args.formats.split(',') if fmt]
+
+    # One JSON line per image so results can be streamed into other tools
+    # Decoder progress messages go to stderr to keep stdout parseable
+    results = sys.stdout
+    sys.stdout = sys.stderr
+    failures = 0
+    for result in decode_iter(jobs, out_dir=args.out_dir, formats=formats, auto_thresh=args.auto_thresh):
+        if 'error' in result:
+            failures += 1
+        results.write(json.dumps(result, sort_keys=True) + '\n')
+        results.flush()
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
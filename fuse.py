@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+
+import numpy as np
+
+from rompar.fuse import fuse
+from rompar.decode import write_outputs, FORMATS
+
+def bit_report(self, votes, cols, rows):
+    '''JSON list describing the bits at cols, rows'''
+    ret = []
+    for ci, ri in zip(cols.tolist(), rows.tolist()):
+        ret.append({
+            'col': ci,
+            'row': ri,
+            'x': self.grid_points_x[ci],
+            'y': self.grid_points_y[ri],
+            'dist': votes.dist(ci, ri),
+            'best': int(self.data.get(ci, ri)),
+            })
+    return ret
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Majority vote bits across several registered captures sharing one grid')
+    parser.add_argument('--out', help='Output basename (default: GRID basename + _fused)')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='Comma separated consensus output formats, see decode.py (default: %(default)s)')
+    parser.add_argument('--layout-file', help='JSON file with extra layout definitions')
+    parser.add_argument('--processes', '-j', type=int, help='Images sampled at once, each holds one image in memory (default: one per core)')
+    parser.add_argument('--auto-thresh', action='store_true', help='Pick the bit threshold per image instead of using the saved one')
+    parser.add_argument('--verbose', action='store_true', help='Show decoder output from the workers')
+    parser.add_argument('grid', help='Grid file shared by every image')
+    parser.add_argument('images', nargs='+', help='Captures of the ROM, registered to the grid')
+    args = parser.parse_args()
+
+    out = args.out or os.path.splitext(args.grid)[0] + '_fused'
+    formats = [fmt for fmt in args.formats.split(',') if fmt]
+    if 'sums' in formats:
+        # Aperture sums are per image, the consensus has none
+        parser.error('sums is not a fused output format')
+
+    def progress(result):
+        if 'error' in result:
+            print 'FAIL %s: %s' % (result['image'], result['error'])
+        else:
+            print 'done %s: thresh_div %0.2f' % (result['image'], result['bit_thresh_div'])
+        sys.stdout.flush()
+
+    self, votes, failures = fuse(args.images, args.grid, processes=args.processes,
+                                 auto_thresh=args.auto_thresh, layout_file=args.layout_file,
+                                 quiet=not args.verbose, callback=progress)
+
+    write_outputs(self, out, formats, inputs=[args.grid] + args.images)
+    # Counts per bit, see Votes.stack()
+    np.save(out + '.votes.npy', votes.stack())
+    disputed = bit_report(self, votes, *votes.disputed())
+    with open(out + '.disputed.json', 'w') as f:
+        json.dump(disputed, f, sort_keys=True, indent=4, separators=(',', ': '))
+    undecided = bit_report(self, votes, *votes.undecided())
+    with open(out + '.unsure.json', 'w') as f:
+        json.dump(undecided, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+    print 'Fused %d images (%d failed), %d bits, %d disputed, %d unsure' % (
+            votes.images, len(failures), len(self.data), len(disputed), len(undecided))
+    print 'Wrote %s.*' % out
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+
+import os
+import time
+
+from rompar.config import Rompar
+from rompar.data import load_grid, save_grid
+from rompar.history import History, is_history
+
+def cmd_list(history, args):
+    for entry in history.entries:
+        size = os.path.getsize(os.path.join(history.objects, entry['object']))
+        print '%4d  %s  %-5s  %8d bytes' % (
+                entry['n'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+                'delta' if entry['parent'] is not None else 'base', size)
+    print '%d saves, %d bytes' % (len(history.entries), history.disk_usage())
+
+def cmd_checkout(history, args):
+    grid_json = history.grid_json(args.n)
+    self = Rompar(gui=False)
+    self.img_fn = grid_json.get('img_fn')
+    self.group_cols = grid_json.get('group_cols')
+    self.group_rows = grid_json.get('group_rows')
+    load_grid(self, grid_json, gui=False)
+    save_grid(self, fn=args.out)
+
+def cmd_gc(history, args):
+    freed = history.gc(args.keep)
+    print 'Freed %d bytes, %d saves left' % (freed, len(history.entries))
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect and prune a rompar --history save store')
+    parser.add_argument('history', help='IMAGE_BASE.history directory')
+    sub = parser.add_subparsers()
+    p = sub.add_parser('list', help='List saves')
+    p.set_defaults(func=cmd_list)
+    p = sub.add_parser('checkout', help='Write a save as a regular grid file')
+    p.add_argument('n', type=int, help='Save number')
+    p.add_argument('out', help='Output grid file, format chosen by extension (.json or .rompar)')
+    p.set_defaults(func=cmd_checkout)
+    p = sub.add_parser('gc', help='Drop old saves')
+    p.add_argument('--keep', type=int, default=16, help='Latest saves to keep (default: %(default)s)')
+    p.set_defaults(func=cmd_gc)
+    args = parser.parse_args()
+
+    if not is_history(args.history):
+        raise Exception("%s: not a history" % args.history)
+    args.func(History(args.history), args)
+
+if __name__ == "__main__":
+    main()
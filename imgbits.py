@@ -1,21 +1,56 @@
 import sys
 import os
 import json
+from multiprocessing.pool import ThreadPool
 
-from rompar.data import load_grid
+import numpy as np
+
+from rompar.data import load_grid, read_grid_file
 from rompar.config import Rompar
 
 from PIL import Image
 
-def run(img_fn_in, grid_fn_in, dir_out):
-    self = Rompar()
-    load_grid(self, grid_file=grid_fn_in, gui=False)
-    im = Image.open(img_fn_in)
+# Output modes
+# png: one file per bit under bit/
+# npy: every crop in one bits.npy array indexed col * rows + row, per bit
+#   answers in best.npy (and votes.npy), so meta.json stays small
+MODES = ('png', 'npy')
+ARCHIVE = 'bits.npy'
+BEST = 'best.npy'
+VOTES = 'votes.npy'
+# Answers counted in a fuse.py .votes.npy, in order
+VOTE_KEYS = ('0', '1', '?')
+
+def bit_name(xc, yc):
+    return "%02dgc-%02dgr" % (xc, yc)
+
+def crop(img, x0, y0, x1, y1):
+    '''img[y0:y1, x0:x1], zero filled where it extends past the edges like PIL crop()'''
+    h, w = img.shape[:2]
+    if x0 >= 0 and y0 >= 0 and x1 <= w and y1 <= h:
+        return img[y0:y1, x0:x1]
+    ret = np.zeros((y1 - y0, x1 - x0) + img.shape[2:], dtype=img.dtype)
+    cx0, cy0 = max(0, x0), max(0, y0)
+    cx1, cy1 = min(w, x1), min(h, y1)
+    if cx0 < cx1 and cy0 < cy1:
+        ret[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = img[cy0:cy1, cx0:cx1]
+    return ret
+
+def run(img_fn_in, grid_fn_in, dir_out, mode='png', threads=None, votes_fn=None):
+    self = Rompar(gui=False)
+    load_grid(self, read_grid_file(grid_fn_in), gui=False)
+    if not self.data_read:
+        raise Exception("%s has no bit data" % grid_fn_in)
+    votes = None
+    if votes_fn:
+        votes = np.load(votes_fn, mmap_mode='r')
+        if votes.shape != (len(VOTE_KEYS),) + self.data.shape:
+            raise Exception("%s: %s votes don't match %dx%d bits" % ((votes_fn, votes.shape) + self.data.shape))
+    # Decode once, crops are slices of this
+    src = np.asarray(Image.open(img_fn_in))
 
     if not os.path.exists(dir_out):
         os.mkdir(dir_out)
-    if not os.path.exists(dir_out + '/bit'):
-        os.mkdir(dir_out + '/bit')
 
     meta = {
         "meta": {
@@ -25,43 +60,120 @@ def run(img_fn_in, grid_fn_in, dir_out):
         #"bit": meta_bits
     }
 
-    meta_bits = {}
-    for data, (xc, yc) in zip(self.Data, self.grid_intersections):
-        x0 = xc - self.config.radius
-        x1 = xc + self.config.radius
-        y0 = yc - self.config.radius
-        y1 = yc + self.config.radius
-        
-        bitfn = "%02dgc-%02dgr.png" % (xc, yc)
-        meta_bit = {
-            # Global absolute coordinates
-            'col': self.grid_points_x.index(xc),
-            'row': self.grid_points_y.index(yc),
-            # Gloal pixels coordinates
-            'roi': (x0, y0, x1, y1),
-            # Answer frequency distribution like
-            # {'0': 3, '1': 1, '?': 1}
-            "dist": {data: 1},
-            "best": int(data),
-            }
-        #print meta_bit
-        imc = im.crop((x0, y0, x1, y1))
-        imc.save(os.path.join(dir_out, "bit", bitfn))
-        imc.close()
-        meta_bits[bitfn] = meta_bit
-
-    meta['bit'] = meta_bits
+    if mode == 'npy':
+        write_archive(self, src, dir_out, meta, votes, threads)
+    else:
+        write_pngs(self, src, dir_out, meta, votes, threads)
 
     json.dump(meta, open(os.path.join(dir_out, 'meta.json'), 'w'),
               sort_keys=True, indent=4, separators=(',', ': '))
 
+def write_archive(self, src, dir_out, meta, votes, threads):
+    '''
+    Every crop into one array, bit (col, row) is archive[col * rows + row]
+
+    Per bit answers go in arrays next to it, meta.json only holds the geometry
+    '''
+    r = self.config.radius
+    crop_shape = (2 * r, 2 * r) + src.shape[2:]
+    xs = self.grid_points_x
+    ys = self.grid_points_y
+    archive = np.lib.format.open_memmap(
+        os.path.join(dir_out, ARCHIVE), mode='w+', dtype=src.dtype,
+        shape=(len(xs) * len(ys),) + crop_shape)
+
+    def do_col(ci):
+        xc = xs[ci]
+        for ri, yc in enumerate(ys):
+            archive[ci * len(ys) + ri] = crop(src, xc - r, yc - r, xc + r, yc + r)
+
+    # memmap writes mostly run outside the GIL
+    pool = ThreadPool(threads)
+    try:
+        pool.map(do_col, xrange(len(xs)))
+    finally:
+        pool.close()
+        pool.join()
+    archive.flush()
+    # [col, row] like the grid
+    np.save(os.path.join(dir_out, BEST), self.data.to_array())
+    meta['meta']['archive'] = {
+        'fn': ARCHIVE,
+        'dtype': src.dtype.str,
+        'shape': archive.shape,
+        # Crop of bit (col, row) starts at offset + (col * rows + row) * crop bytes
+        'offset': archive.offset,
+        'best': BEST,
+        }
+    if votes is not None:
+        # (answer, col, row) counts, answers in VOTE_KEYS order
+        np.save(os.path.join(dir_out, VOTES), np.asarray(votes))
+        meta['meta']['archive']['votes'] = VOTES
+        meta['meta']['archive']['vote_keys'] = VOTE_KEYS
+    # Bit (col, row) roi is (x[col] - radius, y[row] - radius, x[col] + radius, y[row] + radius)
+    meta['grid'] = {'x': xs, 'y': ys, 'radius': r}
+
+def write_pngs(self, src, dir_out, meta, votes, threads):
+    '''One png per bit under bit/, meta.json describes each'''
+    r = self.config.radius
+    bits = self.data.to_array()
+    xs = self.grid_points_x
+    ys = self.grid_points_y
+    if not os.path.exists(dir_out + '/bit'):
+        os.mkdir(dir_out + '/bit')
+
+    def do_col(ci):
+        '''Crop every bit in column ci, return its meta entries'''
+        ret = {}
+        xc = xs[ci]
+        col_votes = None if votes is None else np.array(votes[:, ci])
+        for ri, yc in enumerate(ys):
+            data = int(bits[ci, ri])
+            x0 = xc - r
+            x1 = xc + r
+            y0 = yc - r
+            y1 = yc + r
+
+            meta_bit = {
+                # Global absolute coordinates
+                'col': ci,
+                'row': ri,
+                # Gloal pixels coordinates
+                'roi': (x0, y0, x1, y1),
+                # Answer frequency distribution like
+                # {'0': 3, '1': 1, '?': 1}
+                "dist": {str(data): 1},
+                "best": data,
+                }
+            if col_votes is not None:
+                meta_bit['dist'] = dict((k, int(n)) for k, n in zip(VOTE_KEYS, col_votes[:, ri]) if n)
+            bitfn = bit_name(xc, yc) + '.png'
+            Image.fromarray(crop(src, x0, y0, x1, y1)).save(os.path.join(dir_out, "bit", bitfn))
+            ret[bitfn] = meta_bit
+        return ret
+
+    # PNG encoding mostly runs outside the GIL
+    pool = ThreadPool(threads)
+    meta_bits = {}
+    try:
+        for col_bits in pool.imap_unordered(do_col, xrange(len(xs))):
+            meta_bits.update(col_bits)
+    finally:
+        pool.close()
+        pool.join()
+    meta['bit'] = meta_bits
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Extract mask ROM image')
+    parser.add_argument('--mode', choices=MODES, default='png',
+                        help='png: one file per bit, npy: all bits in one %s array' % ARCHIVE)
+    parser.add_argument('--threads', type=int, help='Worker threads (default: one per core)')
+    parser.add_argument('--votes', help='fuse.py .votes.npy to fill in per bit answer distributions')
     parser.add_argument('image', help='Input image')
     parser.add_argument('grid_file', nargs='?', help='Load saved grid file')
     parser.add_argument('dir_out', nargs='?', help='Output directory')
     args = parser.parse_args()
 
-    run(args.image, args.grid_file, args.dir_out)
+    run(args.image, args.grid_file, args.dir_out, mode=args.mode, threads=args.threads, votes_fn=args.votes)
@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+
+import numpy as np
+
+from rompar.pipeline import load_image
+from rompar.tiled import write_tiled, DEFAULT_TILE, EXTENSION
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert an image into a tiled store for large image decoding')
+    parser.add_argument('--tile', type=int, default=DEFAULT_TILE, help='Tile edge length in pixels')
+    parser.add_argument('--raw', help='Input is raw 8 bit BGR of given WIDTHxHEIGHT, read memory mapped')
+    parser.add_argument('image', help='Input image')
+    parser.add_argument('out', nargs='?', help='Output store (default: image + %s)' % EXTENSION)
+    args = parser.parse_args()
+
+    out = args.out or args.image + EXTENSION
+    if args.raw:
+        width, height = [int(v) for v in args.raw.split('x')]
+        img = np.memmap(args.image, dtype=np.uint8, mode='r', shape=(height, width, 3))
+    else:
+        img = load_image(args.image)
+    print 'Image is %dx%d' % (img.shape[1], img.shape[0])
+    write_tiled(img, out, tile=args.tile)
+    print 'Wrote %s' % out
+
+if __name__ == "__main__":
+    main()
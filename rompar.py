@@ -24,6 +24,8 @@ import cv2.cv as cv
 
 from rompar.config import Rompar
 from rompar.cmd import run
+from rompar.layout import load_layouts
+from rompar import timing
 
 def main():
     import argparse
@@ -32,10 +34,19 @@ def main():
     parser.add_argument('--radius', type=int, help='Use given radius for display, bounded square for detection')
     parser.add_argument('--bit-thresh-div', type=str, help='Bit set area threshold divisor')
     # Only care about min
+    parser.add_argument('--auto-thresh', action='store_true', help='Pick bit threshold divisor from the loaded grid (see T)')
     parser.add_argument('--pix-thresh', type=str, help='Pixel is set threshold minimum')
     parser.add_argument('--dilate', type=str, help='Dilation')
     parser.add_argument('--erode', type=str, help='Erosion')
+    parser.add_argument('--layout', help='Bit to byte ordering (default, rows or from --layout-file)')
+    parser.add_argument('--layout-file', help='JSON file with extra layout definitions')
+    parser.add_argument('--save-format', choices=('json', 'rompar'), default='json',
+                        help='Grid save format, rompar is compact binary (default: %(default)s)')
+    parser.add_argument('--history', action='store_true', help='Save as deltas into IMAGE_BASE.history instead of numbered copies')
+    parser.add_argument('--undo-mb', type=float, default=16, help='Memory limit of the undo journal in MiB (default: %(default)s)')
+    parser.add_argument('--autosave', type=float, default=0, help='Autosave every this many seconds if changed')
     parser.add_argument('--debug', action='store_true', help='')
+    parser.add_argument('--profile', help='Time GUI stages, writing a Chrome trace JSON file here on exit')
     parser.add_argument('--load', help='Load saved grid file')
     parser.add_argument('image', nargs='?', help='Input image')
     parser.add_argument('cols_per_group', nargs='?', type=int, help='')
@@ -44,6 +55,11 @@ def main():
 
     self = Rompar()
     self.debug = args.debug
+    self.save_format = args.save_format
+    self.autosave = args.autosave
+    self.save_history = args.history
+    self.journal.max_bytes = int(args.undo_mb * (1 << 20))
+    self.auto_thresh = args.auto_thresh
     self.group_cols = args.cols_per_group
     self.group_rows = args.rows_per_group
     if args.radius:
@@ -57,8 +73,18 @@ def main():
         self.config.dilate = int(args.dilate, 0)
     if args.erode:
         self.config.erode = int(args.erode, 0)
+    if args.layout_file:
+        load_layouts(args.layout_file)
+    if args.layout:
+        self.config.layout = args.layout
 
-    run(self, args.image, grid_file=args.load)
+    if args.profile:
+        timing.enable(args.profile)
+
+    try:
+        run(self, args.image, grid_file=args.load)
+    finally:
+        timing.finish()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+'''
+Batch decoding of many dies across a process pool
+
+Each (image, grid) job is decoded independently by decode_job() in a worker
+process so a run uses every core of the box.  Finished jobs are appended to
+a JSON lines manifest as they complete; rerunning with the same manifest
+skips everything already decoded so an interrupted run picks up where it
+stopped.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import multiprocessing
+
+from decode import decode_job, FORMATS
+from layout import load_layouts
+from project import EXTENSION as PROJECT_EXTENSION
+from tiled import EXTENSION as TILED_EXTENSION
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', TILED_EXTENSION)
+# Grid file tried next to an image, in order
+GRID_EXTENSIONS = ('.json', PROJECT_EXTENSION)
+MANIFEST = 'manifest.jsonl'
+
+def find_jobs(dirname, grid_fn=None):
+    '''
+    (image, grid) pairs for every image in dirname
+
+    Each image uses the grid with the same basename unless grid_fn is given
+    Images without a grid are skipped
+    '''
+    ret = []
+    for fn in sorted(os.listdir(dirname)):
+        base, ext = os.path.splitext(fn)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        img_fn = os.path.join(dirname, fn)
+        this_grid = grid_fn
+        if this_grid is None:
+            for grid_ext in GRID_EXTENSIONS:
+                if os.path.exists(os.path.join(dirname, base + grid_ext)):
+                    this_grid = os.path.join(dirname, base + grid_ext)
+                    break
+            else:
+                continue
+        ret.append((img_fn, this_grid))
+    return ret
+
+def read_manifest(fn):
+    '''Return {image: result} of jobs recorded in a manifest, later entries win'''
+    ret = {}
+    if not os.path.exists(fn):
+        return ret
+    with open(fn, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Partial last line from a killed run
+                continue
+            ret[result['image']] = result
+    return ret
+
+def pending_jobs(jobs, done, retry=True):
+    '''Jobs not yet completed according to manifest results done'''
+    ret = []
+    for img_fn, grid_fn in jobs:
+        result = done.get(img_fn)
+        if result is None or (retry and 'error' in result):
+            ret.append((img_fn, grid_fn))
+    return ret
+
+def init_worker(layout_file, quiet):
+    # Parent handles ^C and tears the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # One process per core already, don't let OpenCV oversubscribe
+    try:
+        import cv2
+        cv2.setNumThreads(1)
+    except (ImportError, AttributeError):
+        pass
+    if layout_file:
+        load_layouts(layout_file)
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+def _run_job(args):
+    img_fn, grid_fn, out_dir, formats, auto_thresh = args
+    return decode_job(img_fn, grid_fn, out_dir=out_dir, formats=formats, auto_thresh=auto_thresh)
+
+class Summary(object):
+    '''Throughput and failures of one run'''
+    def __init__(self):
+        self.tstart = time.time()
+        self.images = 0
+        self.bits = 0
+        self.failures = []
+
+    def add(self, result):
+        self.images += 1
+        if 'error' in result:
+            self.failures.append(result)
+        else:
+            self.bits += result['bits']
+
+    def as_dict(self):
+        dt = max(time.time() - self.tstart, 1e-6)
+        return {
+            'images': self.images,
+            'failed': len(self.failures),
+            'bits': self.bits,
+            'seconds': dt,
+            'bits_per_sec': self.bits / dt,
+            'images_per_min': self.images * 60.0 / dt,
+            'failures': [(r['image'], r['error']) for r in self.failures],
+            }
+
+def run_batch(jobs, manifest_fn, out_dir=None, formats=FORMATS, processes=None,
+              layout_file=None, retry=True, quiet=True, callback=None, auto_thresh=False):
+    '''
+    Decode jobs across a pool of processes, appending each result to manifest_fn
+
+    Jobs already completed in the manifest are skipped
+    callback(result) is called in this process as each job finishes
+    Returns a Summary of this run
+    '''
+    done = read_manifest(manifest_fn)
+    todo = pending_jobs(jobs, done, retry=retry)
+    summary = Summary()
+    if not todo:
+        return summary
+
+    processes = processes or multiprocessing.cpu_count()
+    processes = min(processes, len(todo))
+    pool = multiprocessing.Pool(processes, init_worker, (layout_file, quiet))
+    args = [(img_fn, grid_fn, out_dir, formats, auto_thresh) for img_fn, grid_fn in todo]
+    try:
+        with open(manifest_fn, 'ab') as manifest:
+            results = pool.imap_unordered(_run_job, args)
+            for _i in xrange(len(args)):
+                # Timeout so ^C is delivered while waiting
+                result = results.next(timeout=1 << 31)
+                # Record before reporting so a crash never loses a finished job
+                manifest.write(json.dumps(result, sort_keys=True) + '\n')
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                summary.add(result)
+                if callback:
+                    callback(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return summary
@@ -0,0 +1,144 @@
+'''
+Packed 2D bit storage
+
+Bits are indexed [column, row] where column / row are indices into the
+sorted grid_points_x / grid_points_y lists.  Each column is packed 8 rows
+per byte (MSB first, zero padded) so a multi-megabit ROM costs 1/8 byte
+per bit instead of a Python object reference per bit.
+'''
+
+import numpy as np
+
+class BitMatrix(object):
+    def __init__(self, cols=0, rows=0):
+        self.cols = cols
+        self.rows = rows
+        self.packed = np.zeros((cols, (rows + 7) // 8), dtype=np.uint8)
+        # Bumped by every change, so users can cache things derived from the bits
+        self.version = 0
+
+    @classmethod
+    def from_array(cls, bits):
+        '''Create from a boolean (cols, rows) array'''
+        bits = np.asarray(bits, dtype=bool)
+        self = cls(bits.shape[0], bits.shape[1])
+        if bits.size:
+            self.packed = np.packbits(bits, axis=1)
+        return self
+
+    @classmethod
+    def from_packed(cls, packed, rows):
+        '''Wrap an already packed (cols, (rows + 7) // 8) uint8 array, ie a memmap'''
+        self = cls()
+        self.cols = packed.shape[0]
+        self.rows = rows
+        self.packed = packed
+        return self
+
+    @classmethod
+    def from_chars(cls, chars, cols, rows):
+        '''Create from a '0' / '1' sequence in [column][row] order (save file layout)'''
+        bits = np.array([c == '1' for c in chars], dtype=bool)
+        return cls.from_array(bits.reshape(cols, rows))
+
+    @property
+    def shape(self):
+        return (self.cols, self.rows)
+
+    def __len__(self):
+        return self.cols * self.rows
+
+    def copy(self):
+        ret = BitMatrix()
+        ret.cols = self.cols
+        ret.rows = self.rows
+        ret.packed = self.packed.copy()
+        return ret
+
+    def to_array(self):
+        '''Return boolean (cols, rows) array'''
+        if not self.cols or not self.rows:
+            return np.zeros((self.cols, self.rows), dtype=bool)
+        return np.unpackbits(self.packed, axis=1)[:, :self.rows].astype(bool)
+
+    def get_rows(self, row0, row1):
+        '''Return boolean (cols, row1 - row0) array of rows [row0, row1)'''
+        if row0 >= row1:
+            return np.zeros((self.cols, 0), dtype=bool)
+        bits = np.unpackbits(self.packed[:, row0 >> 3:(row1 + 7) >> 3], axis=1)
+        return bits[:, row0 & 7:(row0 & 7) + row1 - row0].astype(bool)
+
+    def to_chars(self):
+        '''Return '0' / '1' list in [column][row] order (save file layout)'''
+        return np.where(self.to_array().ravel(), '1', '0').tolist()
+
+    def count(self):
+        '''Number of set bits'''
+        # Padding bits are always 0
+        return int(np.unpackbits(self.packed).sum(dtype=np.int64))
+
+    def get(self, col, row):
+        return (int(self.packed[col, row >> 3]) >> (7 - (row & 7))) & 1
+
+    def set(self, col, row, val):
+        self.version += 1
+        mask = 0x80 >> (row & 7)
+        if val:
+            self.packed[col, row >> 3] |= mask
+        else:
+            self.packed[col, row >> 3] &= ~mask & 0xff
+
+    def toggle(self, col, row):
+        '''Flip a bit and return its new value'''
+        self.version += 1
+        self.packed[col, row >> 3] ^= 0x80 >> (row & 7)
+        return self.get(col, row)
+
+    def __getitem__(self, key):
+        '''m[col, row] returns 0 / 1, anything else slices the unpacked bool array'''
+        if isinstance(key, tuple) and len(key) == 2 and \
+                all(isinstance(k, (int, long, np.integer)) for k in key):
+            return self.get(*key)
+        return self.to_array()[key]
+
+    def get_col(self, col):
+        return np.unpackbits(self.packed[col])[:self.rows].astype(bool)
+
+    def set_col(self, col, bits):
+        self.version += 1
+        self.packed[col] = np.packbits(np.asarray(bits, dtype=bool))
+
+    def get_row(self, row):
+        return ((self.packed[:, row >> 3] >> (7 - (row & 7))) & 1).astype(bool)
+
+    def set_row(self, row, bits):
+        self.version += 1
+        mask = np.uint8(0x80 >> (row & 7))
+        col = self.packed[:, row >> 3]
+        col &= ~mask
+        col |= np.where(np.asarray(bits, dtype=bool), mask, np.uint8(0))
+
+    def insert_col(self, col, bits):
+        self.version += 1
+        self.packed = np.insert(self.packed, col, np.packbits(np.asarray(bits, dtype=bool)), axis=0)
+        self.cols += 1
+
+    def delete_col(self, col):
+        self.version += 1
+        self.packed = np.delete(self.packed, col, axis=0)
+        self.cols -= 1
+
+    def insert_row(self, row, bits):
+        self.version += 1
+        arr = np.insert(self.to_array(), row, np.asarray(bits, dtype=bool), axis=1)
+        self.rows += 1
+        self.packed = np.packbits(arr, axis=1)
+
+    def delete_row(self, row):
+        self.version += 1
+        arr = np.delete(self.to_array(), row, axis=1)
+        self.rows -= 1
+        if self.rows:
+            self.packed = np.packbits(arr, axis=1)
+        else:
+            self.packed = np.zeros((self.cols, 0), dtype=np.uint8)
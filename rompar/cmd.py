@@ -19,15 +19,26 @@
 #    GNU General Public License for more details.
 
 import sys
+import math
 import cv2.cv as cv
 import traceback
 
 from data import *
 from gui import *
 from config import *
+from timing import print_timing
+from search import parse_hex
+from saver import Saver, Autosaver, snapshot, save_snapshot, save_history, autosave_fn
+from history import History, EXTENSION as HISTORY_EXTENSION
+from pyramid import load_pyramid
+from tiled import TiledImage, is_tiled
+import timing
+
+# Grid rotation per [ / ] keypress, degrees
+ROTATE_STEP = 0.05
 
 def cmd_find(self, k):
-    print 'Enter space delimeted HEX (in image window), e.g. 10 A1 EF: ',
+    print 'Enter HEX (in image window), e.g. 10 A1 EF, * prefix to also try invert/LSB: ',
     sys.stdout.flush()
     shx = ''
     while 42:
@@ -56,40 +67,129 @@ def cmd_find(self, k):
             sys.stdout.write(c)
             sys.stdout.flush()
             shx += c
+    shx = shx.strip()
+    all_variants = shx.startswith('*')
     try:
-        self.Search_HEX = [int(h, 16) for h in shx.strip().split(' ')]
+        pattern = parse_hex(shx.lstrip('*'))
     except ValueError:
         print 'Invalid hex value'
         return
-    print 'searching for', shx.upper()
+    print 'searching for', ' '.join('%02X' % b for b in pattern)
+    self.search = Search(pattern, all_variants=all_variants)
+    if search_data(self) is None:
+        print 'Data not read yet, will search once read'
+        return
+    print '%d matches, n/N for next/previous' % len(self.search)
+
+def cmd_next_match(self, n):
+    search = search_data(self)
+    if search is None:
+        print 'No search'
+        return
+    match = search.step(n)
+    if match is None:
+        print 'No matches'
+        return
+    i, offset, (invert, lsb) = match
+    cell_cols, cell_rows = data_cells(self)
+    col, row = cell_cols[offset], cell_rows[offset]
+    print 'Match %d / %d: offset 0x%X, column %d, row %d%s%s' % (
+            i + 1, len(search), offset, col, row,
+            ', inverted' if invert else '', ', LSB flipped' if lsb else '')
+    center_on(self, self.grid_points_x[col], self.grid_points_y[row])
 
 
+def get_saver(self):
+    if self.saver is None:
+        self.saver = Saver()
+    return self.saver
+
 def cmd_save(self):
     print 'saving...'
 
+    if self.history is not None:
+        # Only what changed since the last save is written, plus the text dump
+        get_saver(self).submit('Save', save_history, self.history, snapshot(self))
+        return
+
     next_save(self)
-    save_grid(self)
+    # Written in the background, keep working
+    get_saver(self).submit('Save %d' % self.saven, save_snapshot, snapshot(self))
+    # The files may not exist yet, don't hand out the slot again
+    self.saven += 1
+
+def start_autosave(self):
+    if self.autosave and self.autosaver is None:
+        print 'Autosaving to %s every %s sec' % (autosave_fn(self), self.autosave)
+        self.autosaver = Autosaver(self, get_saver(self), self.autosave)
 
+def stop_saving(self):
+    '''Stop autosaving and wait for pending saves'''
+    if self.autosaver is not None:
+        self.autosaver.stop()
+        self.autosaver = None
+    if self.saver is not None:
+        print 'Waiting for saves to finish'
+        self.saver.wait()
+        self.saver.close()
+        self.saver = None
+
+def cmd_auto_threshold(self):
     if not self.data_read:
-        print 'No bits to save'
+        print 'Data not read yet, nothing to threshold'
+        return
+    try:
+        sep, marginal = auto_threshold(self)
+    except Exception as e:
+        print 'Auto threshold failed: %s' % e
+        return
+    print 'thresh_div: %0.3f' % self.config.bit_thresh_div
+    if sep is None:
+        print 'Separation: none, all bits read the same'
+    else:
+        print 'Separation: %0.1f%%%s' % (sep * 100, ' (classes overlap)' if sep < 0 else '')
+    print 'Bits within %d%% of threshold: %d' % (MARGIN_WARN * 100, marginal)
+
+def cmd_undo(self, func, what):
+    kind = func(self)
+    if kind is None:
+        print 'Nothing to %s' % what
+    else:
+        print '%s %s (%d edits, %d KiB journaled)' % (what, kind, len(self.journal), self.journal.nbytes / 1024)
+
+def cmd_fit_grid(self):
+    model = fit_grid(self)
+    print 'Grid model: col pitch %0.3f, row pitch %0.3f, rotation %0.3f deg' % (
+            model.cols.pitch, model.rows.pitch, math.degrees(model.rotation()))
+    if self.data_read:
+        read_data(self)
     else:
-        if 0 and self.save_dat:
-            save_dat(self)
-        save_txt(self)
+        redraw_grid(self)
+
+def cmd_rotate(self, degrees):
+    rotate_grid(self, math.radians(degrees))
+    print 'Grid rotation: %0.3f deg' % math.degrees(self.grid_model.rotation())
+    if self.data_read:
+        read_data(self)
+    else:
+        redraw_grid(self)
 
 def cmd_help():
     print 'a/A  decrease/increase radius of read aperture'
     print 'b    blank image (to view template)'
-    print 'c    print status (ie configuration)'
+    print 'c    print status (ie configuration and, with --profile, stage timing)'
     print 'd/D  decrease/increase dilation'
     print 'e/E  decrease/increase erosion'
     print 'f/F  decrease font size'
     print 'g    toggle grid display'
+    print 'G    fit grid model (per group origin, sub-pixel pitch)'
     print 'h    print help'
     print 'H    toggle binary / hex data display'
     print 'i    toggle invert data 0/1'
     print 'l    toggle LSB data order (default MSB)'
     print 'm/M  decrease/increase bit threshold divisor'
+    print 'n/N  jump to next/previous search match'
+    print 'T    pick bit threshold divisor automatically'
     print 'o    toggle original image display'
     print 'p    toggle peephole view'
     print 'q    quit'
@@ -97,7 +197,12 @@ def cmd_help():
     print 'R    reset cols (and exit bit/grid editing mode)'
     print 's    show data values (HEX)'
     print 'S    save data and grid'
+    print 'w    toggle marking bits close to the threshold'
     print 't    apply threshold filter'
+    print 'u/U  undo/redo last bit toggle or grid edit'
+    print 'v    toggle minimap (click it to jump)'
+    print 'z/Z  zoom out/in (data and peephole overlays only at 1:1)'
+    print '[/]  rotate grid %g degrees counterclockwise/clockwise' % ROTATE_STEP
     print '-/+  decrease/increase threshold filter minimum'
     print '/    search for HEX (highlight when HEX shown)'
     print '?    print help'
@@ -139,9 +244,12 @@ def on_key(self, k):
     if k == 65288 and self.Edit_x >= 0:
         # BS
         print 'deleting column'
-        self.grid_points_x.remove(self.grid_points_x[self.Edit_x])
+        ci = self.Edit_x
         self.Edit_x = -1
-        read_data(self)
+        delete_col(self, ci)
+        # Edit group highlight went with it
+        if self.Edit_y >= 0:
+            redraw_row(self, self.Edit_y)
     elif k == K_LEFT:
         pan(self, -self.config.view.incx, 0)
     elif k == K_RIGHT:
@@ -181,25 +289,25 @@ def on_key(self, k):
     elif k == 65432 and self.Edit_x >= 0:
         # right arrow on numpad - edit single column
         print 'editing column', self.Edit_x
-        self.grid_points_x[self.Edit_x] += 1
-        read_data(self)
+        move_col(self, self.Edit_x, 1)
     elif k == 65430 and self.Edit_x >= 0:
         # left arrow on numpad - edit single column
         print 'editing column', self.Edit_x
-        self.grid_points_x[self.Edit_x] -= 1
-        read_data(self)
+        move_col(self, self.Edit_x, -1)
     elif (k == 65439 or k == 65535) and self.Edit_y >= 0:
         # delete
         print 'deleting row', self.Edit_y
-        self.grid_points_y.remove(self.Edit_y)
+        ri = self.grid_points_y.index(self.Edit_y)
         self.Edit_y = -1
-        read_data(self)
+        delete_row(self, ri)
     elif k == chr(10):
         # enter
+        edit_y = self.Edit_y
         self.Edit_x = -1
         self.Edit_y = -1
         print 'Done editing'
-        read_data(self)
+        if edit_y >= 0:
+            redraw_row(self, edit_y)
     elif k == 'a':
         if self.config.radius:
             self.config.radius -= 1
@@ -213,6 +321,8 @@ def on_key(self, k):
         self.config.img_display_blank_image = not self.config.img_display_blank_image
     elif k == 'c':
         print_config(self)
+        if timing.enabled():
+            print_timing()
     elif k == 'd':
         self.config.dilate = max(self.config.dilate - 1, 0)
         print 'Dilate: %d' % self.config.dilate
@@ -253,6 +363,12 @@ def on_key(self, k):
     elif k == 'g':
         self.config.img_display_grid = not self.config.img_display_grid
         print 'Display grid:', self.config.img_display_grid
+    elif k == 'G':
+        cmd_fit_grid(self)
+    elif k == '[':
+        cmd_rotate(self, -ROTATE_STEP)
+    elif k == ']':
+        cmd_rotate(self, ROTATE_STEP)
     elif k == 'h' or k == '?':
         cmd_help()
     elif k == 'H':
@@ -279,19 +395,43 @@ def on_key(self, k):
         self.config.img_display_peephole = not self.config.img_display_peephole
         print 'display peephole:', self.config.img_display_peephole
     elif k == 'r':
-        print 'reading %d points...' % len(self.grid_intersections)
+        print 'reading %d points...' % (len(self.grid_points_x) * len(self.grid_points_y))
         read_data(self, force=True)
     elif k == 'R':
-        redraw_grid(self)
         self.data_read = False
+        self.journal.clear()
+        redraw_grid(self)
     elif k == 's':
         self.config.img_display_data = not self.config.img_display_data
         print 'show data:', self.config.img_display_data
     elif k == 'S':
         cmd_save(self)
+    elif k == 'w':
+        self.config.img_display_margin = not self.config.img_display_margin
+        print 'Display margin:', self.config.img_display_margin
+        redraw_grid(self)
     elif k == 'q':
         print "Exiting on q"
         self.running = False
+    elif k == 'n':
+        cmd_next_match(self, 1)
+    elif k == 'N':
+        cmd_next_match(self, -1)
+    elif k == 'T':
+        cmd_auto_threshold(self)
+    elif k == 'v':
+        self.config.img_display_minimap = not self.config.img_display_minimap
+        print 'Display minimap:', self.config.img_display_minimap
+    elif k == 'z':
+        set_zoom(self, zoom_level(self) + 1)
+        print 'Zoom: 1/%d' % (1 << zoom_level(self))
+    elif k == 'Z':
+        set_zoom(self, zoom_level(self) - 1)
+        print 'Zoom: 1/%d' % (1 << zoom_level(self))
+    elif k == 'u':
+        cmd_undo(self, undo_edit, 'undo')
+    elif k == 'U':
+        cmd_undo(self, redo_edit, 'redo')
     elif k == 't':
         self.config.threshold = True
         print 'Threshold:', self.config.threshold
@@ -311,15 +451,10 @@ def on_key(self, k):
     #    print 'Unknown command %s' % k
 
 def do_loop(self):
-    # image processing
-    if self.config.threshold:
-        cv.Threshold(self.img_original, self.img_target, self.config.pix_thresh_min, 0xff, cv.CV_THRESH_BINARY)
-        cv.And(self.img_target, self.img_mask, self.img_target)
-    if self.config.dilate:
-        cv.Dilate(self.img_target, self.img_target, iterations=self.config.dilate)
-    if self.config.erode:
-        cv.Erode(self.img_target, self.img_target, iterations=self.config.erode)
-    show_image(self)
+    with self.state_lock:
+        # image processing, only redone when its parameters change
+        process_image(self)
+        show_image(self)
 
     sys.stdout.write('> ')
     sys.stdout.flush()
@@ -352,7 +487,8 @@ def do_loop(self):
         print "Exiting on closed window"
         self.running = False
         return
-    on_key(self, k)
+    with self.state_lock:
+        on_key(self, k)
 
 
 def run(selfl, img_fn=None, grid_file=None):
@@ -362,8 +498,7 @@ def run(selfl, img_fn=None, grid_file=None):
     self.img_fn = img_fn
     grid_json = None
     if grid_file:
-        with open(grid_file, 'rb') as gridfile:
-            grid_json = json.load(gridfile)
+        grid_json = read_grid_file(grid_file)
         if self.img_fn is None:
             self.img_fn = grid_json.get('img_fn')
         if self.group_cols is None:
@@ -383,22 +518,29 @@ def run(selfl, img_fn=None, grid_file=None):
 
     #self.img_original= cv.LoadImage(img_fn, iscolor=cv.CV_LOAD_IMAGE_GRAYSCALE)
     #self.img_original= cv.LoadImage(img_fn, iscolor=cv.CV_LOAD_IMAGE_COLOR)
-    self.img_original = cv.LoadImage(self.img_fn)
-    print 'Image is %dx%d' % (self.img_original.width, self.img_original.height)
+    if is_tiled(self.img_fn):
+        # Only the viewport and the bits being sampled are ever read, see tiled.py
+        self.img_source = TiledImage(self.img_fn)
+        self.img_original = None
+        self.pyramid = load_pyramid(self.img_fn, self.img_source)
+        print 'Image is %dx%d (tiled)' % (self.img_source.width, self.img_source.height)
+    else:
+        self.img_original = cv.LoadImage(self.img_fn)
+        self.pyramid = load_pyramid(self.img_fn, img_array(self.img_original))
+        print 'Image is %dx%d' % (self.img_original.width, self.img_original.height)
+    process_image(self)
 
     self.basename = self.img_fn[:self.img_fn.find('.')]
+    if self.save_history:
+        self.history = History(self.basename + HISTORY_EXTENSION)
+        print 'Saving to history %s (%d saves)' % (self.history.path, len(self.history.entries))
 
-    # image buffers
-    self.img_target = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
-    self.img_grid = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
-    self.img_mask = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
-    self.img_peephole = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
-    cv.Set(self.img_mask, cv.Scalar(0x00, 0x00, 0xff))
-    self.img_display = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
+    # image buffers, viewport sized for tiled images
+    size = overlay_size(self)
+    self.img_grid = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+    self.img_peephole = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
     cv.Set(self.img_grid, cv.Scalar(0, 0, 0))
-    self.img_blank = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
-    cv.Set(self.img_blank, cv.Scalar(0, 0, 0))
-    self.img_hex = cv.CreateImage(cv.GetSize(self.img_original), cv.IPL_DEPTH_8U, 3)
+    self.img_hex = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
     cv.Set(self.img_hex, cv.Scalar(0, 0, 0))
 
     self.config.font_size = 1.0
@@ -414,22 +556,26 @@ def run(selfl, img_fn=None, grid_file=None):
     cv.NamedWindow(self.title, 1)
     cv.SetMouseCallback(self.title, on_mouse, self)
 
-    self.img_target = cv.CloneImage(self.img_original)
-
     if grid_json:
         load_grid(self, grid_json)
+        if self.auto_thresh:
+            cmd_auto_threshold(self)
 
     cmd_help()
     cmd_help2()
+    start_autosave(self)
 
     # main loop
-    while self.running:
-        try:
-            do_loop(self)
-        except Exception:
-            if self.debug:
-                raise
-            print 'WARNING: exception'
-            traceback.print_exc()
+    try:
+        while self.running:
+            try:
+                do_loop(self)
+            except Exception:
+                if self.debug:
+                    raise
+                print 'WARNING: exception'
+                traceback.print_exc()
+    finally:
+        stop_saving(self)
 
     print 'Exiting'
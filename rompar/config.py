@@ -18,27 +18,50 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
+import os
 import subprocess
+import threading
+from collections import OrderedDict
+
+from journal import Journal
+
+# Used when the screen size can't be found
+DEFAULT_SCREEN = (1024, 768)
 
 def screen_wh():
-    cmd = ['xrandr']
-    cmd2 = ['grep', '*']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(cmd2, stdin=p.stdout, stdout=subprocess.PIPE)
-    p.stdout.close()
-     
-    resolution_string, _junk = p2.communicate()
-    resolution = resolution_string.split()[0]
-    width, height = resolution.split('x')
-    return int(width), int(height)
+    '''Current screen resolution from xrandr, DEFAULT_SCREEN if there is none'''
+    if not os.environ.get('DISPLAY'):
+        return DEFAULT_SCREEN
+    try:
+        p = subprocess.Popen(['xrandr'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _err = p.communicate()
+    except OSError:
+        return DEFAULT_SCREEN
+    # Current mode is marked with a *
+    for line in out.splitlines():
+        if '*' in line:
+            try:
+                width, height = line.split()[0].split('x')
+                return int(width), int(height)
+            except ValueError:
+                break
+    return DEFAULT_SCREEN
 
 class View(object):
-    def __init__(self):
+    # Sized from the screen on first use
+    SCREEN_ATTRS = ('w', 'h', 'incx', 'incy')
+
+    def __init__(self, screen=True):
         # Display objects
         # Crop / viewport
         self.x = 0
         self.y = 0
-        screenw, screenh = screen_wh()
+        # Display shrunk 2**zoom times, see pyramid.py
+        self.zoom = 0
+        # Headless users have no screen to size against, use DEFAULT_SCREEN
+        self._screen = screen
+
+    def set_screen(self, screenw, screenh):
         # Displayed coordinates
         self.w = screenw - 100
         self.h = screenh - 100
@@ -46,8 +69,20 @@ class View(object):
         self.incx = screenw // 3
         self.incy = screenh // 3
 
+    def __getattr__(self, name):
+        # Only called for attributes not set yet
+        # Querying the screen is slow and fails without a display so wait until needed
+        if name not in View.SCREEN_ATTRS:
+            raise AttributeError(name)
+        self.set_screen(*(screen_wh() if self.__dict__.get('_screen', True) else DEFAULT_SCREEN))
+        return self.__dict__[name]
+
+    def as_dict(self):
+        '''Saved view settings'''
+        return dict((k, v) for k, v in self.__dict__.iteritems() if not k.startswith('_'))
+
 class Config(object):
-    def __init__(self):
+    def __init__(self, screen=True):
         # Display options
         # Overlay bit position grid
         self.img_display_grid = True
@@ -61,6 +96,10 @@ class Config(object):
         self.img_display_data = False
         # Overlay binary data on image
         self.img_display_binary = False
+        # Mark bits whose aperture value is close to the threshold
+        self.img_display_margin = False
+        # Overview of the whole image with the viewport marked
+        self.img_display_minimap = True
         # Bit is 1 if sum of pixels in area > (max possible value / thresh_div)
         # ie 10 => set if average value at least 1/10 max brightness  
         # Feel this is sort of a weird way to do this
@@ -79,16 +118,18 @@ class Config(object):
         self.threshold = True
     
         self.LSB_Mode = False
+        # Bit to byte ordering, see layout.py
+        self.layout = 'default'
     
         self.font_size = None
 
-        self.view = View()
+        self.view = View(screen=screen)
         
         self.save_dat = False
 
 class Rompar(object):
-    def __init__(self):
-        self.gui = True
+    def __init__(self, gui=True):
+        self.gui = gui
 
         self.img_fn = None
 
@@ -104,7 +145,22 @@ class Rompar(object):
         self.group_cols = 0
         self.group_rows = 0
 
-        self.Search_HEX = None
+        # Search of the packed bytes, see search.py
+        self.search = None
+        # Grid save format: json (version 1) or rompar (binary version 2)
+        self.save_format = 'json'
+        # Save into a history store instead of numbered copies, see history.py
+        self.save_history = False
+        self.history = None
+        # Seconds between autosaves, 0 to disable
+        self.autosave = 0
+        # Background writer and autosave thread, see saver.py
+        self.saver = None
+        self.autosaver = None
+        # Held by the GUI thread while changing state, snapshots take it too
+        self.state_lock = threading.RLock()
+        # Pick bit_thresh_div from the loaded grid's bit values
+        self.auto_thresh = False
         # Number of save commands issued
         # Used to create unique save file postfix per save
         self.saven = 0
@@ -115,25 +171,63 @@ class Rompar(object):
 
         # Processed data
         self.inverted = False
-        self.data = []
+        # BitMatrix indexed [column, row]
+        self.data = None
         # Global
         self.grid_points_x = []
         self.grid_points_y = []
-        self.grid_intersections = []
+        # Sub-pixel / rotated grid, see grid.py
+        # grid_points_x / grid_points_y are then its lines rounded to whole pixels
+        self.grid_model = None
+        # Bumped by every grid line / model change, see grid_changed()
+        self.grid_version = 0
+        # Grid column / row indices needing resampling by update_data()
+        self.dirty_cols = set()
+        self.dirty_rows = set()
+        # Undo / redo of bit and grid edits, see journal.py
+        self.journal = Journal()
+        # Overlay (x0, y0, x1, y1) regions needing redraw by update_data()
+        self.dirty_rects = []
 
         # Misc
         # Process events while true
         self.running = True
 
         # Image buffers
+        # Loaded image, None if there is none or it is a tiled img_source
+        self.img_original = None
         self.img_target = None
+        # Preprocessing parameters img_target was made with
+        self.img_target_key = None
+        # pipeline_key() => Stage, least recently used first
+        self.pipeline_cache = OrderedDict()
+        self.img_stage = None
         self.img_grid = None
-        self.img_mask = None
         self.img_peephole = None
+        # Image coordinates of overlay (img_grid, img_peephole, img_hex) pixel 0, 0
+        # Always 0, 0 unless a tiled img_source gives them viewport sized windows
+        self.overlay_origin = (0, 0)
+        # (key, viewport region) of a tiled img_source last displayed
+        self.img_view = None
+        # Viewport sized, reused every frame
         self.img_display = None
         self.img_display_viewport = None
-        self.img_blank = None
         self.img_hex = None
+        # Cached rendering of img_hex, see hexview.py
+        self.hex_overlay = None
+        # (key, get_all_bytes() result) so unchanged bits aren't repacked every frame
+        self.bytes_cache = None
+        # Zoom levels of img_original, see pyramid.py
+        self.pyramid = None
+        # Minimap (x, y, w, h) on the display and its pyramid level, None if not shown
+        self.minimap_rect = None
+        # Tiled image store sampled region by region instead of img_target
+        self.img_source = None
+        # Summed-area table of img_target, None until needed
+        self.img_integral = None
+        # Aperture sum per bit and the sums_key() they were computed for
+        self.bit_sums = None
+        self.bit_sums_key = None
         # Font currently rendering
         self.font = None
     
@@ -142,7 +236,7 @@ class Rompar(object):
         self.debug = False
         self.basename = None
 
-        self.config = Config()
+        self.config = Config(screen=gui)
 
 def print_config(self):
     print 'Display'
@@ -151,6 +245,7 @@ def print_config(self):
     print '  Peephole  %s' % self.config.img_display_peephole
     print '  Data      %s' % self.config.img_display_data
     print '    As binary %s' % self.config.img_display_binary
+    print '  Margin    %s' % self.config.img_display_margin
     print 'Pixel processing'
     print '  Bit threshold divisor   %s' % self.config.bit_thresh_div
     print '  Pixel threshold minimum %s (0x%02X)' % (self.config.pix_thresh_min, self.config.pix_thresh_min)
@@ -158,6 +253,8 @@ def print_config(self):
     print '  Erode     %s' % self.config.erode
     print '  Radius    %s' % self.config.radius
     print '  Threshold %s' % self.config.threshold
+    print '  Cached    %d preprocessed images, %d MiB' % (
+            len(self.pipeline_cache), sum(stage.nbytes() for stage in self.pipeline_cache.itervalues()) >> 20)
     print '  Step'
     print '    X       % 5.1f' % self.step_x
     print '    X       % 5.1f' % self.step_y
@@ -170,7 +267,9 @@ def print_config(self):
     print '    X       %d cols' % len(self.grid_points_x)
     print '    Y       %d rows' % len(self.grid_points_y)
     print '  Inverted  %d' % self.inverted
-    print '  Intersections %d' % len(self.grid_intersections)
+    print '  LSB       %d' % self.config.LSB_Mode
+    print '  Layout    %s' % self.config.layout
+    print '  Intersections %d' % (len(self.grid_points_x) * len(self.grid_points_y))
     print '  Viewport'
     print '    X       %d' % self.config.view.x
     print '    Y       %d' % self.config.view.y
@@ -178,4 +277,5 @@ def print_config(self):
     print '    H       %d' % self.config.view.h
     print '    PanX    %d' % self.config.view.incx
     print '    PanY    %d' % self.config.view.incy
+    print '    Zoom    1/%d' % (1 << self.config.view.zoom)
 
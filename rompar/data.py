@@ -18,40 +18,287 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-import cv2.cv as cv
+try:
+    import cv2.cv as cv
+except ImportError:
+    # Only the GUI draws, headless users can do without the legacy cv module
+    cv = None
+import numpy as np
+import bisect
 import os
+import math
 import json
 
+from bitmatrix import BitMatrix
+from layout import get_layout
+from project import EXTENSION as PROJECT_EXTENSION, is_project, read_project, write_project
+from sample import *
+from tiled import region_aperture_sums
+from pipeline import *
+from timing import timed
+from search import Search
+from history import is_history, History
+from export import write_txt, write_dat, layout_bytes
+from grid import Grid, Axis, fit_axis
+
+def grid_changed(self):
+    '''Note grid lines or model changed, anything computed for the old grid is stale'''
+    self.grid_version += 1
+
+def sort_grid(self):
+    if self.grid_model is not None:
+        cols = self.grid_model.cols.sort()
+        rows = self.grid_model.rows.sort()
+        sync_grid_points(self)
+        changed = cols or rows
+    else:
+        changed = not is_sorted(self.grid_points_x) or not is_sorted(self.grid_points_y)
+        self.grid_points_x.sort()
+        self.grid_points_y.sort()
+    if changed:
+        grid_changed(self)
+
+def sync_grid_points(self):
+    '''grid_points_x / grid_points_y from the grid model'''
+    self.grid_points_x = self.grid_model.cols.rounded()
+    self.grid_points_y = self.grid_model.rows.rounded()
+
+def fit_grid(self):
+    '''Replace the grid with a fitted model: per group origins and a float pitch, keeping any rotation'''
+    model = Grid(fit_axis(self.grid_points_x, self.group_cols), fit_axis(self.grid_points_y, self.group_rows))
+    if self.grid_model is not None:
+        model.matrix = self.grid_model.matrix
+        model.pivot = self.grid_model.pivot
+    self.grid_model = model
+    sync_grid_points(self)
+    grid_changed(self)
+    return model
+
+def append_col(self, x):
+    '''Add grid column at x while laying out the grid, before bits are read'''
+    self.grid_points_x.append(x)
+    if self.grid_model is not None:
+        self.grid_model.cols.insert(len(self.grid_model.cols), x)
+    grid_changed(self)
+
+def append_row(self, y):
+    '''Add grid row at y while laying out the grid, before bits are read'''
+    self.grid_points_y.append(y)
+    if self.grid_model is not None:
+        self.grid_model.rows.insert(len(self.grid_model.rows), y)
+    grid_changed(self)
+
+def clear_cols(self):
+    '''Drop every grid column, keeping any rotation'''
+    self.grid_points_x = []
+    if self.grid_model is not None:
+        self.grid_model.cols = Axis([])
+    grid_changed(self)
+
+def clear_rows(self):
+    '''Drop every grid row, keeping any rotation'''
+    self.grid_points_y = []
+    if self.grid_model is not None:
+        self.grid_model.rows = Axis([])
+    grid_changed(self)
+
+def rotate_grid(self, angle):
+    '''Rotate the grid model by angle radians more'''
+    if self.grid_model is None:
+        self.grid_model = Grid.from_points(self.grid_points_x, self.grid_points_y)
+    self.grid_model.set_rotation(self.grid_model.rotation() + angle)
+    grid_changed(self)
+
+def image_size(self):
+    '''(width, height) of the image being worked on'''
+    if self.img_source is not None:
+        h, w = self.img_source.shape[:2]
+    else:
+        h, w = img_array(self.img_target).shape[:2]
+    return w, h
+
+def overlay_size(self):
+    '''
+    Size of img_grid / img_peephole / img_hex
+
+    The whole image, or for a tiled img_source just the viewport
+    (from overlay_origin) so nothing image sized is allocated
+    '''
+    w, h = image_size(self)
+    if self.img_source is None:
+        return w, h
+    return min(w, self.config.view.w), min(h, self.config.view.h)
+
+def overlay_xy(self, x, y):
+    '''Overlay buffer coordinates of image x, y'''
+    return x - self.overlay_origin[0], y - self.overlay_origin[1]
+
+@timed('redraw_grid')
 def redraw_grid(self):
     if not self.gui:
         return
+    sort_grid(self)
+    w, h = image_size(self)
+    redraw_region(self, 0, 0, w, h)
+
+def get_intersections(self):
+    '''List of (x, y) for every grid intersection, sorted'''
+    return [(x, y) for x in self.grid_points_x for y in self.grid_points_y]
+
+def grid_index(points, v):
+    '''Index of exact coordinate v in sorted grid points'''
+    i = bisect.bisect_left(points, v)
+    if i == len(points) or points[i] != v:
+        raise ValueError("%s is not a grid line" % v)
+    return i
+
+def redraw_region(self, x0, y0, x1, y1):
+    '''
+    Clear and redraw grid / bit overlays within [x0, x1) x [y0, y1)
+    None bounds extend to the image edge
+    '''
+    if not self.gui:
+        return
+    w, h = image_size(self)
+    # Overlays may only cover part of the image, see overlay_size()
+    ox, oy = self.overlay_origin
+    ow, oh = cv.GetSize(self.img_grid)
+    x0 = ox if x0 is None else max(ox, x0)
+    y0 = oy if y0 is None else max(oy, y0)
+    x1 = ox + ow if x1 is None else min(ox + ow, x1)
+    y1 = oy + oh if y1 is None else min(oy + oh, y1)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    # Anything whose circle could reach into the region
+    pad = overlay_pad(self)
+    cols = range(bisect.bisect_left(self.grid_points_x, x0 - pad),
+                 bisect.bisect_right(self.grid_points_x, x1 + pad))
+    rows = range(bisect.bisect_left(self.grid_points_y, y0 - pad),
+                 bisect.bisect_right(self.grid_points_y, y1 + pad))
+    # Bit centers [column, row] relative to the ROI
+    rotated = self.grid_model is not None and self.grid_model.is_affine()
+    if rotated and cols and rows:
+        px, py = self.grid_model.points(cols, rows)
+        bx = np.floor(px + 0.5).astype(int) - x0
+        by = np.floor(py + 0.5).astype(int) - y0
+    else:
+        bx, by = np.broadcast_arrays(
+                np.array([self.grid_points_x[ci] - x0 for ci in cols], dtype=int)[:, None],
+                np.array([self.grid_points_y[ri] - y0 for ri in rows], dtype=int)[None, :])
+
+    # Draw in full image coordinates shifted to the ROI so pixels match a full redraw
+    rect = (x0 - ox, y0 - oy, x1 - x0, y1 - y0)
+    cv.SetImageROI(self.img_grid, rect)
+    cv.SetImageROI(self.img_peephole, rect)
     cv.Set(self.img_grid, cv.Scalar(0, 0, 0))
     cv.Set(self.img_peephole, cv.Scalar(0, 0, 0))
-    self.grid_intersections = []
-    self.grid_points_x.sort()
-    self.grid_points_y.sort()
-
-    for x in self.grid_points_x:
-        cv.Line(self.img_grid, (x, 0), (x, self.img_target.height), cv.Scalar(0xff, 0x00, 0x00),
-                1)
-        for y in self.grid_points_y:
-            self.grid_intersections.append((x, y))
-    self.grid_intersections.sort()
-    for y in self.grid_points_y:
-        cv.Line(self.img_grid, (0, y), (self.img_target.width, y), cv.Scalar(0xff, 0x00, 0x00),
-                1)
-    for x, y in self.grid_intersections:
-        cv.Circle(
-            self.img_grid, (x, y), self.config.radius, cv.Scalar(0x00, 0x00, 0x00), thickness=-1)
-        cv.Circle(
-            self.img_grid, (x, y), self.config.radius, cv.Scalar(0xff, 0x00, 0x00), thickness=1)
-        cv.Circle(
-            self.img_peephole, (x, y),
-            self.config.radius + 1,
-            cv.Scalar(0xff, 0xff, 0xff),
-            thickness=-1)
+
+    # Rotated grid lines aren't image rows / columns, only the bits are drawn
+    if not rotated:
+        for ci in cols:
+            x = self.grid_points_x[ci] - x0
+            cv.Line(self.img_grid, (x, -y0), (x, h - y0), cv.Scalar(0xff, 0x00, 0x00),
+                    1)
+        for ri in rows:
+            y = self.grid_points_y[ri] - y0
+            cv.Line(self.img_grid, (-x0, y), (w - x0, y), cv.Scalar(0xff, 0x00, 0x00),
+                    1)
+    for i in xrange(len(cols)):
+        for j in xrange(len(rows)):
+            xy = (int(bx[i, j]), int(by[i, j]))
+            cv.Circle(
+                self.img_grid, xy, self.config.radius, cv.Scalar(0x00, 0x00, 0x00), thickness=-1)
+            cv.Circle(
+                self.img_grid, xy, self.config.radius, cv.Scalar(0xff, 0x00, 0x00), thickness=1)
+            cv.Circle(
+                self.img_peephole, xy,
+                self.config.radius + 1,
+                cv.Scalar(0xff, 0xff, 0xff),
+                thickness=-1)
+
+    if self.data_read:
+        sx = self.Edit_x - (self.Edit_x % self.group_cols)
+        for i, ci in enumerate(cols):
+            for j, ri in enumerate(rows):
+                if not self.data.get(ci, ri):
+                    continue
+                xy = (int(bx[i, j]), int(by[i, j]))
+                cv.Circle(
+                    self.img_grid, xy, self.config.radius, cv.Scalar(0x00, 0xff, 0x00), thickness=2)
+                # highlight if we're in edit mode
+                if self.grid_points_y[ri] == self.Edit_y and ci >= sx and ci < sx + self.group_cols:
+                    cv.Circle(
+                        self.img_grid, xy,
+                        self.config.radius,
+                        cv.Scalar(0xff, 0xff, 0xff),
+                        thickness=2)
+
+    # Flag bits read too close to the threshold
+    if self.data_read and self.config.img_display_margin and cols and rows and sums_valid(self):
+        m = margins(self.bit_sums[cols[0]:cols[-1] + 1, rows[0]:rows[-1] + 1],
+                    self.config.radius, self.config.bit_thresh_div)
+        for mci, mri in zip(*np.nonzero(np.abs(m) < MARGIN_WARN)):
+            cv.Circle(
+                self.img_grid,
+                (int(bx[mci, mri]), int(by[mci, mri])),
+                max(1, self.config.radius / 2),
+                cv.Scalar(0x00, 0xff, 0xff),
+                thickness=1)
+
+    cv.ResetImageROI(self.img_grid)
+    cv.ResetImageROI(self.img_peephole)
+
+def overlay_pad(self):
+    '''Distance from its grid lines a bit's overlay can reach'''
+    pad = self.config.radius + 2
+    if self.grid_model is not None:
+        pad += int(math.ceil(self.grid_model.max_offset()))
+    return pad
+
+def col_extent(self, x):
+    '''Overlay region touched by a grid column at x'''
+    pad = overlay_pad(self)
+    return (x - pad, None, x + pad + 1, None)
+
+def row_extent(self, y):
+    '''Overlay region touched by a grid row at y'''
+    pad = overlay_pad(self)
+    return (None, y - pad, None, y + pad + 1)
+
+def bit_extent(self, x, y):
+    '''Overlay region touched by the bit at x, y'''
+    pad = overlay_pad(self)
+    return (x - pad, y - pad, x + pad + 1, y + pad + 1)
+
+def bit_at(self, x, y):
+    '''(column, row, center x, center y) of the bit drawn under image point x, y, or None'''
+    if self.grid_model is None or not self.grid_model.is_affine():
+        r = self.config.radius / 2
+        cols = [ci for ci, gx in enumerate(self.grid_points_x) if gx - r <= x <= gx + r]
+        rows = [ri for ri, gy in enumerate(self.grid_points_y) if gy - r <= y <= gy + r]
+        if not cols or not rows:
+            return None
+        return cols[0], rows[0], self.grid_points_x[cols[0]], self.grid_points_y[rows[0]]
+    # Rotated bits are drawn off their lines, take the nearest intersection
+    pad = overlay_pad(self)
+    cols = range(bisect.bisect_left(self.grid_points_x, x - pad),
+                 bisect.bisect_right(self.grid_points_x, x + pad))
+    rows = range(bisect.bisect_left(self.grid_points_y, y - pad),
+                 bisect.bisect_right(self.grid_points_y, y + pad))
+    if not cols or not rows:
+        return None
+    px, py = self.grid_model.points(cols, rows)
+    dist = (px - x) ** 2 + (py - y) ** 2
+    i, j = np.unravel_index(np.argmin(dist), dist.shape)
+    if dist[i, j] > self.config.radius ** 2:
+        return None
+    return cols[i], rows[j], int(math.floor(px[i, j] + 0.5)), int(math.floor(py[i, j] + 0.5))
 
 def get_pixel(self, x, y):
+    if self.img_source is not None:
+        # x is the row, y the column like img_target[x, y]
+        return int(preprocess_region(self.img_source, self.config, y, x, y + 1, x + 1).sum())
     return self.img_target[x, y][0] + self.img_target[x, y][1] + self.img_target[x, y][2]
 
 # create binary printable string
@@ -70,110 +317,428 @@ def update_radius(self):
         elif self.step_y:
             self.config.radius = int(self.step_y / 3)
 
+def img_array(img):
+    '''Return numpy view of a cv image, arrays are returned as is'''
+    if isinstance(img, np.ndarray):
+        return img
+    return np.asarray(cv.GetMat(img))
+
+@timed('process_image')
+def process_image(self):
+    '''
+    Bring img_target up to date with the preprocessing config
+
+    Results for the last few parameter sets are kept so only an actual
+    parameter change reprocesses the image and stepping back is free
+    '''
+    if self.img_original is None:
+        return
+    key = pipeline_key(self.config)
+    if key == self.img_target_key:
+        return
+    stage = self.pipeline_cache.pop(key, None)
+    if stage is None:
+        stage = Stage(preprocess(img_array(self.img_original), self.config))
+        if self.gui:
+            stage.image = cv.GetImage(cv.fromarray(stage.target))
+        else:
+            stage.image = stage.target
+    # Most recently used last
+    self.pipeline_cache[key] = stage
+    self.img_stage = stage
+    self.img_target = stage.image
+    self.img_target_key = key
+    self.img_integral = stage.integral
+    trim_pipeline_cache(self)
+
+def trim_pipeline_cache(self):
+    '''Drop least recently used stages beyond CACHE_BYTES, never the current one'''
+    total = sum(stage.nbytes() for stage in self.pipeline_cache.itervalues())
+    while total > CACHE_BYTES and len(self.pipeline_cache) > 1:
+        _key, stage = self.pipeline_cache.popitem(last=False)
+        total -= stage.nbytes()
+
+def get_integral(self):
+    '''Summed-area table of img_target, built once per preprocessing result'''
+    process_image(self)
+    if self.img_target is None:
+        raise Exception("No image loaded to sample")
+    if self.img_integral is None:
+        self.img_integral = integral_image(img_array(self.img_target))
+        if self.img_stage is not None:
+            self.img_stage.integral = self.img_integral
+            trim_pipeline_cache(self)
+    return self.img_integral
+
+def model_active(self):
+    '''Is the grid sampled through self.grid_model rather than grid_points_x / grid_points_y'''
+    return self.grid_model is not None and not self.grid_model.is_integer()
+
+@timed('sample')
+def get_sums(self, cols=None, rows=None):
+    '''Aperture sums for grid column indices cols / row indices rows (default all), indexed [column, row]'''
+    if model_active(self):
+        if self.img_source is not None:
+            raise Exception("Sub-pixel / rotated grids need the whole image, not a tile store")
+        px, py = self.grid_model.points(cols, rows)
+        return point_aperture_sums(get_integral(self), px, py, self.config.radius)
+    xs = self.grid_points_x
+    ys = self.grid_points_y
+    if cols is not None:
+        xs = [xs[ci] for ci in cols]
+    if rows is not None:
+        ys = [ys[ri] for ri in rows]
+    if self.img_source is not None:
+        return region_aperture_sums(self.img_source, self.config, xs, ys, self.config.radius)
+    return aperture_sums(get_integral(self), xs, ys, self.config.radius)
+
+def sample_bits(self, cols=None, rows=None):
+    '''Return boolean bit array indexed [column, row]'''
+    return classify(get_sums(self, cols, rows), self.config.radius, self.config.bit_thresh_div)
+
+def sums_key(self):
+    '''Everything bit_sums depends on, the grid by its version so checking costs O(1)'''
+    return (pipeline_key(self.config), self.config.radius, self.grid_version)
+
+def sums_valid(self):
+    return self.bit_sums is not None and self.bit_sums_key == sums_key(self)
+
+def get_bit_sums(self):
+    '''
+    Aperture sum of every bit, indexed [column, row]
+
+    Cached until the image pipeline, radius or grid changes so threshold
+    changes only need a new comparison
+    '''
+    if not sums_valid(self):
+        self.bit_sums = get_sums(self)
+        self.bit_sums_key = sums_key(self)
+    return self.bit_sums
+
+def get_margins(self):
+    '''Signed per bit distance from the threshold, fraction of maximum aperture value'''
+    return margins(get_bit_sums(self), self.config.radius, self.config.bit_thresh_div)
+
+def auto_threshold(self):
+    '''
+    Set bit_thresh_div from the per bit value histogram and reclassify
+
+    Returns (separation, marginal bits), see separation() and MARGIN_WARN
+    '''
+    sums = get_bit_sums(self)
+    thresh = otsu_threshold(sums)
+    maxval = aperture_maxval(self.config.radius)
+    if not maxval or thresh <= 0:
+        # A zero divisor would break classify()
+        raise Exception("Can't threshold with radius %d, threshold %s" % (self.config.radius, thresh))
+    # bits are set if sum > maxval / div
+    self.config.bit_thresh_div = maxval / thresh
+    read_data(self)
+    marginal = int((np.abs(get_margins(self)) < MARGIN_WARN).sum())
+    return separation(sums, thresh, self.config.radius), marginal
+
+@timed('read_data')
 def read_data(self, data_ref=None, force=False):
+    '''Resample every bit, use after any global parameter change'''
     if not force and not self.data_read:
         return
 
-    redraw_grid(self)
+    self.dirty_cols.clear()
+    self.dirty_rows.clear()
+    del self.dirty_rects[:]
+    # Every bit is resampled, earlier edits no longer apply
+    # Unless this is undo / redo of a move that re-sorted the grid, which cleared them already
+    if not self.journal.replaying:
+        self.journal.clear()
+    if self.gui:
+        sort_grid(self)
 
     # maximum possible value if all pixels are set
-    maxval = (self.config.radius * self.config.radius) * 255
+    maxval = aperture_maxval(self.config.radius)
     print 'read_data max aperture value:', maxval
 
-    if data_ref:
+    if data_ref is not None:
         print 'read_data: loading reference data (%d entries)' % len(data_ref)
-        print 'Grid intersections: %d' % len(self.grid_intersections)
+        print 'Grid intersections: %d' % (len(self.grid_points_x) * len(self.grid_points_y))
         self.data = data_ref
     else:
         print 'read_data: computing'
-        # Compute
-        self.data = []
-        for x, y in self.grid_intersections:
-            value = 0
-            # FIXME: misleading
-            # This isn't a radius but rather a bounding box
-            for xx in range(x - (self.config.radius / 2), x + (self.config.radius / 2)):
-                for yy in range(y - (self.config.radius / 2), y + (self.config.radius / 2)):
-                    value += get_pixel(self, yy, xx)
-            if value > maxval / self.config.bit_thresh_div:
-                self.data.append('1')
-            else:
-                self.data.append('0')
-
-    # Render
-    for i, (x, y) in enumerate(self.grid_intersections):
-        if self.data[i] == '1':
-            cv.Circle(
-                self.img_grid, (x, y), self.config.radius, cv.Scalar(0x00, 0xff, 0x00), thickness=2)
-            # highlight if we're in edit mode
-            if y == self.Edit_y:
-                sx = self.Edit_x - (self.Edit_x % self.group_cols)
-                if self.grid_points_x.index(x) >= sx and self.grid_points_x.index(
-                        x) < sx + self.group_cols:
-                    cv.Circle(
-                        self.img_grid, (x, y),
-                        self.config.radius,
-                        cv.Scalar(0xff, 0xff, 0xff),
-                        thickness=2)
-        else:
-            pass
+        self.data = BitMatrix.from_array(
+            classify(get_bit_sums(self), self.config.radius, self.config.bit_thresh_div))
+
     self.data_read = True
+    redraw_grid(self)
+
+def is_sorted(points):
+    return all(a <= b for a, b in zip(points, points[1:]))
+
+@timed('update_data')
+def update_data(self, keep_sums=False):
+    '''
+    Resample only dirty grid columns / rows and redraw only dirty overlay regions
+
+    Use after grid edits that don't change global parameters
+    keep_sums: bit_sums was valid before the edit, patch it rather than dropping it
+    '''
+    if not is_sorted(self.grid_points_x) or not is_sorted(self.grid_points_y):
+        # Edit moved a line past its neighbor, bit order needs rebuilding
+        sort_grid(self)
+        if self.data_read:
+            read_data(self)
+        else:
+            redraw_grid(self)
+        return
+
+    if self.data_read:
+        radius, div = self.config.radius, self.config.bit_thresh_div
+        for ci in sorted(self.dirty_cols):
+            sums = get_sums(self, cols=[ci])
+            self.data.set_col(ci, classify(sums, radius, div)[0])
+            if keep_sums:
+                self.bit_sums[ci, :] = sums[0]
+        for ri in sorted(self.dirty_rows):
+            sums = get_sums(self, rows=[ri])
+            self.data.set_row(ri, classify(sums, radius, div)[:, 0])
+            if keep_sums:
+                self.bit_sums[:, ri] = sums[:, 0]
+        if keep_sums:
+            self.bit_sums_key = sums_key(self)
+    self.dirty_cols.clear()
+    self.dirty_rows.clear()
+
+    for rect in self.dirty_rects:
+        redraw_region(self, *rect)
+    del self.dirty_rects[:]
+
+def move_col(self, ci, dx):
+    '''Shift grid column ci by dx pixels'''
+    keep_sums = sums_valid(self)
+    x = self.grid_points_x[ci]
+    self.grid_points_x[ci] = x + dx
+    if self.grid_model is not None:
+        self.grid_model.cols.move(ci, dx)
+    grid_changed(self)
+    self.dirty_cols.add(ci)
+    self.dirty_rects.append(col_extent(self, x))
+    self.dirty_rects.append(col_extent(self, x + dx))
+    update_data(self, keep_sums=keep_sums)
+    # By coordinate, update_data() may have re-sorted the line to another index
+    self.journal.record('move_col', (x, x + dx))
+
+def move_row(self, ri, dy):
+    '''Shift grid row ri by dy pixels'''
+    keep_sums = sums_valid(self)
+    y = self.grid_points_y[ri]
+    self.grid_points_y[ri] = y + dy
+    if self.grid_model is not None:
+        self.grid_model.rows.move(ri, dy)
+    grid_changed(self)
+    self.dirty_rows.add(ri)
+    self.dirty_rects.append(row_extent(self, y))
+    self.dirty_rects.append(row_extent(self, y + dy))
+    update_data(self, keep_sums=keep_sums)
+    self.journal.record('move_row', (y, y + dy))
+
+def delete_col(self, ci):
+    '''Remove grid column ci along with its bits'''
+    keep_sums = sums_valid(self)
+    x = self.grid_points_x.pop(ci)
+    bits = sums = line = None
+    if self.grid_model is not None:
+        line = self.grid_model.cols.delete(ci)
+    grid_changed(self)
+    if self.data_read:
+        bits = self.data.get_col(ci)
+        self.data.delete_col(ci)
+    if keep_sums:
+        sums = self.bit_sums[ci].copy()
+        self.bit_sums = np.delete(self.bit_sums, ci, axis=0)
+    self.dirty_rects.append(col_extent(self, x))
+    update_data(self, keep_sums=keep_sums)
+    self.journal.record('delete_col', (ci, x, bits, sums, line))
+
+def delete_row(self, ri):
+    '''Remove grid row ri along with its bits'''
+    keep_sums = sums_valid(self)
+    y = self.grid_points_y.pop(ri)
+    bits = sums = line = None
+    if self.grid_model is not None:
+        line = self.grid_model.rows.delete(ri)
+    grid_changed(self)
+    if self.data_read:
+        bits = self.data.get_row(ri)
+        self.data.delete_row(ri)
+    if keep_sums:
+        sums = self.bit_sums[:, ri].copy()
+        self.bit_sums = np.delete(self.bit_sums, ri, axis=1)
+    self.dirty_rects.append(row_extent(self, y))
+    update_data(self, keep_sums=keep_sums)
+    self.journal.record('delete_row', (ri, y, bits, sums, line))
+
+def insert_col(self, ci, x, bits=None, sums=None, line=None):
+    '''Add grid column at x (model line at line, default x) as index ci, with given bits / aperture sums or sampled'''
+    keep_sums = sums_valid(self) and (sums is not None or bits is None)
+    self.grid_points_x.insert(ci, x)
+    if self.grid_model is not None:
+        self.grid_model.cols.insert(ci, x if line is None else line)
+    grid_changed(self)
+    if self.data_read:
+        if bits is None:
+            bits = np.zeros(self.data.rows, dtype=bool)
+            self.dirty_cols.add(ci)
+        self.data.insert_col(ci, bits)
+    if keep_sums:
+        if sums is None:
+            sums = np.zeros(self.bit_sums.shape[1], dtype=self.bit_sums.dtype)
+        self.bit_sums = np.insert(self.bit_sums, ci, sums, axis=0)
+    self.dirty_rects.append(col_extent(self, x))
+    update_data(self, keep_sums=keep_sums)
+
+def insert_row(self, ri, y, bits=None, sums=None, line=None):
+    '''Add grid row at y (model line at line, default y) as index ri, with given bits / aperture sums or sampled'''
+    keep_sums = sums_valid(self) and (sums is not None or bits is None)
+    self.grid_points_y.insert(ri, y)
+    if self.grid_model is not None:
+        self.grid_model.rows.insert(ri, y if line is None else line)
+    grid_changed(self)
+    if self.data_read:
+        if bits is None:
+            bits = np.zeros(self.data.cols, dtype=bool)
+            self.dirty_rows.add(ri)
+        self.data.insert_row(ri, bits)
+    if keep_sums:
+        if sums is None:
+            sums = np.zeros(self.bit_sums.shape[0], dtype=self.bit_sums.dtype)
+        self.bit_sums = np.insert(self.bit_sums, ri, sums, axis=1)
+    self.dirty_rects.append(row_extent(self, y))
+    update_data(self, keep_sums=keep_sums)
+
+def toggle_bit(self, ci, ri):
+    '''Flip bit at grid column ci, row ri and redraw it'''
+    ret = self.data.toggle(ci, ri)
+    self.dirty_rects.append(bit_extent(self, self.grid_points_x[ci], self.grid_points_y[ri]))
+    update_data(self)
+    return ret
 
+def apply_edit(self, kind, args, undo):
+    '''Redo a journaled edit, or revert it if undo'''
+    if kind == 'toggle':
+        toggle_bit(self, *args)
+    elif kind == 'move_col':
+        x0, x1 = args[::-1] if undo else args
+        move_col(self, self.grid_points_x.index(x0), x1 - x0)
+    elif kind == 'move_row':
+        y0, y1 = args[::-1] if undo else args
+        move_row(self, self.grid_points_y.index(y0), y1 - y0)
+    elif kind == 'delete_col':
+        if undo:
+            insert_col(self, *args)
+        else:
+            delete_col(self, args[0])
+    elif kind == 'delete_row':
+        if undo:
+            insert_row(self, *args)
+        else:
+            delete_row(self, args[0])
+    else:
+        raise Exception("Unknown edit %s" % kind)
+
+def undo_edit(self):
+    '''Revert the last edit, return its kind or None if there is nothing to undo'''
+    op = self.journal.pop_undo()
+    if op is None:
+        return None
+    self.journal.replaying = True
+    try:
+        apply_edit(self, op[0], op[1], True)
+    finally:
+        self.journal.replaying = False
+    return op[0]
+
+def redo_edit(self):
+    '''Reapply the last undone edit, return its kind or None if there is nothing to redo'''
+    op = self.journal.pop_redo()
+    if op is None:
+        return None
+    self.journal.replaying = True
+    try:
+        apply_edit(self, op[0], op[1], False)
+    finally:
+        self.journal.replaying = False
+    return op[0]
+
+def redraw_row(self, y):
+    '''Redraw overlay for grid row at y, ie after edit highlight changes'''
+    self.dirty_rects.append(row_extent(self, y))
+    update_data(self)
+
+
+def get_all_bytes(self):
+    '''
+    Return data as a numpy uint8 array packed per the configured layout
+
+    The array is cached until the bits or packing settings change, don't modify it
+    '''
+    key = (self.data, self.data.version, self.config.layout, self.group_cols,
+           self.config.LSB_Mode, self.inverted)
+    if self.bytes_cache is None or self.bytes_cache[0] != key:
+        layout = get_layout(self.config.layout)
+        dat = layout.pack(self.data.to_array(), self.group_cols,
+                          lsb=self.config.LSB_Mode, invert=self.inverted)
+        self.bytes_cache = (key, dat)
+    return self.bytes_cache[1]
 
 def get_all_data(self):
     '''Return data as bytes'''
-    out = ''
-    for column in range(len(self.grid_points_x) / self.group_cols):
-        for row in range(len(self.grid_points_y)):
-            thischunk = ''
-            for x in range(self.group_cols):
-                thisbit = self.data[x * len(self.grid_points_y) + row +
-                               column * self.group_cols * len(self.grid_points_y)]
-                if self.inverted:
-                    if thisbit == '0':
-                        thisbit = '1'
-                    else:
-                        thisbit = '0'
-                thischunk += thisbit
-            for x in range(self.group_cols / 8):
-                thisbyte = thischunk[x * 8:x * 8 + 8]
-                # reverse self.group_cols if we want LSB
-                if self.config.LSB_Mode:
-                    thisbyte = thisbyte[::-1]
-                out += chr(int(thisbyte, 2))
-    return out
+    return get_all_bytes(self).tostring()
+
+def search_data(self, dat=None):
+    '''Bring self.search up to date with the current bytes, return it'''
+    if self.search is None or not self.data_read:
+        return None
+    if dat is None:
+        dat = get_all_bytes(self)
+    if self.search.stale(dat):
+        self.search.run(dat)
+    return self.search
+
+def data_cells(self):
+    '''(column, row) grid indices where each byte of get_all_data() starts'''
+    layout = get_layout(self.config.layout)
+    return layout.cells(len(self.grid_points_x), len(self.grid_points_y), self.group_cols)
 
 def data_as_xy(self):
     '''Return data as binary chars in ret[(x, y)] map'''
     ret = {}
-    for d, (x, y) in zip(self.data, self.grid_intersections):
+    for (x, y), d in zip(get_intersections(self), self.data.to_chars()):
         ret[(x, y)] = d
     return ret
 
 def data_as_cr(self):
     '''Return data as binary chars in ret[(column, row)] map'''
     ret = {}
-    xys = data_as_xy(self)
-    for xi, x in enumerate(self.grid_points_x):
-        for yi, y in enumerate(self.grid_points_y):
-            ret[(xi, yi)] = xys[(x, y)]
+    bits = self.data.to_array()
+    for xi in xrange(bits.shape[0]):
+        for yi in xrange(bits.shape[1]):
+            ret[(xi, yi)] = '1' if bits[xi, yi] else '0'
     return ret
 
 # call with exact values for intersection
 def get_data(self, x, y):
-    return self.data[self.grid_intersections.index((x, y))]
+    ci = grid_index(self.grid_points_x, x)
+    ri = grid_index(self.grid_points_y, y)
+    return str(self.data.get(ci, ri))
 
 def set_data(self, x, y, val):
-    i = self.grid_intersections.index((x, y))
-    self.data[i] = val
+    ci = grid_index(self.grid_points_x, x)
+    ri = grid_index(self.grid_points_y, y)
+    self.data.set(ci, ri, val == '1')
 
 def toggle_data(self, x, y):
-    i = self.grid_intersections.index((x, y))
-    if self.data[i] == '0':
-        self.data[i] = '1'
-    else:
-        self.data[i] = '0'
-    return self.data[i]
+    ci = grid_index(self.grid_points_x, x)
+    ri = grid_index(self.grid_points_y, y)
+    self.journal.record('toggle', (ci, ri))
+    return str(self.data.toggle(ci, ri))
 
 def symlinka(target, alias):
     '''Atomic symlink'''
@@ -184,8 +749,17 @@ def symlinka(target, alias):
     os.rename(tmp, alias)
 
 def save_grid(self, fn=None):
+    '''Save as binary version 2 if fn (or save_format) says so, otherwise version 1 JSON'''
+    if self.basename:
+        if not fn:
+            fn = self.basename + '_s%d' % self.saven + save_extension(self)
+        symlinka(fn, self.basename + os.path.splitext(fn)[1])
+    if fn.endswith(PROJECT_EXTENSION):
+        write_project(self, fn)
+        return
+
     config = dict(self.config.__dict__)
-    config['view'] = config['view'].__dict__
+    config['view'] = config['view'].as_dict()
 
     # XXX: this first cut is partly due to ease of converting old DB
     # Try to move everything non-volatile into config object
@@ -193,8 +767,8 @@ def save_grid(self, fn=None):
         # Increment major when a fundamentally breaking change occurs
         # minor reserved for now, but could be used for non-breaking
         'version': (1, 0),
-        'grid_intersections': self.grid_intersections,
-        'data': self.data,
+        'grid_intersections': get_intersections(self),
+        'data': self.data.to_chars() if self.data_read else [],
         'grid_points_x': self.grid_points_x,
         'grid_points_y': self.grid_points_y,
         'fn': config,
@@ -203,20 +777,34 @@ def save_grid(self, fn=None):
         'config': config,
         'img_fn': self.img_fn,
         }
+    if self.grid_model is not None:
+        j['grid_model'] = self.grid_model.as_dict()
 
-    if self.basename:
-        if not fn:
-            fn = self.basename + '_s%d.json' % self.saven
-        symlinka(fn, self.basename + '.json')
     gridout = open(fn, 'wb')
     json.dump(j, gridout, indent=4, sort_keys=True)
     print 'Saved %s' % fn
 
-def load_grid(self, grid_json=None, gui=True):
+def save_extension(self):
+    if self.save_format == 'rompar':
+        return PROJECT_EXTENSION
+    return '.json'
+
+def read_grid_file(fn):
+    '''Read a saved grid, JSON version 1, binary version 2 or latest of a history, for load_grid()'''
+    if is_history(fn):
+        return History(fn).grid_json()
+    if is_project(fn):
+        return read_project(fn)
+    with open(fn, 'rb') as gridfile:
+        return json.load(gridfile)
+
+def load_grid(self, grid_json=None, gui=True, data=True):
+    '''Load grid, config and (if data is set) bits from read_grid_file() output'''
     self.gui = gui
 
-    self.grid_intersections = grid_json['grid_intersections']
-    data = grid_json['data']
+    # Version 2 has no per intersection lists
+    grid_intersections = grid_json.get('grid_intersections', [])
+    bits = grid_json.get('bits')
     self.grid_points_x = grid_json['grid_points_x']
     self.grid_points_y = grid_json['grid_points_y']
     # self.config = grid_json['config']
@@ -228,28 +816,26 @@ def load_grid(self, grid_json=None, gui=True):
             self.config.__dict__[k] = v
 
     # Possible only one direction is drawn
-    if self.grid_intersections:
+    if grid_intersections:
         # Some past DBs had corrupt sets with duplicates
         # Maybe better to just trust them though
-        self.grid_points_x = []
-        self.grid_points_y = []
-        for x, y in self.grid_intersections:
-            try:
-                self.grid_points_x.index(x)
-            except:
-                self.grid_points_x.append(x)
-    
-            try:
-                self.grid_points_y.index(y)
-            except:
-                self.grid_points_y.append(y)
+        self.grid_points_x = sorted(set(x for x, _y in grid_intersections))
+        self.grid_points_y = sorted(set(y for _x, y in grid_intersections))
+
+    self.grid_model = None
+    if grid_json.get('grid_model'):
+        self.grid_model = Grid.from_dict(grid_json['grid_model'])
+        if self.grid_model.shape != (len(self.grid_points_x), len(self.grid_points_y)):
+            raise Exception("Grid model is %dx%d, grid points %dx%d" % (
+                    self.grid_model.shape + (len(self.grid_points_x), len(self.grid_points_y))))
+    grid_changed(self)
 
     print 'Grid points: %d x, %d y' % (len(self.grid_points_x), len(self.grid_points_y))
     squared = len(self.grid_points_x) * len(self.grid_points_y)
-    if len(self.grid_intersections) != squared:
+    if 'bits' not in grid_json and len(grid_intersections) != squared:
         print self.grid_points_x
         print self.grid_points_y
-        raise Exception("%d != %d" % (len(self.grid_intersections), squared))
+        raise Exception("%d != %d" % (len(grid_intersections), squared))
 
     self.step_x = 0.0
     if len(self.grid_points_x) > 1:
@@ -264,46 +850,56 @@ def load_grid(self, grid_json=None, gui=True):
             self.config.radius = self.step_y / 3
     redraw_grid(self)
 
-    if data:
+    if not data:
+        return
+    chars = grid_json.get('data')
+    if chars:
+        if len(chars) != len(grid_intersections):
+            raise Exception("%d != %d" % (len(chars), len(grid_intersections)))
+        # Bits are stored in intersection order
+        cols = dict((x, i) for i, x in enumerate(self.grid_points_x))
+        rows = dict((y, i) for i, y in enumerate(self.grid_points_y))
+        arr = np.zeros((len(cols), len(rows)), dtype=bool)
+        for (x, y), d in zip(grid_intersections, chars):
+            arr[cols[x], rows[y]] = d == '1'
+        bits = BitMatrix.from_array(arr)
+    if bits is not None:
         print 'Initializing data'
-        if len(data) != len(self.grid_intersections):
-            raise Exception("%d != %d" % (len(data), len(self.grid_intersections)))    
-        read_data(self, data_ref=data, force=True)
+        if bits.shape != (len(self.grid_points_x), len(self.grid_points_y)):
+            raise Exception("%s != %d x %d" % (bits.shape, len(self.grid_points_x), len(self.grid_points_y)))
+        read_data(self, data_ref=bits, force=True)
 
 # self.data packed into column based bytes
-def save_dat(self):
-    out = get_all_data(self)
+def save_dat(self, fn=None):
+    '''Write one file per column group or everything to fn if given'''
+    size = layout_bytes(self)
+    if fn:
+        with open(fn, 'wb') as outfile:
+            write_dat(self, outfile)
+        print '%s: %d bytes' % (fn, size)
+        return
     columns = len(self.grid_points_x) / self.group_cols
-    chunk = len(out) / columns
+    chunk = size / columns
     for x in range(columns):
         fn = self.basename + '_s%d-%d.dat' % (self.saven, x)
         symlinka(fn, self.basename + '_%d.dat' % x)
         with open(fn, 'wb') as outfile:
-            outfile.write(out[x * chunk:x * chunk + chunk])
+            write_dat(self, outfile, x * chunk, x * chunk + chunk)
             print '%s: %d bytes' % (fn, chunk)
 
-def save_txt(self):
+def save_txt(self, fn=None):
     '''Write text file like bits sown in GUI. Space between row/cols'''
-    fn = self.basename + '_s%d.txt' % self.saven
-    symlinka(fn, self.basename + '.txt')
-    crs = data_as_cr(self)
+    if not fn:
+        fn = self.basename + '_s%d.txt' % self.saven
+        symlinka(fn, self.basename + '.txt')
     with open(fn, 'w') as f:
-        for row in xrange(len(self.grid_points_y)):
-            # Put a space between row gaps
-            if row and row % self.group_rows == 0:
-                f.write('\n')
-            for col in xrange(len(self.grid_points_x)):
-                if col and col % self.group_cols == 0:
-                    f.write(' ')
-                f.write(crs[(col, row)])
-            # Newline afer every row
-            f.write('\n')
+        write_txt(self, f)
     print 'Saved %s' % fn
 
 def next_save(self):
     '''Look for next unused save slot by checking grid files'''
     while True:
-        fn = self.basename + '_s%d.grid' % self.saven
-        if not os.path.exists(fn):
+        prefix = self.basename + '_s%d' % self.saven
+        if not any(os.path.exists(prefix + ext) for ext in ('.json', PROJECT_EXTENSION, '.grid')):
             break
         self.saven += 1
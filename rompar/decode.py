@@ -0,0 +1,152 @@
+'''
+Headless decoding: image + saved grid => ROM bits
+
+No window is opened and nothing queries the screen so this can run on
+machines without a display.  Results are produced one image at a time so
+long job lists can be streamed through decode_iter()
+'''
+
+import os
+import time
+
+import numpy as np
+
+from config import Rompar
+from data import *
+from pipeline import *
+from tiled import TiledImage, is_tiled
+from export import EXPORTS, export
+
+# Output file extensions written by default
+# Not json: next to the image that is usually the grid being decoded with
+FORMATS = ('dat', 'txt')
+
+def load_project(grid_fn, img_fn=None):
+    '''Create a headless Rompar from a saved grid file'''
+    self = Rompar(gui=False)
+    grid_json = read_grid_file(grid_fn)
+    self.img_fn = img_fn or grid_json.get('img_fn')
+    if self.img_fn is None:
+        raise Exception("Image required")
+    self.group_cols = grid_json.get('group_cols')
+    self.group_rows = grid_json.get('group_rows')
+    # Bits are recomputed from the image
+    load_grid(self, grid_json, gui=False, data=False)
+    return self
+
+def out_fn(out_base, fmt):
+    if fmt == 'sums':
+        return out_base + '.sums.npy'
+    if fmt in EXPORTS:
+        return out_base + EXPORTS[fmt][0]
+    return out_base + '.' + fmt
+
+def check_outputs(fns, inputs):
+    '''Refuse to write any of fns over one of the inputs, links followed'''
+    inputs = dict((os.path.realpath(fn), fn) for fn in inputs if fn)
+    for fn in fns:
+        src = inputs.get(os.path.realpath(fn))
+        if src is not None:
+            raise Exception("Output %s would overwrite input %s" % (fn, src))
+
+def write_outputs(self, out_base, formats=FORMATS, inputs=()):
+    '''
+    Write out_base.<ext> for each requested format, return filenames
+
+    Nothing is written if an output would replace one of the input files
+    '''
+    check_outputs([out_fn(out_base, fmt) for fmt in formats], inputs)
+    ret = []
+    for fmt in formats:
+        fn = out_fn(out_base, fmt)
+        if fmt == 'dat':
+            save_dat(self, fn=fn)
+        elif fmt == 'txt':
+            save_txt(self, fn=fn)
+        elif fmt in ('json', 'rompar'):
+            save_grid(self, fn=fn)
+        elif fmt == 'sums':
+            # Per bit aperture sums, [column, row]
+            np.save(fn, get_bit_sums(self))
+        elif fmt in EXPORTS:
+            export(self, fmt, fn)
+        else:
+            raise Exception("Unknown output format %s" % fmt)
+        ret.append(fn)
+    return ret
+
+def decode(img_fn, grid_fn, out_base=None, formats=FORMATS, auto_thresh=False):
+    '''
+    Decode img_fn using the grid and config saved in grid_fn
+
+    Writes outputs if out_base is given
+    auto_thresh replaces the saved bit_thresh_div with auto_threshold()
+    Returns the populated Rompar object
+    '''
+    self = load_project(grid_fn, img_fn=img_fn)
+    if is_tiled(self.img_fn):
+        # Preprocessed and sampled a tile at a time
+        self.img_source = TiledImage(self.img_fn)
+    else:
+        self.img_original = load_image(self.img_fn)
+    read_data(self, force=True)
+    if auto_thresh:
+        auto_threshold(self)
+    if out_base:
+        write_outputs(self, out_base, formats, inputs=(img_fn, grid_fn))
+    return self
+
+def default_out_base(img_fn, out_dir=None):
+    '''Output basename for an image: its name sans extension, optionally in out_dir'''
+    base = os.path.splitext(img_fn)[0]
+    if out_dir:
+        base = os.path.join(out_dir, os.path.basename(base))
+    return base
+
+def decode_job(img_fn, grid_fn, out_dir=None, formats=FORMATS, auto_thresh=False):
+    '''
+    Decode one image, returning a JSON-able summary dict
+
+    Failures are reported in the summary rather than raised
+    '''
+    out_base = default_out_base(img_fn, out_dir)
+    tstart = time.time()
+    result = {
+        'image': img_fn,
+        'grid': grid_fn,
+        }
+    try:
+        self = decode(img_fn, grid_fn, out_base=out_base, formats=formats, auto_thresh=auto_thresh)
+        outputs = [out_fn(out_base, fmt) for fmt in formats]
+    except Exception as e:
+        result['error'] = str(e)
+    else:
+        result['bits'] = len(self.data)
+        result['ones'] = self.data.count()
+        result['outputs'] = outputs
+        result['marginal'] = int((np.abs(get_margins(self)) < MARGIN_WARN).sum())
+        if auto_thresh:
+            result['bit_thresh_div'] = self.config.bit_thresh_div
+            result['separation'] = separation(get_bit_sums(self),
+                    bit_thresh(self.config.radius, self.config.bit_thresh_div), self.config.radius)
+        del self
+    result['seconds'] = time.time() - tstart
+    return result
+
+def decode_iter(jobs, out_dir=None, formats=FORMATS, auto_thresh=False):
+    '''
+    Decode (img_fn, grid_fn) jobs one at a time, yielding a summary dict per job
+
+    Only one image is held in memory at a time
+    '''
+    for img_fn, grid_fn in jobs:
+        yield decode_job(img_fn, grid_fn, out_dir=out_dir, formats=formats, auto_thresh=auto_thresh)
+
+def read_jobs(f):
+    '''Parse "image grid" lines, blank lines and # comments are ignored'''
+    for line in f:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        img_fn, grid_fn = line.split()
+        yield img_fn, grid_fn
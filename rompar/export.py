@@ -0,0 +1,132 @@
+'''
+Streaming bit exporters
+
+Every format is written a chunk at a time straight from the packed
+BitMatrix so memory beyond the bits themselves is bounded by the chunk size,
+however large the ROM.  Layout ordered bytes are gathered LAYOUT_CHUNK at a
+time, each output bit needs a few intp temporaries while it is located.
+
+    txt       bits as shown in the GUI, space / blank line between groups
+    dat       ROM bytes per the configured layout, LSB and invert settings
+    hex       the same bytes as Intel HEX
+    bitplane  raw 1 bit image: row by row, columns packed 8 per byte MSB first
+    npy       NumPy bool array indexed [column, row]
+
+txt, bitplane and npy are in grid order, ignoring layout / LSB / invert.
+'''
+
+import struct
+import binascii
+
+import numpy as np
+
+from layout import get_layout
+
+# Output bytes produced per step by the grid order writers
+CHUNK = 1 << 20
+# Packed ROM bytes gathered per step, the Intel HEX segment size
+LAYOUT_CHUNK = 1 << 16
+# Data bytes per Intel HEX record
+HEX_RECORD = 16
+
+def band_rows(row_bytes):
+    '''Rows per step for rows of row_bytes output bytes, multiple of 8 for get_rows()'''
+    return max(8, CHUNK // max(1, row_bytes) // 8 * 8)
+
+def write_txt(self, f):
+    ncols, nrows = self.data.shape
+    group_cols = self.group_cols or max(1, ncols)
+    # Output offset of each column, plus a leading blank line slot
+    pos = 1 + np.arange(ncols) + np.arange(ncols) // group_cols
+    width = 1 + ncols + max(0, ncols - 1) // group_cols + 1
+    band = band_rows(width)
+    for row0 in xrange(0, nrows, band):
+        row1 = min(nrows, row0 + band)
+        rows = np.arange(row0, row1)
+        lines = np.full((row1 - row0, width), ord(' '), dtype=np.uint8)
+        lines[:, 0] = ord('\n')
+        lines[:, -1] = ord('\n')
+        lines[:, pos] = ord('0') + self.data.get_rows(row0, row1).T
+        # Blank line before every row group but the first
+        keep = np.ones(lines.shape, dtype=bool)
+        keep[:, 0] = (rows > 0) & (rows % self.group_rows == 0)
+        f.write(lines[keep].tostring())
+
+def layout_bytes(self):
+    '''Size of the packed ROM, see get_all_bytes()'''
+    ncols, nrows = self.data.shape
+    return get_layout(self.config.layout).size(ncols, nrows, self.group_cols)
+
+def layout_chunks(self, start=0, end=None):
+    '''Packed ROM bytes [start, end) as uint8 arrays of at most LAYOUT_CHUNK bytes'''
+    ncols, nrows = self.data.shape
+    layout = get_layout(self.config.layout)
+    packed = self.data.packed
+    if end is None:
+        end = layout.size(ncols, nrows, self.group_cols)
+    for pos in xrange(start, end, LAYOUT_CHUNK):
+        perm = layout.perm_range(ncols, nrows, self.group_cols, self.config.LSB_Mode,
+                                 pos * 8, min(end, pos + LAYOUT_CHUNK) * 8)
+        # Gather each output bit out of the packed columns
+        col, row = np.divmod(perm, nrows)
+        out = np.packbits((packed[col, row >> 3] >> (7 - (row & 7))) & 1)
+        if self.inverted:
+            out ^= 0xff
+        yield out
+
+def write_dat(self, f, start=0, end=None):
+    for chunk in layout_chunks(self, start, end):
+        f.write(chunk.tostring())
+
+def hex_record(addr, rtype, data):
+    body = struct.pack('>BHB', len(data), addr, rtype) + data
+    checksum = -sum(bytearray(body)) & 0xff
+    return ':%s%02X\n' % (binascii.hexlify(body).upper(), checksum)
+
+def write_hex(self, f):
+    addr = 0
+    for chunk in layout_chunks(self):
+        data = chunk.tostring()
+        lines = []
+        for i in xrange(0, len(data), HEX_RECORD):
+            if not (addr + i) & 0xffff and addr + i:
+                # Extended linear address for the next 64 KiB
+                lines.append(hex_record(0, 4, struct.pack('>H', (addr + i) >> 16)))
+            lines.append(hex_record((addr + i) & 0xffff, 0, data[i:i + HEX_RECORD]))
+        f.write(''.join(lines))
+        addr += len(data)
+    f.write(hex_record(0, 1, ''))
+
+def write_bitplane(self, f):
+    ncols, nrows = self.data.shape
+    band = band_rows((ncols + 7) // 8)
+    for row0 in xrange(0, nrows, band):
+        row1 = min(nrows, row0 + band)
+        f.write(np.packbits(self.data.get_rows(row0, row1).T, axis=1).tostring())
+
+def write_npy(self, f):
+    ncols, nrows = self.data.shape
+    np.lib.format.write_array_header_1_0(
+        f, {'descr': np.dtype(bool).str, 'fortran_order': False, 'shape': (ncols, nrows)})
+    band = max(1, CHUNK // max(1, nrows))
+    for col0 in xrange(0, ncols, band):
+        packed = self.data.packed[col0:col0 + band]
+        f.write(np.unpackbits(packed, axis=1)[:, :nrows].astype(bool).tostring())
+
+# format: (file extension, writer)
+EXPORTS = {
+    'txt': ('.txt', write_txt),
+    'dat': ('.dat', write_dat),
+    'hex': ('.hex', write_hex),
+    'bitplane': ('.bitplane', write_bitplane),
+    'npy': ('.bits.npy', write_npy),
+    }
+
+def export(self, fmt, fn):
+    '''Write the bits of Rompar self to fn in export format fmt'''
+    try:
+        _ext, writer = EXPORTS[fmt]
+    except KeyError:
+        raise Exception("Unknown export format %s, have: %s" % (fmt, ', '.join(sorted(EXPORTS))))
+    with open(fn, 'wb') as f:
+        writer(self, f)
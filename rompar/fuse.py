@@ -0,0 +1,129 @@
+'''
+Multi-capture fusion
+
+Several registered captures of the same ROM (focus, exposure, delayering
+passes) are decoded with one shared grid and every bit gets a vote per
+image: 0, 1 or '?' if the image read it within MARGIN_WARN of its
+threshold.  The consensus is the majority of the sure votes, ties going to
+the side of the summed margins.  Bits the images disagree on are disputed.
+
+Images are sampled in a process pool.  Each worker holds one image at a time
+and only hands back packed bits and per bit margins, which are folded into
+the vote counts as they arrive, so memory does not grow with the number of
+images.
+'''
+
+import multiprocessing
+
+import numpy as np
+
+from bitmatrix import BitMatrix
+from batch import init_worker
+from decode import decode, load_project
+from data import get_margins
+from sample import MARGIN_WARN
+
+def sample_image(args):
+    '''Decode one capture, return its packed bits and margins or its error'''
+    img_fn, grid_fn, auto_thresh = args
+    result = {'image': img_fn}
+    try:
+        self = decode(img_fn, grid_fn, auto_thresh=auto_thresh)
+        result['bits'] = self.data.packed
+        result['rows'] = self.data.rows
+        result['margins'] = get_margins(self).astype(np.float32)
+        result['bit_thresh_div'] = self.config.bit_thresh_div
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+class Votes(object):
+    '''Per bit vote counts, indexed [column, row]'''
+    def __init__(self, cols, rows):
+        self.zeros = np.zeros((cols, rows), dtype=np.uint16)
+        self.ones = np.zeros((cols, rows), dtype=np.uint16)
+        self.unsure = np.zeros((cols, rows), dtype=np.uint16)
+        self.margin_sum = np.zeros((cols, rows), dtype=np.float32)
+        self.images = 0
+
+    @property
+    def shape(self):
+        return self.ones.shape
+
+    def add(self, bits, margins):
+        '''Count one image's boolean bits and signed margins'''
+        if bits.shape != self.shape:
+            raise Exception("Image has %dx%d bits, expected %dx%d" % (bits.shape + self.shape))
+        unsure = np.abs(margins) < MARGIN_WARN
+        self.ones += bits & ~unsure
+        self.zeros += ~bits & ~unsure
+        self.unsure += unsure
+        self.margin_sum += margins
+        self.images += 1
+
+    def consensus(self):
+        '''BitMatrix of the majority vote'''
+        bits = self.ones > self.zeros
+        tie = self.ones == self.zeros
+        bits[tie] = self.margin_sum[tie] > 0
+        return BitMatrix.from_array(bits)
+
+    def disputed(self):
+        '''(columns, rows) of bits read both ways, which includes any tie with votes cast'''
+        return np.nonzero((self.ones > 0) & (self.zeros > 0))
+
+    def undecided(self):
+        '''(columns, rows) of bits every image was unsure of, consensus is from the margins alone'''
+        return np.nonzero((self.ones == 0) & (self.zeros == 0) & (self.unsure > 0))
+
+    def dist(self, ci, ri):
+        '''imgbits style answer frequency, ie {'0': 3, '1': 1, '?': 1}'''
+        ret = {}
+        for k, counts in (('0', self.zeros), ('1', self.ones), ('?', self.unsure)):
+            if counts[ci, ri]:
+                ret[k] = int(counts[ci, ri])
+        return ret
+
+    def stack(self):
+        '''uint16 (3, columns, rows) of zeros, ones, unsure votes, the .votes.npy format'''
+        return np.array([self.zeros, self.ones, self.unsure])
+
+def fuse(img_fns, grid_fn, processes=None, auto_thresh=False, layout_file=None, quiet=True, callback=None):
+    '''
+    Decode img_fns with grid_fn and vote on every bit
+
+    callback(result) is called as each image finishes, see sample_image()
+    Returns (Rompar holding the consensus bits, Votes, failed results)
+    '''
+    self = load_project(grid_fn, img_fn=img_fns[0])
+    votes = Votes(len(self.grid_points_x), len(self.grid_points_y))
+    failures = []
+    processes = min(processes or multiprocessing.cpu_count(), len(img_fns))
+    pool = multiprocessing.Pool(processes, init_worker, (layout_file, quiet))
+    try:
+        results = pool.imap_unordered(sample_image, [(img_fn, grid_fn, auto_thresh) for img_fn in img_fns])
+        for _i in xrange(len(img_fns)):
+            # Timeout so ^C is delivered while waiting
+            result = results.next(timeout=1 << 31)
+            if 'error' not in result:
+                try:
+                    votes.add(BitMatrix.from_packed(result['bits'], result['rows']).to_array(),
+                              result['margins'])
+                except Exception as e:
+                    result['error'] = str(e)
+            if 'error' in result:
+                failures.append(result)
+            if callback:
+                callback(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if not votes.images:
+        raise Exception("No image decoded")
+
+    self.data = votes.consensus()
+    self.data_read = True
+    return self, votes, failures
@@ -0,0 +1,184 @@
+'''
+Parametric grid model
+
+Rather than integer line positions a grid can be described per axis by the
+origin of each group of lines and one float pitch:
+
+    line[g * group + i] = origins[g] + pitch * i
+
+plus an affine term (rotation / skew) applied about a pivot:
+
+    point(column, row) = pivot + matrix . ((cols[column], rows[row]) - pivot)
+
+Intersections are computed on demand as coordinate arrays, nothing is stored
+per bit.  Sub-pixel and rotated points are sampled with bilinear
+interpolation (see point_aperture_sums()).  An axis aligned grid on whole
+pixels is exactly the classic grid_points_x / grid_points_y grid and is
+sampled the classic way.
+
+Editing a line (move / insert / delete) turns that axis into explicit lines,
+one per group.
+'''
+
+import math
+
+import numpy as np
+
+IDENTITY = ((1.0, 0.0), (0.0, 1.0))
+
+class Axis(object):
+    def __init__(self, origins, pitch=0.0, group=1):
+        self.origins = np.array(origins, dtype=np.float64).ravel()
+        self.pitch = float(pitch)
+        self.group = int(group)
+
+    @classmethod
+    def from_lines(cls, lines):
+        return cls(lines)
+
+    def __len__(self):
+        return len(self.origins) * self.group
+
+    def lines(self):
+        '''Float position of every line'''
+        return (self.origins[:, None] + self.pitch * np.arange(self.group)).ravel()
+
+    def rounded(self):
+        '''Whole pixel lines, as grid_points_x / grid_points_y'''
+        return [int(v) for v in np.floor(self.lines() + 0.5)]
+
+    def explicit(self):
+        '''Switch to one origin per line so single lines can be edited'''
+        if self.group != 1:
+            self.origins = self.lines()
+            self.pitch = 0.0
+            self.group = 1
+
+    def move(self, i, d):
+        self.explicit()
+        self.origins[i] += d
+
+    def delete(self, i):
+        self.explicit()
+        ret = self.origins[i]
+        self.origins = np.delete(self.origins, i)
+        return ret
+
+    def insert(self, i, v):
+        self.explicit()
+        self.origins = np.insert(self.origins, i, v)
+
+    def sort(self):
+        '''Put the lines in order, return whether any moved'''
+        lines = self.lines()
+        if not (np.diff(lines) < 0).any():
+            return False
+        self.origins = np.sort(lines)
+        self.pitch = 0.0
+        self.group = 1
+        return True
+
+    def as_dict(self):
+        return {'origins': self.origins.tolist(), 'pitch': self.pitch, 'group': self.group}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['origins'], d.get('pitch', 0.0), d.get('group', 1))
+
+def fit_axis(lines, group):
+    '''
+    Least squares Axis of per group origins and one common pitch through lines
+
+    Lines that don't divide into whole groups of at least 2 are kept explicit
+    '''
+    lines = np.asarray(lines, dtype=np.float64)
+    if not group or group < 2 or not len(lines) or len(lines) % group:
+        return Axis.from_lines(lines)
+    per_group = lines.reshape(-1, group)
+    i = np.arange(group, dtype=np.float64) - (group - 1) / 2.0
+    # Pooled slope of line position vs index within group
+    pitch = (per_group * i).sum() / (len(per_group) * (i * i).sum())
+    origins = per_group.mean(axis=1) - pitch * (group - 1) / 2.0
+    return Axis(origins, pitch, group)
+
+class Grid(object):
+    def __init__(self, cols, rows, matrix=IDENTITY, pivot=None):
+        self.cols = cols
+        self.rows = rows
+        self.matrix = np.array(matrix, dtype=np.float64)
+        if pivot is None:
+            pivot = self.center()
+        self.pivot = np.array(pivot, dtype=np.float64)
+
+    @classmethod
+    def from_points(cls, grid_points_x, grid_points_y):
+        '''The classic integer grid'''
+        return cls(Axis.from_lines(grid_points_x), Axis.from_lines(grid_points_y))
+
+    @property
+    def shape(self):
+        return (len(self.cols), len(self.rows))
+
+    def center(self):
+        xs = self.cols.lines()
+        ys = self.rows.lines()
+        return ((xs.min() + xs.max()) / 2.0 if len(xs) else 0.0,
+                (ys.min() + ys.max()) / 2.0 if len(ys) else 0.0)
+
+    def is_affine(self):
+        return not np.array_equal(self.matrix, IDENTITY)
+
+    def is_integer(self):
+        '''Axis aligned on whole pixels, ie sampled exactly like grid_points_x / grid_points_y'''
+        if self.is_affine():
+            return False
+        return all(np.array_equal(axis.lines(), np.floor(axis.lines())) for axis in (self.cols, self.rows))
+
+    def set_rotation(self, angle):
+        '''Rotate by angle radians (clockwise on screen) about the pivot, dropping any skew'''
+        c, s = math.cos(angle), math.sin(angle)
+        self.matrix = np.array(((c, -s), (s, c)))
+
+    def rotation(self):
+        return math.atan2(self.matrix[1, 0], self.matrix[0, 0])
+
+    def points(self, cols=None, rows=None):
+        '''
+        Image (x, y) float arrays of the intersections of columns cols and rows rows
+
+        Default all, result arrays are indexed [column, row]
+        '''
+        xs = self.cols.lines()
+        ys = self.rows.lines()
+        if cols is not None:
+            xs = xs[np.asarray(cols, dtype=np.intp)]
+        if rows is not None:
+            ys = ys[np.asarray(rows, dtype=np.intp)]
+        dx = xs[:, None] - self.pivot[0]
+        dy = ys[None, :] - self.pivot[1]
+        (a, b), (c, d) = self.matrix
+        return self.pivot[0] + a * dx + b * dy, self.pivot[1] + c * dx + d * dy
+
+    def max_offset(self):
+        '''Furthest any intersection is moved by the affine term, in pixels'''
+        if not self.is_affine() or not len(self.cols) or not len(self.rows):
+            return 0.0
+        xs = self.cols.lines()
+        ys = self.rows.lines()
+        corners_x = np.array([xs.min(), xs.max()])
+        corners_y = np.array([ys.min(), ys.max()])
+        px, py = Grid(Axis(corners_x), Axis(corners_y), self.matrix, self.pivot).points()
+        return float(np.hypot(px - corners_x[:, None], py - corners_y[None, :]).max())
+
+    def as_dict(self):
+        return {
+            'cols': self.cols.as_dict(),
+            'rows': self.rows.as_dict(),
+            'matrix': self.matrix.tolist(),
+            'pivot': self.pivot.tolist(),
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(Axis.from_dict(d['cols']), Axis.from_dict(d['rows']),
+                   d.get('matrix', IDENTITY), d.get('pivot'))
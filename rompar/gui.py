@@ -19,8 +19,15 @@
 #    GNU General Public License for more details.
 
 import cv2.cv as cv
+import numpy as np
+import bisect
+import math
 
 from data import *
+from timing import timed
+from hexview import HexOverlay
+from pyramid import stage_pyramid
+from tiled import render_viewport
 #from cmd import *
 import sys
 
@@ -37,27 +44,25 @@ def on_mouse_left(img_x, img_y, flags, param):
     # Edit data
     if self.data_read:
         # find nearest intersection and toggle its value
-        for x in self.grid_points_x:
-            if img_x >= x - self.config.radius / 2 and img_x <= x + self.config.radius / 2:
-                for y in self.grid_points_y:
-                    if img_y >= y - self.config.radius / 2 and img_y <= y + self.config.radius / 2:
-                        value = toggle_data(self, x, y)
-                        #print self.img_target[x, y]
-                        #print 'value', value
-                        if value == '0':
-                            cv.Circle(
-                                self.img_grid, (x, y),
-                                self.config.radius,
-                                cv.Scalar(0xff, 0x00, 0x00),
-                                thickness=2)
-                        else:
-                            cv.Circle(
-                                self.img_grid, (x, y),
-                                self.config.radius,
-                                cv.Scalar(0x00, 0xff, 0x00),
-                                thickness=2)
+        hit = bit_at(self, img_x, img_y)
+        if hit is not None:
+            ci, ri, x, y = hit
+            value = toggle_data(self, self.grid_points_x[ci], self.grid_points_y[ri])
+            #print 'value', value
+            if value == '0':
+                cv.Circle(
+                    self.img_grid, overlay_xy(self, x, y),
+                    self.config.radius,
+                    cv.Scalar(0xff, 0x00, 0x00),
+                    thickness=2)
+            else:
+                cv.Circle(
+                    self.img_grid, overlay_xy(self, x, y),
+                    self.config.radius,
+                    cv.Scalar(0x00, 0xff, 0x00),
+                    thickness=2)
 
-                        show_image(self)
+            show_image(self)
     # Edit grid
     else:
         #if not Target[img_y, img_x]:
@@ -75,7 +80,7 @@ def on_mouse_left(img_x, img_y, flags, param):
 
             # don't try to auto-center if shift key pressed
             draw_line(self, img_x, img_y, 'V', False)
-            self.grid_points_x.append(img_x)
+            append_col(self, img_x)
             if self.group_rows == 1:
                 draw_line(self, img_x, img_y, 'V', True)
         else:
@@ -85,12 +90,12 @@ def on_mouse_left(img_x, img_y, flags, param):
                 self.step_x = float(img_x - self.grid_points_x[0]) / (self.group_cols - 1)
                 # reset stored self.data as main loop will add all entries
                 img_x = self.grid_points_x[0]
-                self.grid_points_x = []
+                clear_cols(self)
                 update_radius(self)
             # draw a full set of self.group_cols
             for x in range(self.group_cols):
                 draw_x = int(img_x + x * self.step_x)
-                self.grid_points_x.append(draw_x)
+                append_col(self, draw_x)
                 draw_line(self, draw_x, img_y, 'V', True)
 
 def on_mouse_right(img_x, img_y, flags, param):
@@ -99,6 +104,18 @@ def on_mouse_right(img_x, img_y, flags, param):
     # Edit data
     if self.data_read:
         # find row and select for editing
+        if self.grid_model is not None and self.grid_model.is_affine():
+            # Rotated rows aren't horizontal, select the row of the bit clicked
+            hit = bit_at(self, img_x, img_y)
+            if hit is not None:
+                self.Edit_x = hit[0]
+                edit_y = self.Edit_y
+                self.Edit_y = self.grid_points_y[hit[1]]
+                if edit_y >= 0 and edit_y != self.Edit_y:
+                    redraw_row(self, edit_y)
+                redraw_row(self, self.Edit_y)
+                show_image(self)
+            return
         for x in self.grid_points_x:
             for y in self.grid_points_y:
                 if img_y >= y - self.config.radius / 2 and img_y <= y + self.config.radius / 2:
@@ -112,9 +129,11 @@ def on_mouse_right(img_x, img_y, flags, param):
                         else:
                             xcount += 1
                     # highlight the bit group we're in
-                    sx = self.Edit_x - (self.Edit_x % self.group_cols)
+                    edit_y = self.Edit_y
                     self.Edit_y = y
-                    read_data(self)
+                    if edit_y >= 0 and edit_y != y:
+                        redraw_row(self, edit_y)
+                    redraw_row(self, y)
                     show_image(self)
                     return
     # Edit grid
@@ -131,7 +150,7 @@ def on_mouse_right(img_x, img_y, flags, param):
                 img_x, img_y = auto_center(self, img_x, img_y)
 
             draw_line(self, img_x, img_y, 'H', False)
-            self.grid_points_y.append(img_y)
+            append_row(self, img_y)
             if self.group_rows == 1:
                 draw_line(self, img_x, img_y, 'H', True)
         else:
@@ -141,15 +160,15 @@ def on_mouse_right(img_x, img_y, flags, param):
                 self.step_y = float(img_y - self.grid_points_y[0]) / (self.group_rows - 1)
                 # reset stored self.data as main loop will add all entries
                 img_y = self.grid_points_y[0]
-                self.grid_points_y = []
+                clear_rows(self)
                 update_radius(self)
             # draw a full set of self.group_rows
             for y in range(self.group_rows):
                 draw_y = int(img_y + y * self.step_y)
                 # only draw up to the edge of the image
-                if draw_y > self.img_original.height:
+                if draw_y > image_size(self)[1]:
                     break
-                self.grid_points_y.append(draw_y)
+                append_row(self, draw_y)
                 draw_line(self, img_x, draw_y, 'H', True)
 
 
@@ -157,39 +176,223 @@ def on_mouse_right(img_x, img_y, flags, param):
 def on_mouse(event, mouse_x, mouse_y, flags, param):
     self = param
 
-    img_x = mouse_x + self.config.view.x
-    img_y = mouse_y + self.config.view.y
+    zoom = zoom_level(self)
+    img_x = ((self.config.view.x >> zoom) + mouse_x) << zoom
+    img_y = ((self.config.view.y >> zoom) + mouse_y) << zoom
 
-    # draw vertical grid lines
-    if event == cv.CV_EVENT_LBUTTONDOWN:
-        on_mouse_left(img_x, img_y, flags, param)
-    # draw horizontal grid lines
-    elif event == cv.CV_EVENT_RBUTTONDOWN:
-        on_mouse_right(img_x, img_y, flags, param)
+    with self.state_lock:
+        if event == cv.CV_EVENT_LBUTTONDOWN and self.minimap_rect is not None:
+            mx, my, mw, mh, mzoom = self.minimap_rect
+            if mx <= mouse_x < mx + mw and my <= mouse_y < my + mh:
+                center_on(self, (mouse_x - mx) << mzoom, (mouse_y - my) << mzoom)
+                show_image(self)
+                return
+        # draw vertical grid lines
+        if event == cv.CV_EVENT_LBUTTONDOWN:
+            on_mouse_left(img_x, img_y, flags, param)
+        # draw horizontal grid lines
+        elif event == cv.CV_EVENT_RBUTTONDOWN:
+            on_mouse_right(img_x, img_y, flags, param)
 
 
-def show_image(self):
-    if self.config.img_display_original:
-        self.img_display = cv.CloneImage(self.img_original)
+def viewport_rect(self):
+    '''Visible (x, y, w, h) region of the image'''
+    imgw, imgh = image_size(self)
+    x = min(max(0, self.config.view.x), imgw - 1)
+    y = min(max(0, self.config.view.y), imgh - 1)
+    w = min(self.config.view.w, imgw - x)
+    h = min(self.config.view.h, imgh - y)
+    return (x, y, w, h)
+
+def blend_roi(dst, src, rect, op):
+    '''dst = op(dst, src[rect]) without copying src'''
+    cv.SetImageROI(src, rect)
+    try:
+        if op is None:
+            cv.Copy(src, dst)
+        else:
+            op(dst, src, dst)
+    finally:
+        cv.ResetImageROI(src)
+
+def zoom_level(self):
+    '''Display zoom, limited to the levels there are'''
+    if self.pyramid is None:
+        return 0
+    return min(self.config.view.zoom, len(self.pyramid) - 1)
+
+def display_buffer(self, size):
+    if self.img_display is None or cv.GetSize(self.img_display) != size:
+        self.img_display = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+    return self.img_display
+
+def draw_grid_scaled(self, disp, lx, ly, zoom):
+    '''Grid lines and set bits onto disp showing pyramid level zoom from level pixel lx, ly'''
+    h, w = disp.shape[:2]
+    if self.grid_model is not None and self.grid_model.is_affine():
+        # Rotated grid lines aren't image rows / columns, mark the intersections instead
+        pad = int(math.ceil(self.grid_model.max_offset()))
+        x0, y0 = lx << zoom, ly << zoom
+        cols = range(bisect.bisect_left(self.grid_points_x, x0 - pad),
+                     bisect.bisect_right(self.grid_points_x, x0 + (w << zoom) + pad))
+        rows = range(bisect.bisect_left(self.grid_points_y, y0 - pad),
+                     bisect.bisect_right(self.grid_points_y, y0 + (h << zoom) + pad))
+        if not cols or not rows:
+            return
+        px, py = self.grid_model.points(cols, rows)
+        px = (np.floor(px + 0.5).astype(np.intp) >> zoom) - lx
+        py = (np.floor(py + 0.5).astype(np.intp) >> zoom) - ly
+        inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        # Blue (BGR)
+        disp[py[inside], px[inside], 0] = 0xff
+        if not self.data_read:
+            return
+        on = inside & self.data.to_array()[np.ix_(cols, rows)]
+        px = px[on]
+        py = py[on]
+    else:
+        xs = (np.asarray(self.grid_points_x, dtype=np.intp) >> zoom) - lx
+        ys = (np.asarray(self.grid_points_y, dtype=np.intp) >> zoom) - ly
+        cols = np.flatnonzero((xs >= 0) & (xs < w))
+        rows = np.flatnonzero((ys >= 0) & (ys < h))
+        # Blue (BGR)
+        disp[:, xs[cols], 0] = 0xff
+        disp[ys[rows], :, 0] = 0xff
+        if not self.data_read or not len(cols) or not len(rows):
+            return
+        ci, ri = np.nonzero(self.data.to_array()[np.ix_(cols, rows)])
+        px = xs[cols[ci]]
+        py = ys[rows[ri]]
+    # Set bits as green squares about the size of the aperture
+    r = self.config.radius >> zoom
+    for dy in xrange(-r, r + 1):
+        for dx in xrange(-r, r + 1):
+            x = np.clip(px + dx, 0, w - 1)
+            y = np.clip(py + dy, 0, h - 1)
+            disp[y, x] = (0x00, 0xff, 0x00)
+
+def draw_minimap(self, zoom):
+    '''Overview of the image in the display's top right corner, viewport outlined'''
+    self.minimap_rect = None
+    if self.pyramid is None or not self.config.img_display_minimap:
+        return
+    overview = self.pyramid.overview()
+    mzoom = len(self.pyramid) - 1
+    oh, ow = overview.shape[:2]
+    w, h = cv.GetSize(self.img_display)
+    if ow + 2 > w or oh + 2 > h:
+        return
+    mx, my = w - ow - 1, 1
+    img_array(self.img_display)[my:my + oh, mx:mx + ow] = overview
+    view = self.config.view
+    x0 = mx + (view.x >> mzoom)
+    y0 = my + (view.y >> mzoom)
+    x1 = min(mx + ow - 1, x0 + ((w << zoom) >> mzoom))
+    y1 = min(my + oh - 1, y0 + ((h << zoom) >> mzoom))
+    cv.Rectangle(self.img_display, (x0, y0), (x1, y1), cv.Scalar(0x00, 0xff, 0xff), 1)
+    self.minimap_rect = (mx, my, ow, oh, mzoom)
+
+def compose_zoomed(self, zoom):
+    '''
+    Compose a zoomed out frame from the matching pyramid level
+
+    The grid is drawn at display scale, peephole and data overlays are 1:1 only
+    '''
+    level = self.pyramid.level(zoom)
+    lh, lw = level.shape[:2]
+    lx = min(self.config.view.x >> zoom, lw - 1)
+    ly = min(self.config.view.y >> zoom, lh - 1)
+    w = min(self.config.view.w, lw - lx)
+    h = min(self.config.view.h, lh - ly)
+    disp = img_array(display_buffer(self, (w, h)))
+
+    if self.config.img_display_blank_image:
+        disp[:] = 0
+    elif self.config.img_display_original:
+        disp[:] = level[ly:ly + h, lx:lx + w]
+    elif self.img_source is not None:
+        # No full size preprocessed image to shrink, approximate from the level
+        disp[:] = preprocess(np.ascontiguousarray(level[ly:ly + h, lx:lx + w]), self.config)
     else:
-        self.img_display = cv.CloneImage(self.img_target)
+        disp[:] = stage_pyramid(self.img_stage).level(zoom)[ly:ly + h, lx:lx + w]
+        trim_pipeline_cache(self)
+
+    if self.config.img_display_grid:
+        draw_grid_scaled(self, disp, lx, ly, zoom)
+
+    draw_minimap(self, zoom)
+    self.img_display_viewport = self.img_display
+    return self.img_display
+
+def place_overlays(self, rect):
+    '''Move the viewport sized overlays of a tiled image to the viewport rect, redrawing them'''
+    if self.img_source is None:
+        return
+    size = overlay_size(self)
+    if cv.GetSize(self.img_grid) != size:
+        # Viewport resized, ie by a loaded config
+        self.img_grid = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+        self.img_peephole = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+        self.img_hex = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+        cv.Set(self.img_hex, cv.Scalar(0, 0, 0))
+        self.hex_overlay = None
+    elif self.overlay_origin == rect[:2]:
+        return
+    self.overlay_origin = rect[:2]
+    if self.hex_overlay is not None:
+        self.hex_overlay.move(self.overlay_origin)
+    redraw_region(self, None, None, None, None)
+
+def source_view(self, rect):
+    '''Viewport rect of the tiled image, preprocessed unless showing the original'''
+    key = (rect, self.config.img_display_original or pipeline_key(self.config))
+    if self.img_view is None or self.img_view[0] != key:
+        self.img_view = (key, render_viewport(self.img_source, self.config, rect,
+                                              original=self.config.img_display_original))
+    return self.img_view[1]
+
+def compose_viewport(self):
+    '''
+    Compose enabled layers for the visible region only
+
+    Reuses one viewport sized buffer so a frame costs O(viewport), not O(image)
+    '''
+    zoom = zoom_level(self)
+    if zoom:
+        return compose_zoomed(self, zoom)
+    rect = viewport_rect(self)
+    size = (rect[2], rect[3])
+    display_buffer(self, size)
+    place_overlays(self, rect)
+    # Overlays may start at overlay_origin rather than the image origin
+    orect = (rect[0] - self.overlay_origin[0], rect[1] - self.overlay_origin[1], rect[2], rect[3])
 
     if self.config.img_display_blank_image:
-        self.img_display = cv.CloneImage(self.img_blank)
+        cv.Set(self.img_display, cv.Scalar(0, 0, 0))
+    elif self.img_source is not None:
+        img_array(self.img_display)[:] = source_view(self, rect)
+    elif self.config.img_display_original:
+        blend_roi(self.img_display, self.img_original, rect, None)
+    else:
+        blend_roi(self.img_display, self.img_target, rect, None)
 
     if self.config.img_display_grid:
-        cv.Or(self.img_display, self.img_grid, self.img_display)
+        blend_roi(self.img_display, self.img_grid, orect, cv.Or)
 
     if self.config.img_display_peephole:
-        cv.And(self.img_display, self.img_peephole, self.img_display)
+        blend_roi(self.img_display, self.img_peephole, orect, cv.And)
 
     if self.config.img_display_data:
         show_data(self)
-        cv.Or(self.img_display, self.img_hex, self.img_display)
+        blend_roi(self.img_display, self.img_hex, orect, cv.Or)
 
-    self.img_display_viewport = self.img_display[self.config.view.y:self.config.view.y+self.config.view.h,
-                                                 self.config.view.x:self.config.view.x+self.config.view.w]
-    cv.ShowImage(self.title, self.img_display_viewport)
+    draw_minimap(self, 0)
+    self.img_display_viewport = self.img_display
+    return self.img_display
+
+@timed('show_image')
+def show_image(self):
+    cv.ShowImage(self.title, compose_viewport(self))
 
 def auto_center(self, x, y):
     '''
@@ -215,75 +418,67 @@ def auto_center(self, x, y):
 def draw_line(self, x, y, direction, intersections):
     print 'draw_line', x, y, direction, intersections, len(self.grid_points_x), len(self.grid_points_y)
 
+    imgw, imgh = image_size(self)
     if direction == 'H':
-        print 'Draw H line', (0, y), (self.img_target.width, y)
-        cv.Line(self.img_grid, (0, y), (self.img_target.width, y), cv.Scalar(0xff, 0x00, 0x00),
+        print 'Draw H line', (0, y), (imgw, y)
+        cv.Line(self.img_grid, overlay_xy(self, 0, y), overlay_xy(self, imgw, y), cv.Scalar(0xff, 0x00, 0x00),
                 1)
         for gridx in self.grid_points_x:
             print '*****self.grid_points_x circle', (gridx, y), self.config.radius
             cv.Circle(
-                self.img_grid, (gridx, y),
+                self.img_grid, overlay_xy(self, gridx, y),
                 self.config.radius,
                 cv.Scalar(0x00, 0x00, 0x00),
                 thickness=-1)
-            cv.Circle(self.img_grid, (gridx, y), self.config.radius, cv.Scalar(0xff, 0x00, 0x00))
-            if intersections:
-                self.grid_intersections.append((gridx, y))
+            cv.Circle(self.img_grid, overlay_xy(self, gridx, y), self.config.radius, cv.Scalar(0xff, 0x00, 0x00))
     else:
-        cv.Line(self.img_grid, (x, 0), (x, self.img_target.height), cv.Scalar(0xff, 0x00, 0x00),
+        cv.Line(self.img_grid, overlay_xy(self, x, 0), overlay_xy(self, x, imgh), cv.Scalar(0xff, 0x00, 0x00),
                 1)
         for gridy in self.grid_points_y:
             cv.Circle(
-                self.img_grid, (x, gridy),
+                self.img_grid, overlay_xy(self, x, gridy),
                 self.config.radius,
                 cv.Scalar(0x00, 0x00, 0x00),
                 thickness=-1)
-            cv.Circle(self.img_grid, (x, gridy), self.config.radius, cv.Scalar(0xff, 0x00, 0x00))
-            if intersections:
-                self.grid_intersections.append((x, gridy))
+            cv.Circle(self.img_grid, overlay_xy(self, x, gridy), self.config.radius, cv.Scalar(0xff, 0x00, 0x00))
     show_image(self)
-    print 'draw_line grid intersections:', len(self.grid_intersections)
+    print 'draw_line grid intersections:', len(self.grid_points_x) * len(self.grid_points_y)
 
+@timed('show_data')
 def show_data(self):
+    '''Bring img_hex up to date for the visible region'''
     if not self.data_read:
         return
 
-    cv.Set(self.img_hex, cv.Scalar(0, 0, 0))
-    print
-    dat = get_all_data(self)
-    for row in range(len(self.grid_points_y)):
-        out = ''
-        outbin = ''
-        for column in range(len(self.grid_points_x) / self.group_cols):
-            thisbyte = ord(dat[column * len(self.grid_points_y) + row])
-            hexbyte = '%02X ' % thisbyte
-            out += hexbyte
-            outbin += to_bin(thisbyte) + ' '
-            if self.config.img_display_binary:
-                disp_data = to_bin(thisbyte)
-            else:
-                disp_data = hexbyte
-            if self.config.img_display_data:
-                if self.Search_HEX and self.Search_HEX.count(thisbyte):
-                    cv.PutText(self.img_hex, disp_data,
-                               (self.grid_points_x[column * self.group_cols],
-                                self.grid_points_y[row] + self.config.radius / 2 + 1), self.font,
-                               cv.Scalar(0x00, 0xff, 0xff))
-                else:
-                    cv.PutText(self.img_hex, disp_data,
-                               (self.grid_points_x[column * self.group_cols],
-                                self.grid_points_y[row] + self.config.radius / 2 + 1), self.font,
-                               cv.Scalar(0xff, 0xff, 0xff))
-        #print outbin
-        #print
-        #print out
-    print
+    dat = get_all_bytes(self)
+    search = search_data(self, dat)
+    if self.hex_overlay is None:
+        self.hex_overlay = HexOverlay(img_array(self.img_hex), self.overlay_origin)
+    self.hex_overlay.update(self, dat, search.highlight if search else None)
+    self.hex_overlay.render(viewport_rect(self))
+
+def center_on(self, x, y):
+    '''Move the viewport so image x/y is in its center'''
+    zoom = zoom_level(self)
+    self.config.view.x = x - (self.config.view.w << zoom) / 2
+    self.config.view.y = y - (self.config.view.h << zoom) / 2
+    pan(self, 0, 0)
 
 def pan(self, x, y):
+    '''Move the viewport x, y display pixels'''
     #imgw = self.img_target.cols
     #imgh = self.img_target.rows
     #imgw, imgh, _channels = self.img_target.shape
-    imgw, imgh = cv.GetSize(self.img_target)
-    self.config.view.x = min(max(0, self.config.view.x + x), imgw - self.config.view.w)
-    self.config.view.y = min(max(0, self.config.view.y + y), imgh - self.config.view.h)
+    imgw, imgh = image_size(self)
+    zoom = zoom_level(self)
+    self.config.view.x = max(0, min(self.config.view.x + (x << zoom), imgw - (self.config.view.w << zoom)))
+    self.config.view.y = max(0, min(self.config.view.y + (y << zoom), imgh - (self.config.view.h << zoom)))
+
+def set_zoom(self, zoom):
+    '''Zoom to 2**-zoom scale keeping the viewport center in place'''
+    old = zoom_level(self)
+    cx = self.config.view.x + (self.config.view.w << old) / 2
+    cy = self.config.view.y + (self.config.view.h << old) / 2
+    self.config.view.zoom = max(0, min(zoom, len(self.pyramid) - 1 if self.pyramid else 0))
+    center_on(self, cx, cy)
 
@@ -0,0 +1,205 @@
+'''
+Hex / binary data overlay
+
+The overlay (img_hex) is kept between frames and drawn a tile at a time,
+only for tiles the viewport has actually shown.  Tiles are redrawn when the
+bytes or search highlights they show change; layout, grid or font changes
+drop everything.  Text is copied out of a glyph atlas, every byte value
+rendered once per font, instead of rasterized per byte.  Bytes are bucketed
+by the tiles their text touches whenever the layout changes, so drawing a tile
+only visits its own bytes, and unchanged bytes (the same get_all_bytes()
+array) skip the per frame comparison entirely.
+
+For tiled images img_hex only covers the viewport, starting at origin, and
+is cleared whenever it moves.
+'''
+
+import cv2.cv as cv
+import numpy as np
+
+from data import to_bin, data_cells, img_array
+
+# Overlay tile edge length in pixels
+TILE = 256
+WHITE = (0, 1, 2)
+# BGR channels lit for search matches (yellow)
+YELLOW = (1, 2)
+
+class GlyphAtlas(object):
+    '''Text of every byte value, rendered once with font'''
+    def __init__(self, font, binary):
+        # Per byte value: (uint8 mask, rows above the baseline)
+        self.glyphs = []
+        for value in xrange(256):
+            text = to_bin(value) if binary else '%02X' % value
+            (w, h), baseline = cv.GetTextSize(text, font)
+            img = cv.CreateImage((w + 2, h + baseline + 2), cv.IPL_DEPTH_8U, 1)
+            cv.Set(img, cv.Scalar(0))
+            cv.PutText(img, text, (0, h), font, cv.Scalar(0xff))
+            self.glyphs.append((img_array(img).copy(), h))
+        # Bounding box of any glyph relative to its text origin
+        self.above = max(h for _mask, h in self.glyphs)
+        self.below = max(mask.shape[0] - h for mask, h in self.glyphs)
+        self.width = max(mask.shape[1] for mask, _h in self.glyphs)
+
+class HexOverlay(object):
+    def __init__(self, img, origin=(0, 0)):
+        # numpy view of img_hex
+        self.img = img
+        # Image coordinates of img pixel 0, 0
+        self.origin = origin
+        self.key = None
+        self.atlas = None
+        self.atlas_key = None
+        # Bytes and highlights the rendered tiles show, not copied as their
+        # owners (get_all_bytes(), Search) replace rather than modify them
+        self.dat = None
+        self.highlight = None
+        # highlight as passed to update(), maybe None
+        self.highlight_src = None
+        # Text origin of each byte
+        self.px = None
+        self.py = None
+        # (tile x, tile y): indices of the bytes whose text touches it
+        self.buckets = {}
+        # (tile x, tile y) already drawn
+        self.rendered = set()
+
+    def tile_rect(self, tx, ty):
+        '''Image (x0, y0, x1, y1) of a tile, clipped to img'''
+        ox, oy = self.origin
+        return (max(tx * TILE, ox), max(ty * TILE, oy),
+                min((tx + 1) * TILE, ox + self.img.shape[1]), min((ty + 1) * TILE, oy + self.img.shape[0]))
+
+    def clear_tile(self, tile):
+        x0, y0, x1, y1 = self.tile_rect(*tile)
+        ox, oy = self.origin
+        if x0 < x1 and y0 < y1:
+            self.img[y0 - oy:y1 - oy, x0 - ox:x1 - ox] = 0
+        self.rendered.discard(tile)
+
+    def clear(self):
+        for tile in list(self.rendered):
+            self.clear_tile(tile)
+
+    def move(self, origin):
+        '''img now covers the image from origin'''
+        self.origin = origin
+        self.img[:] = 0
+        self.rendered.clear()
+
+    def byte_tiles(self, indices):
+        '''Tiles touched by the text of given bytes'''
+        ret = set()
+        for i in indices:
+            x0 = self.px[i] // TILE
+            x1 = (self.px[i] + self.atlas.width) // TILE
+            y0 = (self.py[i] - self.atlas.above) // TILE
+            y1 = (self.py[i] + self.atlas.below) // TILE
+            for tx in xrange(x0, x1 + 1):
+                for ty in xrange(y0, y1 + 1):
+                    ret.add((tx, ty))
+        return ret
+
+    def bucket(self):
+        '''Group byte indices by the tiles their text touches'''
+        atlas = self.atlas
+        tx0 = self.px // TILE
+        tx1 = (self.px + atlas.width) // TILE
+        ty0 = (self.py - atlas.above) // TILE
+        ty1 = (self.py + atlas.below) // TILE
+        indices, txs, tys = [], [], []
+        if len(self.px):
+            for dx in xrange(int((tx1 - tx0).max()) + 1):
+                for dy in xrange(int((ty1 - ty0).max()) + 1):
+                    i = np.flatnonzero((tx0 + dx <= tx1) & (ty0 + dy <= ty1))
+                    indices.append(i)
+                    txs.append(tx0[i] + dx)
+                    tys.append(ty0[i] + dy)
+        self.buckets = {}
+        if not indices:
+            return
+        indices = np.concatenate(indices)
+        txs = np.concatenate(txs)
+        tys = np.concatenate(tys)
+        order = np.lexsort((indices, txs, tys))
+        indices, txs, tys = indices[order], txs[order], tys[order]
+        starts = np.flatnonzero(np.r_[True, (np.diff(txs) != 0) | (np.diff(tys) != 0)])
+        ends = np.r_[starts[1:], len(indices)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.buckets[(int(txs[start]), int(tys[start]))] = indices[start:end]
+
+    def update(self, rompar, dat, highlight):
+        '''Drop tiles made stale by the current bytes, layout, grid or font'''
+        atlas_key = (rompar.config.font_size, rompar.config.img_display_binary)
+        key = (atlas_key, rompar.config.layout, rompar.group_cols, rompar.config.radius,
+               rompar.grid_version)
+        if key == self.key and dat is self.dat and highlight is self.highlight_src:
+            # Nothing changed since the last frame
+            return
+        highlight_src = highlight
+        if highlight is None:
+            highlight = np.zeros(len(dat), dtype=bool)
+        if key != self.key:
+            self.clear()
+            if atlas_key != self.atlas_key:
+                self.atlas = GlyphAtlas(rompar.font, rompar.config.img_display_binary)
+                self.atlas_key = atlas_key
+            cell_cols, cell_rows = data_cells(rompar)
+            self.px = np.asarray(rompar.grid_points_x, dtype=np.intp)[cell_cols]
+            self.py = np.asarray(rompar.grid_points_y, dtype=np.intp)[cell_rows] + rompar.config.radius / 2 + 1
+            self.bucket()
+            self.key = key
+        elif len(dat) != len(self.dat):
+            self.clear()
+        else:
+            changed = np.flatnonzero((dat != self.dat) | (highlight != self.highlight))
+            if len(changed) > len(self.rendered) * 16:
+                self.clear()
+            else:
+                for tile in self.byte_tiles(changed) & self.rendered:
+                    self.clear_tile(tile)
+        self.dat = dat
+        self.highlight = highlight
+        self.highlight_src = highlight_src
+
+    def render(self, rect):
+        '''Draw tiles intersecting image rect (x, y, w, h) that aren't current'''
+        x, y, w, h = rect
+        for tx in xrange(x // TILE, (x + w - 1) // TILE + 1):
+            for ty in xrange(y // TILE, (y + h - 1) // TILE + 1):
+                if (tx, ty) not in self.rendered:
+                    self.render_tile(tx, ty)
+
+    def render_tile(self, tx, ty):
+        atlas = self.atlas
+        ox, oy = self.origin
+        x0, y0, x1, y1 = self.tile_rect(tx, ty)
+        if x1 <= x0 or y1 <= y0:
+            self.rendered.add((tx, ty))
+            return
+        self.img[y0 - oy:y1 - oy, x0 - ox:x1 - ox] = 0
+        sel = self.buckets.get((tx, ty))
+        if sel is None:
+            self.rendered.add((tx, ty))
+            return
+        # Bucketed by whole tile, the overlay may only cover part of it
+        px = self.px[sel]
+        py = self.py[sel]
+        sel = sel[(px < x1) & (px + atlas.width > x0) & (py - atlas.above < y1) & (py + atlas.below > y0)]
+        for i in sel.tolist():
+            mask, above = atlas.glyphs[self.dat[i]]
+            gx = self.px[i]
+            gy = self.py[i] - above
+            # Clip glyph to tile
+            cx0 = max(gx, x0)
+            cy0 = max(gy, y0)
+            cx1 = min(gx + mask.shape[1], x1)
+            cy1 = min(gy + mask.shape[0], y1)
+            if cx0 >= cx1 or cy0 >= cy1:
+                continue
+            glyph = mask[cy0 - gy:cy1 - gy, cx0 - gx:cx1 - gx]
+            region = self.img[cy0 - oy:cy1 - oy, cx0 - ox:cx1 - ox]
+            for channel in (YELLOW if self.highlight[i] else WHITE):
+                np.maximum(region[:, :, channel], glyph, out=region[:, :, channel])
+        self.rendered.add((tx, ty))
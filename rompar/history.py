@@ -0,0 +1,257 @@
+'''
+Save history store
+
+Rather than a full _sN copy per save, a history directory keeps
+
+    log.jsonl       one line per save: n, time, object, parent save
+    objects/<sha1>  zlib compressed, content addressed blobs
+
+A blob is either a base (full grid, config and packed bits) or a delta
+against the parent save: config / group keys that changed, changed grid line
+positions and the packed bit bytes that differ.  A save therefore writes
+about as much as was edited.  Line insert / delete, a bit matrix of a
+different shape or a chain of CHAIN_MAX deltas start a new base instead.
+
+Any save is materialized by applying its delta chain to the base.  gc()
+drops all but the latest saves, rebasing the oldest one kept.
+'''
+
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+
+import numpy as np
+
+from bitmatrix import BitMatrix
+
+EXTENSION = '.history'
+LOG = 'log.jsonl'
+# Deltas allowed before a save is written as a new base
+CHAIN_MAX = 64
+
+def is_history(fn):
+    return os.path.isdir(fn) and os.path.exists(os.path.join(fn, LOG))
+
+class State(object):
+    '''What a save records, grid lines as int32 arrays and bits packed like BitMatrix'''
+    def __init__(self, meta, grid_x, grid_y, bits):
+        self.meta = meta
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        # packed uint8 (cols, (rows + 7) // 8) or None if not read
+        self.bits = bits
+
+def project_state(self):
+    '''State of Rompar self, sharing nothing with it'''
+    config = dict(self.config.__dict__)
+    config['view'] = config['view'].as_dict()
+    meta = {
+        'config': config,
+        'group_cols': self.group_cols,
+        'group_rows': self.group_rows,
+        'img_fn': self.img_fn,
+        'grid_model': self.grid_model.as_dict() if self.grid_model is not None else None,
+        }
+    bits = np.array(self.data.packed) if self.data_read else None
+    return State(meta,
+                 np.array(self.grid_points_x, dtype=np.int32),
+                 np.array(self.grid_points_y, dtype=np.int32),
+                 bits)
+
+def encode(header, arrays):
+    '''Blob of a JSON header and named arrays'''
+    header = dict(header)
+    header['arrays'] = [(name, arr.dtype.str, arr.shape) for name, arr in arrays]
+    header = json.dumps(header, sort_keys=True)
+    parts = [struct.pack('<I', len(header)), header]
+    parts += [np.ascontiguousarray(arr).tostring() for _name, arr in arrays]
+    return zlib.compress(''.join(parts))
+
+def decode(blob):
+    '''Return (header, {name: array}) of an encode()d blob'''
+    raw = zlib.decompress(blob)
+    header_len, = struct.unpack('<I', raw[:4])
+    header = json.loads(raw[4:4 + header_len])
+    pos = 4 + header_len
+    arrays = {}
+    for name, dtype, shape in header['arrays']:
+        dtype = np.dtype(str(dtype))
+        n = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = np.frombuffer(raw[pos:pos + n], dtype=dtype).reshape(shape).copy()
+        pos += n
+    return header, arrays
+
+def encode_base(state):
+    arrays = [('grid_x', state.grid_x), ('grid_y', state.grid_y)]
+    if state.bits is not None:
+        arrays.append(('bits', state.bits))
+    return encode({'kind': 'base', 'meta': state.meta}, arrays)
+
+def can_delta(old, new):
+    return (len(old.grid_x) == len(new.grid_x) and len(old.grid_y) == len(new.grid_y) and
+            (old.bits is None) == (new.bits is None) and
+            (old.bits is None or old.bits.shape == new.bits.shape))
+
+def encode_delta(old, new):
+    meta = dict((k, v) for k, v in new.meta.iteritems() if old.meta.get(k) != v)
+    arrays = []
+    for axis in ('grid_x', 'grid_y'):
+        idx = np.flatnonzero(getattr(old, axis) != getattr(new, axis)).astype(np.uint32)
+        arrays += [(axis + '_idx', idx), (axis + '_val', getattr(new, axis)[idx])]
+    if new.bits is not None:
+        idx = np.flatnonzero(old.bits.ravel() != new.bits.ravel()).astype(np.uint32)
+        arrays += [('bits_idx', idx), ('bits_val', new.bits.ravel()[idx])]
+    return encode({'kind': 'delta', 'meta': meta}, arrays)
+
+def apply_delta(state, header, arrays):
+    '''New State from state plus a decoded delta'''
+    meta = dict(state.meta)
+    meta.update(header['meta'])
+    grid = {}
+    for axis in ('grid_x', 'grid_y'):
+        grid[axis] = getattr(state, axis).copy()
+        grid[axis][arrays[axis + '_idx']] = arrays[axis + '_val']
+    bits = None
+    if state.bits is not None:
+        bits = state.bits.copy()
+        bits.ravel()[arrays['bits_idx']] = arrays['bits_val']
+    return State(meta, grid['grid_x'], grid['grid_y'], bits)
+
+class History(object):
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+        self.entries = []
+        log = os.path.join(path, LOG)
+        if os.path.exists(log):
+            with open(log, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        self.entries.append(json.loads(line))
+        self.index = dict((entry['n'], entry) for entry in self.entries)
+        # State of the last entry if known, saves diffing against a materialized copy
+        self.head = None
+
+    def put(self, blob):
+        '''Store blob, return its name'''
+        sha = hashlib.sha1(blob).hexdigest()
+        fn = os.path.join(self.objects, sha)
+        if not os.path.exists(fn):
+            tmp = fn + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(blob)
+            os.rename(tmp, fn)
+        return sha
+
+    def get(self, sha):
+        with open(os.path.join(self.objects, sha), 'rb') as f:
+            return decode(f.read())
+
+    def entry(self, n):
+        try:
+            return self.index[n]
+        except KeyError:
+            raise Exception("%s: no save %d" % (self.path, n))
+
+    def chain(self, n):
+        '''Entries from the base up to save n'''
+        ret = []
+        entry = self.entry(n)
+        while True:
+            ret.append(entry)
+            if entry['parent'] is None:
+                break
+            entry = self.entry(entry['parent'])
+        return ret[::-1]
+
+    def state(self, n=None):
+        '''Materialize save n, default latest'''
+        if n is None:
+            if not self.entries:
+                raise Exception("%s: no saves" % self.path)
+            n = self.entries[-1]['n']
+        if self.head is not None and n == self.entries[-1]['n']:
+            return self.head
+        state = None
+        for entry in self.chain(n):
+            header, arrays = self.get(entry['object'])
+            if header['kind'] == 'base':
+                state = State(header['meta'], arrays['grid_x'], arrays['grid_y'], arrays.get('bits'))
+            else:
+                state = apply_delta(state, header, arrays)
+        return state
+
+    def append_log(self, entry):
+        with open(os.path.join(self.path, LOG), 'ab') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(entry)
+        self.index[entry['n']] = entry
+
+    def commit(self, state):
+        '''Record state as a new save, return its entry'''
+        parent = self.entries[-1] if self.entries else None
+        prev = self.state() if parent else None
+        if prev is not None and can_delta(prev, state) and len(self.chain(parent['n'])) <= CHAIN_MAX:
+            sha = self.put(encode_delta(prev, state))
+            parent_n = parent['n']
+        else:
+            sha = self.put(encode_base(state))
+            parent_n = None
+        entry = {
+            'n': parent['n'] + 1 if parent else 0,
+            'time': time.time(),
+            'object': sha,
+            'parent': parent_n,
+            }
+        self.append_log(entry)
+        self.head = state
+        return entry
+
+    def grid_json(self, n=None):
+        '''load_grid() compatible dict of save n, default latest'''
+        state = self.state(n)
+        ret = dict(state.meta)
+        ret['grid_points_x'] = state.grid_x.tolist()
+        ret['grid_points_y'] = state.grid_y.tolist()
+        ret['bits'] = None
+        if state.bits is not None:
+            ret['bits'] = BitMatrix.from_packed(state.bits.copy(), len(state.grid_y))
+        return ret
+
+    def gc(self, keep):
+        '''Drop all but the latest keep saves and their unreferenced objects, return bytes freed'''
+        if keep < 1 or len(self.entries) <= keep:
+            return 0
+        kept = self.entries[-keep:]
+        first = dict(kept[0])
+        if first['parent'] is not None:
+            first['object'] = self.put(encode_base(self.state(first['n'])))
+            first['parent'] = None
+        kept[0] = first
+        log = os.path.join(self.path, LOG)
+        tmp = log + '.tmp'
+        with open(tmp, 'wb') as f:
+            for entry in kept:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.rename(tmp, log)
+        self.entries = kept
+        self.index = dict((entry['n'], entry) for entry in kept)
+
+        used = set(entry['object'] for entry in kept)
+        freed = 0
+        for sha in os.listdir(self.objects):
+            if sha not in used:
+                fn = os.path.join(self.objects, sha)
+                freed += os.path.getsize(fn)
+                os.unlink(fn)
+        return freed
+
+    def disk_usage(self):
+        return sum(os.path.getsize(os.path.join(self.objects, sha)) for sha in os.listdir(self.objects))
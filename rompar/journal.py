@@ -0,0 +1,75 @@
+'''
+Undo / redo journal
+
+Edits are recorded as (kind, args) tuples holding just enough to reverse
+them: a toggled bit's position, a moved line's old and new coordinate, a deleted
+line's position with its bits and aperture sums.  Reverting or redoing an edit
+goes through the same incremental functions as the edit itself (see
+apply_edit() in data.py) so only the affected column, row or bit is
+resampled and redrawn.
+
+Memory is bounded by max_bytes over both stacks, oldest edits are dropped
+first.
+'''
+
+from collections import deque
+
+import numpy as np
+
+# Default journal size limit
+MAX_BYTES = 16 << 20
+# Rough cost of an edit besides its arrays
+OP_BYTES = 128
+
+def op_size(args):
+    return OP_BYTES + sum(arg.nbytes for arg in args if isinstance(arg, np.ndarray))
+
+class Journal(object):
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        # (kind, args, size), most recent last
+        self.undo_ops = deque()
+        self.redo_ops = []
+        # Of both stacks, undo / redo only move edits between them
+        self.nbytes = 0
+        # Set while an edit is being reverted / redone so it isn't recorded again
+        self.replaying = False
+
+    def __len__(self):
+        return len(self.undo_ops)
+
+    def record(self, kind, args):
+        '''Note a new edit, which invalidates anything undone'''
+        if self.replaying:
+            return
+        self.nbytes -= sum(op[2] for op in self.redo_ops)
+        del self.redo_ops[:]
+        size = op_size(args)
+        self.undo_ops.append((kind, args, size))
+        self.nbytes += size
+        self.trim()
+
+    def trim(self):
+        while self.undo_ops and self.nbytes > self.max_bytes:
+            self.nbytes -= self.undo_ops.popleft()[2]
+
+    def pop_undo(self):
+        '''Most recent edit, now redoable, or None'''
+        if not self.undo_ops:
+            return None
+        op = self.undo_ops.pop()
+        self.redo_ops.append(op)
+        return op
+
+    def pop_redo(self):
+        '''Most recently undone edit, now undoable again, or None'''
+        if not self.redo_ops:
+            return None
+        op = self.redo_ops.pop()
+        self.undo_ops.append(op)
+        return op
+
+    def clear(self):
+        self.undo_ops.clear()
+        del self.redo_ops[:]
+        self.nbytes = 0
@@ -0,0 +1,142 @@
+'''
+ROM bit orderings
+
+A layout maps the [column, row] bit matrix onto output bytes.  Rather than
+code, a layout is a small definition:
+
+    order: nesting of the output, outermost first, over
+        'group' (column group), 'row' and 'byte' (byte within a column group)
+    cols: optional permutation of the group_cols columns within a group
+    bits: optional permutation of the 8 columns of a byte, MSB first
+
+Each definition is turned into one gather permutation per array geometry
+and cached so packing is a single take + packbits.  Exports compute the part
+of the permutation they need per chunk instead (see perm_range()).
+Extra layouts can be registered from a JSON file, ie
+
+    [{"name": "rows", "order": ["row", "group", "byte"]}]
+'''
+
+import json
+
+import numpy as np
+
+AXES = ('group', 'row', 'byte')
+
+class Layout(object):
+    def __init__(self, name, order=AXES, cols=None, bits=None):
+        if sorted(order) != sorted(AXES):
+            raise Exception("Layout %s: order must be a permutation of %s" % (name, AXES))
+        if bits is not None and sorted(bits) != range(8):
+            raise Exception("Layout %s: bits must be a permutation of 0-7" % name)
+        self.name = name
+        self.order = tuple(order)
+        self.cols = None if cols is None else list(cols)
+        self.bits = None if bits is None else list(bits)
+        # (geometry key, (perm, cell_cols, cell_rows))
+        self.cache = None
+
+    def _geometry(self, ncols, nrows, group_cols, lsb):
+        '''Return (output shape, colmap, bitmap) for the given geometry'''
+        if self.cols is not None and sorted(self.cols) != range(group_cols):
+            raise Exception("Layout %s: cols must be a permutation of 0-%d" % (self.name, group_cols - 1))
+        sizes = {
+            'group': ncols // group_cols if group_cols else 0,
+            'row': nrows,
+            'byte': group_cols // 8,
+            }
+        shape = [sizes[axis] for axis in self.order] + [8]
+        # Which column of the byte lands in each output bit position
+        bitmap = np.array(self.bits if self.bits is not None else range(8), dtype=np.intp)
+        if lsb:
+            bitmap = bitmap[::-1]
+        colmap = np.array(self.cols if self.cols is not None else range(group_cols), dtype=np.intp)
+        return shape, colmap, bitmap
+
+    def _axes(self, ncols, nrows, group_cols, lsb):
+        '''Return (perm, cell_cols, cell_rows) for the given geometry'''
+        key = (ncols, nrows, group_cols, lsb)
+        if self.cache is not None and self.cache[0] == key:
+            return self.cache[1]
+
+        shape, colmap, bitmap = self._geometry(ncols, nrows, group_cols, lsb)
+
+        def axis(name):
+            '''arange along named axis, broadcastable against the output shape'''
+            if name == 'bit':
+                dim = len(self.order)
+            else:
+                dim = self.order.index(name)
+            view = [1] * len(shape)
+            view[dim] = shape[dim]
+            return np.arange(shape[dim], dtype=np.intp).reshape(view)
+
+        group = axis('group')
+        row = axis('row')
+        byte = axis('byte')
+        bit = axis('bit')
+        col = group * group_cols + colmap[byte * 8 + bitmap[bit]]
+        perm = np.broadcast_to(col * nrows + row, shape).ravel()
+        # Where each byte is displayed: its first column in the grid
+        cell_cols = np.broadcast_to(group * group_cols + byte * 8, shape[:-1] + [1]).ravel()
+        cell_rows = np.broadcast_to(row[..., :1], shape[:-1] + [1]).ravel()
+
+        ret = (perm, cell_cols, cell_rows)
+        self.cache = (key, ret)
+        return ret
+
+    def perm(self, ncols, nrows, group_cols, lsb=False):
+        '''Index into the raveled [column, row] bits of each output bit'''
+        return self._axes(ncols, nrows, group_cols, lsb)[0]
+
+    def size(self, ncols, nrows, group_cols):
+        '''Packed output bytes'''
+        shape, _colmap, _bitmap = self._geometry(ncols, nrows, group_cols, False)
+        return int(np.prod(shape[:-1]))
+
+    def perm_range(self, ncols, nrows, group_cols, lsb, start, end):
+        '''perm()[start:end] computed per output bit, without building (or caching) the whole permutation'''
+        shape, colmap, bitmap = self._geometry(ncols, nrows, group_cols, lsb)
+        if end <= start:
+            return np.zeros(0, dtype=np.intp)
+        coords = dict(zip(self.order + ('bit',), np.unravel_index(np.arange(start, end, dtype=np.intp), shape)))
+        col = coords['group'] * group_cols + colmap[coords['byte'] * 8 + bitmap[coords['bit']]]
+        return col * nrows + coords['row']
+
+    def pack(self, bits, group_cols, lsb=False, invert=False):
+        '''Return packed bytes (numpy uint8) from a boolean [column, row] array'''
+        ncols, nrows = bits.shape
+        perm, _cell_cols, _cell_rows = self._axes(ncols, nrows, group_cols, lsb)
+        out = np.packbits(bits.ravel()[perm])
+        if invert:
+            out ^= 0xff
+        return out
+
+    def cells(self, ncols, nrows, group_cols):
+        '''(column, row) grid index arrays for each output byte'''
+        _perm, cell_cols, cell_rows = self._axes(ncols, nrows, group_cols, False)
+        return cell_cols, cell_rows
+
+LAYOUTS = {}
+
+def register_layout(name, order=AXES, cols=None, bits=None):
+    LAYOUTS[name] = Layout(name, order=order, cols=cols, bits=bits)
+    return LAYOUTS[name]
+
+def load_layouts(fn):
+    '''Register layouts from a JSON list of definitions'''
+    with open(fn, 'rb') as f:
+        defs = json.load(f)
+    for d in defs:
+        register_layout(d['name'], order=d.get('order', AXES), cols=d.get('cols'), bits=d.get('bits'))
+
+def get_layout(name):
+    try:
+        return LAYOUTS[name]
+    except KeyError:
+        raise Exception("Unknown layout %s, have: %s" % (name, ', '.join(sorted(LAYOUTS))))
+
+# Column group by column group, each row top to bottom
+register_layout('default', order=('group', 'row', 'byte'))
+# Row by row, each column group left to right
+register_layout('rows', order=('row', 'group', 'byte'))
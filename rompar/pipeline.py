@@ -0,0 +1,85 @@
+'''
+Image preprocessing on numpy arrays
+
+Same threshold / mask / dilate / erode steps as the interactive loop but
+without any display buffers so it can run headless
+OpenCV is imported on first use so tools only handling grid files don't load it
+'''
+
+# Thresholding keeps only the red channel (BGR order)
+MASK_CHANNEL = 2
+
+def preprocess(img, config):
+    '''Return a new target image from img processed per config'''
+    import cv2
+
+    if config.threshold:
+        _retval, target = cv2.threshold(img, config.pix_thresh_min, 0xff, cv2.THRESH_BINARY)
+        for channel in xrange(target.shape[2]):
+            if channel != MASK_CHANNEL:
+                target[:, :, channel] = 0
+    else:
+        target = img.copy()
+    if config.dilate:
+        target = cv2.dilate(target, None, iterations=config.dilate)
+    if config.erode:
+        target = cv2.erode(target, None, iterations=config.erode)
+    return target
+
+def load_image(fn):
+    '''Load BGR image as numpy array, same channel order as cv.LoadImage'''
+    import cv2
+
+    img = cv2.imread(fn, cv2.CV_LOAD_IMAGE_COLOR)
+    if img is None:
+        raise Exception("Failed to load image %s" % fn)
+    return img
+
+def morph_margin(config):
+    '''Pixels of context dilate / erode need around a region to match a full image pass'''
+    return config.dilate + config.erode
+
+def preprocess_region(source, config, x0, y0, x1, y1):
+    '''
+    Return preprocessed [y0:y1, x0:x1] of source
+
+    source can be anything sliced like source[y0:y1, x0:x1] (array, TiledImage)
+    Only the region plus a small dilate / erode margin is read
+    '''
+    margin = morph_margin(config)
+    h, w = source.shape[0], source.shape[1]
+    rx0 = max(0, x0 - margin)
+    ry0 = max(0, y0 - margin)
+    rx1 = min(w, x1 + margin)
+    ry1 = min(h, y1 + margin)
+    target = preprocess(source[ry0:ry1, rx0:rx1], config)
+    return target[y0 - ry0:y1 - ry0, x0 - rx0:x1 - rx0]
+
+# Preprocessed images (with their SAT and pyramid) kept for recently used
+# parameter sets, up to this many bytes.  The current one is always kept
+CACHE_BYTES = 512 << 20
+
+def pipeline_key(config):
+    '''Parameters that affect preprocess() output'''
+    if config.threshold:
+        return (True, config.pix_thresh_min, config.dilate, config.erode)
+    return (False, None, config.dilate, config.erode)
+
+class Stage(object):
+    '''A preprocess() result and things derived from it'''
+    def __init__(self, target):
+        self.target = target
+        # Display buffer sharing target's memory, if any
+        self.image = None
+        # Summed-area table, built on first use
+        self.integral = None
+        # Zoomed out display levels, see pyramid.py
+        self.pyramid = None
+
+    def nbytes(self):
+        ret = self.target.nbytes
+        if self.integral is not None:
+            ret += self.integral.nbytes
+        if self.pyramid is not None:
+            ret += sum(level.nbytes for level in self.pyramid.levels[1:])
+        return ret
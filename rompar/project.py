@@ -0,0 +1,101 @@
+'''
+Binary project format (version 2)
+
+    magic       'ROMPAR\\0\\2'
+    header_len  uint32 little endian
+    header      JSON: version, config, group sizes, image name, grid model, section table
+    sections    64 byte aligned raw arrays:
+                    grid_points_x   int32[cols]
+                    grid_points_y   int32[rows]
+                    bits            uint8[cols][(rows + 7) / 8], BitMatrix packing
+
+Unlike the version 1 JSON files nothing is stored per intersection so
+saving / loading is O(N) and a few bytes per 8 bits.  The bit payload is
+memory mapped copy-on-write so it is only paged in as it is used.
+'''
+
+import json
+import struct
+
+import numpy as np
+
+from bitmatrix import BitMatrix
+
+MAGIC = 'ROMPAR\x00\x02'
+EXTENSION = '.rompar'
+VERSION = (2, 0)
+ALIGN = 64
+
+def align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def is_project(fn):
+    '''True if fn is a version 2 binary project'''
+    with open(fn, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_project(self, fn):
+    config = dict(self.config.__dict__)
+    config['view'] = config['view'].as_dict()
+
+    arrays = [
+        ('grid_points_x', np.array(self.grid_points_x, dtype=np.int32)),
+        ('grid_points_y', np.array(self.grid_points_y, dtype=np.int32)),
+        ]
+    if self.data_read:
+        arrays.append(('bits', np.ascontiguousarray(self.data.packed)))
+
+    # Offsets are relative to the first section
+    sections = {}
+    offset = 0
+    for name, arr in arrays:
+        sections[name] = [offset, arr.dtype.str, list(arr.shape)]
+        offset = align(offset + arr.nbytes)
+
+    header = json.dumps({
+        'version': VERSION,
+        'config': config,
+        'group_cols': self.group_cols,
+        'group_rows': self.group_rows,
+        'img_fn': self.img_fn,
+        'grid_model': self.grid_model.as_dict() if self.grid_model is not None else None,
+        'sections': sections,
+        }, sort_keys=True)
+
+    with open(fn, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        start = align(f.tell())
+        for name, arr in arrays:
+            f.seek(start + sections[name][0])
+            f.write(arr.tostring())
+    print 'Saved %s' % fn
+
+def read_project(fn):
+    '''
+    Return a load_grid() compatible dict for a version 2 project
+
+    Bits are returned as a BitMatrix backed by a copy-on-write memmap
+    '''
+    with open(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("%s: not a rompar project" % fn)
+        header_len, = struct.unpack('<I', f.read(4))
+        ret = json.loads(f.read(header_len))
+    if ret['version'][0] != VERSION[0]:
+        raise Exception("%s: unsupported version %s" % (fn, ret['version']))
+    start = align(len(MAGIC) + 4 + header_len)
+
+    def section(name):
+        offset, dtype, shape = ret['sections'][name]
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode='c', offset=start + offset, shape=tuple(shape))
+
+    ret['grid_points_x'] = section('grid_points_x').tolist()
+    ret['grid_points_y'] = section('grid_points_y').tolist()
+    ret['bits'] = None
+    if 'bits' in ret['sections']:
+        ret['bits'] = BitMatrix.from_packed(section('bits'), len(ret['grid_points_y']))
+    return ret
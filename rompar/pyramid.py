@@ -0,0 +1,138 @@
+'''
+Image pyramid for zoomed out display
+
+Level n is the image shrunk 2**n times by averaging 2x2 blocks, down to
+the first level no larger than MIN_SIZE on either side, which doubles as the
+minimap.  Zoomed out frames crop only the level matching the zoom so they
+cost O(viewport) like 1:1 frames.
+
+The original image's levels are built once, straight into a cache next to it
+
+    die.png.pyramid/meta.json   source size / mtime, level count
+    die.png.pyramid/<n>.npy     level n, memory mapped on load
+
+so only one band of them is in memory at a time, even for a tiled store.
+Preprocessed images change with their parameters so their levels are only
+kept in memory with the pipeline Stage.
+'''
+
+import os
+import json
+
+import numpy as np
+
+EXTENSION = '.pyramid'
+VERSION = 1
+# Smallest level fits in this many pixels, also the minimap size
+MIN_SIZE = 192
+# Rows downsampled at a time, bounds temporaries for huge images
+BAND = 1024
+
+def downsample(img, out=None):
+    '''
+    img shrunk 2x by averaging 2x2 blocks, odd edge pixels dropped
+
+    img only needs .shape, .dtype and [y0:y1, x0:x1] slicing (array, TiledImage)
+    '''
+    h, w = img.shape[0] // 2, img.shape[1] // 2
+    if out is None:
+        out = np.empty((h, w) + tuple(img.shape[2:]), dtype=img.dtype)
+    for y0 in xrange(0, h, BAND):
+        y1 = min(h, y0 + BAND)
+        src = img[2 * y0:2 * y1, :2 * w].astype(np.uint16)
+        acc = src[0::2, 0::2] + src[0::2, 1::2] + src[1::2, 0::2] + src[1::2, 1::2]
+        out[y0:y1] = (acc + 2) >> 2
+    return out
+
+def build_levels(img, min_size=MIN_SIZE, alloc=None):
+    '''Levels 1 and up of img, output arrays from alloc(n, shape, dtype) if given'''
+    ret = []
+    while max(img.shape[0], img.shape[1]) > min_size and min(img.shape[0], img.shape[1]) >= 2:
+        out = None
+        if alloc is not None:
+            out = alloc(len(ret) + 1, (img.shape[0] // 2, img.shape[1] // 2) + tuple(img.shape[2:]), img.dtype)
+        img = downsample(img, out)
+        ret.append(img)
+    return ret
+
+class Pyramid(object):
+    def __init__(self, img, levels):
+        # levels[0] is img itself
+        self.levels = [img] + list(levels)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level(self, zoom):
+        '''Level for zoom, clamped to the smallest'''
+        return self.levels[min(zoom, len(self.levels) - 1)]
+
+    def overview(self):
+        return self.levels[-1]
+
+    def crop(self, zoom, x, y, w, h):
+        '''Full resolution region (x, y) with w x h level pixels, as a view of the level'''
+        img = self.level(zoom)
+        x >>= zoom
+        y >>= zoom
+        return img[y:y + h, x:x + w]
+
+def pyramid_fn(img_fn):
+    return img_fn + EXTENSION
+
+def source_meta(img_fn):
+    st = os.stat(img_fn)
+    return {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+def read_levels(path, img_fn):
+    '''Cached levels of img_fn, None if missing or stale'''
+    try:
+        with open(os.path.join(path, 'meta.json'), 'rb') as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if meta.get('version') != VERSION or meta.get('source') != source_meta(img_fn):
+        return None
+    try:
+        return [np.load(os.path.join(path, '%d.npy' % n), mmap_mode='r')
+                for n in xrange(1, meta['levels'] + 1)]
+    except IOError:
+        return None
+
+def write_levels(path, img_fn, img):
+    '''Build the levels of img into memory mapped files under path'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+
+    def alloc(n, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(path, '%d.npy' % n), mode='w+', dtype=dtype, shape=shape)
+
+    levels = build_levels(img, alloc=alloc)
+    for level in levels:
+        level.flush()
+    # Last so a partial write is never taken as valid
+    meta = {'version': VERSION, 'source': source_meta(img_fn), 'levels': len(levels)}
+    with open(os.path.join(path, 'meta.json'), 'wb') as f:
+        json.dump(meta, f)
+    return levels
+
+def load_pyramid(img_fn, img):
+    '''Pyramid of image img (array or TiledImage) loaded from img_fn, using / refreshing the on disk cache'''
+    path = pyramid_fn(img_fn)
+    levels = read_levels(path, img_fn)
+    if levels is None:
+        print 'Building image pyramid'
+        try:
+            levels = write_levels(path, img_fn, img)
+        except (IOError, OSError) as e:
+            print 'WARNING: failed to cache pyramid: %s' % e
+            levels = build_levels(img)
+    return Pyramid(img, levels)
+
+def stage_pyramid(stage):
+    '''Pyramid of a pipeline Stage's target, built on first use'''
+    if stage.pyramid is None:
+        stage.pyramid = Pyramid(stage.target, build_levels(stage.target))
+    return stage.pyramid
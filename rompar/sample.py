@@ -0,0 +1,156 @@
+'''
+Vectorized bit sampling
+
+A bit's value is the sum of all pixels (all channels) in a square aperture
+centered on its grid intersection.  Rather than walking every pixel of every
+aperture build a summed-area table (integral image) of the target once and get
+every aperture sum from four array gathers.
+'''
+
+import numpy as np
+
+# Summed-area table entries wrap modulo 2**32: 4 bytes a pixel, and a box sum
+# (four entry difference) is still exact as long as the box itself sums to
+# less than 2**32, ie any aperture under ~5.6 Mpixel of 3 x 255
+SAT_DTYPE = np.uint32
+
+def integral_image(img):
+    '''
+    Return summed-area table of img with channels added together
+
+    Result is (h + 1, w + 1) with a zero first row and column
+    such that sat[y, x] is the sum of img[:y, :x] modulo 2**32
+    '''
+    img = np.asarray(img)
+    h, w = img.shape[0], img.shape[1]
+    sat = np.zeros((h + 1, w + 1), dtype=SAT_DTYPE)
+    if img.ndim == 3:
+        np.sum(img, axis=2, dtype=SAT_DTYPE, out=sat[1:, 1:])
+    else:
+        sat[1:, 1:] = img
+    np.cumsum(sat[1:, 1:], axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+def box_sums(sat, x0, y0, x1, y1):
+    '''Exact int64 sums of sat boxes [y0:y1, x0:x1], wrapping differences included'''
+    return (sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]).astype(np.int64)
+
+def aperture_bounds(centers, radius, limit):
+    '''Return clipped [lo, hi) aperture bounds for given center coordinates'''
+    # FIXME: misleading
+    # This isn't a radius but rather a bounding box
+    half = int(radius) // 2
+    centers = np.asarray(centers, dtype=np.intp)
+    lo = np.clip(centers - half, 0, limit)
+    hi = np.clip(centers + half, 0, limit)
+    return lo, hi
+
+def aperture_sums(sat, xs, ys, radius):
+    '''
+    Return aperture sums at every intersection of grid columns xs and rows ys
+
+    Result is indexed [column, row]
+    Apertures hanging off the image only count the pixels inside it
+    '''
+    h, w = sat.shape[0] - 1, sat.shape[1] - 1
+    x0, x1 = aperture_bounds(xs, radius, w)
+    y0, y1 = aperture_bounds(ys, radius, h)
+    return box_sums(sat, x0[:, None], y0[None, :], x1[:, None], y1[None, :])
+
+def point_aperture_sums(sat, px, py, radius):
+    '''
+    Return aperture sums centered on arbitrary sub-pixel points px, py
+
+    Equivalent to bilinearly interpolating the summed-area table at the
+    aperture corners, which weighs pixels partly inside the aperture by their
+    covered area.  The table wraps so rather than interpolating its entries
+    this adds up the whole pixel boxes between the neighbouring corners,
+    weighted.  Whole pixel points give exactly aperture_sums()
+    '''
+    h, w = sat.shape[0] - 1, sat.shape[1] - 1
+    half = int(radius) // 2
+    px = np.asarray(px, dtype=np.float64)
+    py = np.asarray(py, dtype=np.float64)
+
+    def corner(c, limit):
+        '''Whole pixel part and fraction of clipped corner coordinates'''
+        c = np.clip(c, 0, limit)
+        i = np.minimum(c.astype(np.intp), max(0, limit - 1))
+        return i, c - i
+
+    ix0, fx0 = corner(px - half, w)
+    ix1, fx1 = corner(px + half, w)
+    iy0, fy0 = corner(py - half, h)
+    iy1, fy1 = corner(py + half, h)
+    ret = np.zeros(px.shape, dtype=np.float64)
+    # Every combination of rounding each corner coordinate down (0) or up (1)
+    for dx0, wx0 in ((0, 1 - fx0), (1, fx0)):
+        for dx1, wx1 in ((0, 1 - fx1), (1, fx1)):
+            for dy0, wy0 in ((0, 1 - fy0), (1, fy0)):
+                for dy1, wy1 in ((0, 1 - fy1), (1, fy1)):
+                    weight = wx0 * wx1 * wy0 * wy1
+                    if not weight.any():
+                        continue
+                    ret += weight * box_sums(sat, ix0 + dx0, iy0 + dy0, ix1 + dx1, iy1 + dy1)
+    return ret
+
+def aperture_maxval(radius):
+    '''Maximum possible value if all pixels are set'''
+    return (radius * radius) * 255
+
+def bit_thresh(radius, bit_thresh_div):
+    '''Aperture sum a bit must exceed to read as 1'''
+    return aperture_maxval(radius) / bit_thresh_div
+
+def classify(sums, radius, bit_thresh_div):
+    '''Return boolean bit array from aperture sums'''
+    return sums > bit_thresh(radius, bit_thresh_div)
+
+# Bits closer than this fraction of the maximum aperture value to the threshold are marginal
+MARGIN_WARN = 0.05
+
+def margins(sums, radius, bit_thresh_div):
+    '''Signed distance of each sum from the bit threshold as a fraction of the maximum aperture value'''
+    return (sums - bit_thresh(radius, bit_thresh_div)) / float(max(1, aperture_maxval(radius)))
+
+# Histogram resolution for otsu_threshold(), exact if the value range is smaller
+OTSU_BINS = 4096
+
+def otsu_threshold(sums, bins=OTSU_BINS):
+    '''
+    Aperture sum best separating 0 and 1 bits (Otsu's method)
+
+    Every candidate threshold is scored from cumulative histogram sums in one pass
+    Returned value is midway between the brightest 0 and dimmest 1
+    '''
+    sums = np.asarray(sums).ravel()
+    if not len(sums):
+        raise Exception("No bits to threshold")
+    lo, hi = int(sums.min()), int(sums.max())
+    if lo == hi:
+        raise Exception("All bits have the same value, nothing to separate")
+    bins = min(bins, hi - lo + 1)
+    hist, edges = np.histogram(sums, bins=bins, range=(lo, hi + 1))
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    # Class 0 is bins [0, i], class 1 (i, bins)
+    w0 = np.cumsum(hist).astype(np.float64)
+    w1 = w0[-1] - w0
+    s0 = np.cumsum(hist * centers)
+    s1 = s0[-1] - s0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = w0 * w1 * (s0 / w0 - s1 / w1) ** 2
+    between[~np.isfinite(between)] = 0
+    i = int(np.argmax(between))
+    # Center the threshold in the gap between the classes
+    split = np.ceil(edges[i + 1])
+    return (sums[sums < split].max() + sums[sums >= split].min()) / 2.0
+
+def separation(sums, thresh, radius):
+    '''Gap between the dimmest 1 and brightest 0 as a fraction of the maximum aperture value, negative if they overlap'''
+    sums = np.asarray(sums).ravel()
+    ones = sums[sums > thresh]
+    zeros = sums[sums <= thresh]
+    if not len(ones) or not len(zeros):
+        return None
+    return (ones.min() - zeros.max()) / float(max(1, aperture_maxval(radius)))
@@ -0,0 +1,181 @@
+'''
+Background saving
+
+The GUI thread only takes a snapshot: the packed bits (1/8 byte per bit), grid
+lists and config are copied and everything else is shared, so a snapshot of a
+multi megabit ROM costs milliseconds.  Serializing and writing the snapshot
+happens on a writer thread, which reports completion or failure on the
+console.  An optional autosave thread periodically snapshots the project
+(under self.state_lock, which the GUI holds while changing state) and
+rewrites one autosave file if anything changed.
+'''
+
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+import traceback
+from collections import deque
+
+from data import save_grid, save_txt, save_extension
+from export import write_txt
+from history import project_state
+
+def snapshot(self):
+    '''Copy of self that later edits won't affect, for save functions'''
+    snap = copy.copy(self)
+    snap.config = copy.copy(self.config)
+    snap.config.view = copy.copy(self.config.view)
+    snap.grid_points_x = list(self.grid_points_x)
+    snap.grid_points_y = list(self.grid_points_y)
+    snap.grid_model = copy.deepcopy(self.grid_model)
+    if self.data is not None:
+        snap.data = self.data.copy()
+    return snap
+
+def state_key(self):
+    '''Digest of everything a save writes, to skip redundant autosaves'''
+    h = hashlib.md5()
+    h.update(json.dumps([self.grid_points_x, self.grid_points_y, self.group_cols, self.group_rows,
+                         self.grid_model.as_dict() if self.grid_model is not None else None,
+                         self.data_read, sorted((k, repr(v)) for k, v in self.config.__dict__.iteritems() if k != 'view')]))
+    if self.data_read:
+        h.update(self.data.packed.tostring())
+    return h.digest()
+
+def save_snapshot(snap):
+    '''Numbered save of grid and bits, what 'S' writes'''
+    save_grid(snap)
+    if not snap.data_read:
+        print 'No bits to save'
+    else:
+        save_txt(snap)
+
+def save_history(history, snap):
+    '''Record snap in history and rewrite the unnumbered text dump, what 'S' writes with --history'''
+    entry = history.commit(project_state(snap))
+    print 'Saved %s #%d (%s, %d bytes stored)' % (
+            history.path, entry['n'], 'delta' if entry['parent'] is not None else 'base',
+            os.path.getsize(os.path.join(history.objects, entry['object'])))
+    if snap.data_read and snap.basename:
+        write_latest_txt(snap)
+
+def write_latest_txt(snap):
+    '''Replace the unnumbered basename.txt, not following the symlink a numbered save leaves there'''
+    fn = snap.basename + '.txt'
+    tmp = snap.basename + '.tmp.txt'
+    with open(tmp, 'w') as f:
+        write_txt(snap, f)
+    os.rename(tmp, fn)
+    print 'Saved %s' % fn
+
+def autosave_fn(self):
+    return self.basename + '_autosave' + save_extension(self)
+
+def write_autosave(snap, fn):
+    '''Replace fn atomically so a crash mid write leaves the previous autosave'''
+    base, ext = os.path.splitext(fn)
+    tmp = base + '.tmp' + ext
+    # Don't move the latest save symlinks to the autosave
+    snap.basename = None
+    save_grid(snap, fn=tmp)
+    os.rename(tmp, fn)
+
+class Saver(object):
+    '''Runs save jobs one at a time on a background thread'''
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (description, func, args, replace key)
+        self.jobs = deque()
+        self.busy = False
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, name='rompar-saver')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, desc, func, *args, **kwargs):
+        '''
+        Queue func(*args)
+
+        A job submitted with replace=key supersedes a queued, not yet started,
+        job with the same key
+        '''
+        replace = kwargs.get('replace')
+        with self.cond:
+            if replace is not None:
+                for job in list(self.jobs):
+                    if job[3] == replace:
+                        self.jobs.remove(job)
+            self.jobs.append((desc, func, args, replace))
+            self.cond.notify()
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                desc, func, args, _replace = self.jobs.popleft()
+                self.busy = True
+            tstart = time.time()
+            try:
+                func(*args)
+            except Exception as e:
+                print
+                print 'ERROR: %s failed: %s' % (desc, e)
+                traceback.print_exc()
+            else:
+                print '%s done in %0.2f sec' % (desc, time.time() - tstart)
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def wait(self):
+        '''Block until every queued job is written'''
+        with self.cond:
+            while self.jobs or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+class Autosaver(object):
+    '''Snapshots self every interval seconds into the saver if it changed'''
+    def __init__(self, rompar, saver, interval):
+        self.rompar = rompar
+        self.saver = saver
+        self.interval = interval
+        # What's on disk already needs no autosave
+        with rompar.state_lock:
+            self.last_key = state_key(rompar)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='rompar-autosave')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        r = self.rompar
+        with r.state_lock:
+            if not r.grid_points_x and not r.grid_points_y:
+                return
+            key = state_key(r)
+            if key == self.last_key:
+                return
+            snap = snapshot(r)
+            fn = autosave_fn(r)
+        self.last_key = key
+        self.saver.submit('Autosave %s' % fn, write_autosave, snap, fn, replace='autosave')
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
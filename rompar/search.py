@@ -0,0 +1,105 @@
+'''
+Byte sequence search over the packed ROM
+
+Inverting the data XORs every byte with 0xff and LSB mode reverses the bits
+of every byte, so rather than repacking the ROM per variant the pattern is
+transformed instead and every variant is searched in the same bytes.
+'''
+
+import numpy as np
+
+# Bit reversed value of every byte
+REVERSE = np.array([int('{0:08b}'.format(i)[::-1], 2) for i in xrange(256)], dtype=np.uint8)
+# (invert, lsb) relative to the displayed data
+VARIANTS = ((False, False), (True, False), (False, True), (True, True))
+
+def parse_hex(s):
+    '''
+    "DE AD", "DEAD" or "de a d" => [0xde, 0xad] style byte list, raises ValueError
+
+    Whitespace is ignored, the digits are read in pairs so there must be an even number
+    '''
+    digits = ''.join(s.split())
+    if not digits or len(digits) % 2:
+        raise ValueError(s)
+    return [int(digits[i:i + 2], 16) for i in xrange(0, len(digits), 2)]
+
+def variant_pattern(pattern, invert, lsb):
+    '''Pattern as it appears in the displayed data if the ROM is read with given variant'''
+    pattern = np.asarray(pattern, dtype=np.uint8)
+    if lsb:
+        pattern = REVERSE[pattern]
+    if invert:
+        pattern = pattern ^ 0xff
+    return pattern
+
+def find_pattern(data, pattern):
+    '''Offsets of every (possibly overlapping) occurrence of pattern in uint8 array data'''
+    n = len(pattern)
+    if n > len(data):
+        return np.zeros(0, dtype=np.intp)
+    # Narrow down candidates a byte at a time, usually few survive the first
+    offsets = np.flatnonzero(data[:len(data) - n + 1] == pattern[0])
+    for i in xrange(1, n):
+        if not len(offsets):
+            break
+        offsets = offsets[data[offsets + i] == pattern[i]]
+    return offsets
+
+class Search(object):
+    def __init__(self, pattern, all_variants=False):
+        self.pattern = list(pattern)
+        self.variants = VARIANTS if all_variants else VARIANTS[:1]
+        # Bytes the current matches were found in
+        self.data = None
+        # Sorted match start offsets and the VARIANTS index of each
+        self.offsets = np.zeros(0, dtype=np.intp)
+        self.match_variants = np.zeros(0, dtype=np.intp)
+        # Per byte, is it part of a match
+        self.highlight = None
+        # Match last jumped to
+        self.current = -1
+
+    def stale(self, data):
+        '''Do the matches need rerunning for data, only compares contents once per new array'''
+        if self.data is None:
+            return True
+        if self.data is data:
+            return False
+        if not np.array_equal(self.data, data):
+            return True
+        self.data = data
+        return False
+
+    def run(self, data):
+        '''Search uint8 array data, the displayed packed ROM'''
+        offsets = []
+        variants = []
+        for variant in self.variants:
+            found = find_pattern(data, variant_pattern(self.pattern, *variant))
+            offsets.append(found)
+            variants.append(np.full(len(found), VARIANTS.index(variant), dtype=np.intp))
+        offsets = np.concatenate(offsets)
+        variants = np.concatenate(variants)
+        order = np.argsort(offsets, kind='mergesort')
+        self.offsets = offsets[order]
+        self.match_variants = variants[order]
+        self.highlight = np.zeros(len(data), dtype=bool)
+        for i in xrange(len(self.pattern)):
+            self.highlight[self.offsets + i] = True
+        # Not modified by its owner, see get_all_bytes()
+        self.data = data
+        self.current = -1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def step(self, n=1):
+        '''Advance n matches (wrapping), return (match index, offset, (invert, lsb)) or None'''
+        if not len(self.offsets):
+            return None
+        if self.current < 0 and n < 0:
+            self.current = 0
+        self.current = (self.current + n) % len(self.offsets)
+        return (self.current, int(self.offsets[self.current]),
+                VARIANTS[self.match_variants[self.current]])
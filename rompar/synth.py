@@ -0,0 +1,125 @@
+'''
+Synthetic mask ROM images with known contents
+
+Bits are drawn as bright square contacts on a dark background at fixed
+pitch, optionally with extra spacing between column / row groups, then
+degraded with illumination gradient, blur and noise.  Used to benchmark and
+check decoding against ground truth.
+'''
+
+import numpy as np
+
+# Contact and background brightness before degrading
+FOREGROUND = 220
+BACKGROUND = 40
+
+def synth_bits(cols, rows, seed=0):
+    '''Random boolean [column, row] pattern'''
+    return np.random.RandomState(seed).rand(cols, rows) > 0.5
+
+def grid_points(n, pitch, group=None, gap=None, margin=None):
+    '''Pixel centers of n grid lines with gap extra pixels after every group lines'''
+    if margin is None:
+        margin = 2 * pitch
+    if gap is None:
+        gap = pitch
+    i = np.arange(n)
+    points = margin + i * pitch
+    if group:
+        points += (i // group) * gap
+    return points.tolist()
+
+def box_blur(a, r, axis):
+    '''Mean over a 2r + 1 window along axis, edges replicated'''
+    if r <= 0:
+        return a
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (r + 1, r)
+    c = np.cumsum(np.pad(a, pad, mode='edge'), axis=axis, dtype=np.float32)
+    n = a.shape[axis]
+    hi = np.take(c, np.arange(2 * r + 1, 2 * r + 1 + n), axis=axis)
+    lo = np.take(c, np.arange(0, n), axis=axis)
+    return (hi - lo) / (2 * r + 1)
+
+def synth_image(bits, pitch=8, spot=None, group_cols=None, group_rows=None, gap=None,
+                noise=0.0, blur=0, gradient=0.0, seed=0, band=1024):
+    '''
+    Render bits, a boolean [column, row] array, as a BGR uint8 image
+
+    spot: contact edge length in pixels (default pitch / 2)
+    gap: extra pixels between column / row groups (default pitch)
+    noise: gaussian noise standard deviation in grey levels
+    blur: box blur radius in pixels, applied twice
+    gradient: brightness falls off by this fraction across the image
+
+    Returns (img, grid_points_x, grid_points_y)
+    Rendered in bands of rows so only the output is full image size
+    '''
+    bits = np.asarray(bits, dtype=bool)
+    cols, rows = bits.shape
+    if spot is None:
+        spot = max(1, pitch // 2)
+    xs = grid_points(cols, pitch, group_cols, gap)
+    ys = grid_points(rows, pitch, group_rows, gap)
+    w = xs[-1] + 2 * pitch + 1
+    h = ys[-1] + 2 * pitch + 1
+
+    def spot_index(points, n):
+        '''Grid line each pixel's contact belongs to, -1 for none'''
+        index = np.full(n, -1, dtype=np.intp)
+        for i, p in enumerate(points):
+            index[p - spot // 2:p - spot // 2 + spot] = i
+        return index
+    xindex = spot_index(xs, w)
+    yindex = spot_index(ys, h)
+
+    rng = np.random.RandomState(seed)
+    img = np.empty((h, w, 3), dtype=np.uint8)
+    # Vertical blur needs rows from the neighboring bands
+    halo = 2 * blur
+    xshade = 1.0 - gradient * np.linspace(0.0, 0.5, w, dtype=np.float32)
+    for y0 in xrange(0, h, band):
+        y1 = min(h, y0 + band)
+        ya = max(0, y0 - halo)
+        yb = min(h, y1 + halo)
+        yi = yindex[ya:yb]
+        lit = bits[np.maximum(xindex, 0)[None, :], np.maximum(yi, 0)[:, None]]
+        lit &= (xindex >= 0)[None, :] & (yi >= 0)[:, None]
+        a = np.where(lit, np.float32(FOREGROUND), np.float32(BACKGROUND))
+        for _i in xrange(2):
+            a = box_blur(a, blur, 0)
+            a = box_blur(a, blur, 1)
+        a = a[y0 - ya:y0 - ya + (y1 - y0)]
+        yshade = 1.0 - gradient * np.linspace(0.0, 0.5, h, dtype=np.float32)[y0:y1]
+        a *= yshade[:, None] * xshade[None, :]
+        if noise:
+            a += rng.normal(0.0, noise, a.shape).astype(np.float32)
+        img[y0:y1] = np.clip(a, 0, 255).astype(np.uint8)[:, :, None]
+    return img, xs, ys
+
+def synth_project(self, bits, pitch=8, group_cols=8, group_rows=None, **kwargs):
+    '''
+    Set up Rompar self with a synthetic image and its exact grid
+
+    Bits are not read, call read_data(self, force=True)
+    Returns the image
+    '''
+    cols, rows = np.asarray(bits).shape
+    if group_rows is None:
+        group_rows = rows
+    img, xs, ys = synth_image(bits, pitch=pitch, group_cols=group_cols, group_rows=group_rows, **kwargs)
+    self.img_fn = 'synthetic'
+    self.img_original = img
+    self.group_cols = group_cols
+    self.group_rows = group_rows
+    self.grid_points_x = xs
+    self.grid_points_y = ys
+    # Stale any bit sums, see grid_changed()
+    self.grid_version += 1
+    self.step_x = pitch
+    self.step_y = pitch
+    self.config.radius = max(1, kwargs.get('spot') or pitch // 2)
+    self.config.default_radius = self.config.radius
+    # Contacts are FOREGROUND before degrading
+    self.config.pix_thresh_min = (FOREGROUND + BACKGROUND) // 2
+    return img
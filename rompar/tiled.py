@@ -0,0 +1,154 @@
+'''
+Tiled, memory mapped image store for images too large to load
+
+A store is a raw file of fixed size tiles (tile-major, BGR uint8) plus a
+small JSON header next to it:
+
+    die.tiles       tiles[tile_row][tile_col][y][x][channel]
+    die.tiles.json  {"version": 1, "width": ..., "height": ..., ...}
+
+Reads only page in the tiles they cover so memory use scales with the
+region being looked at rather than the whole image
+'''
+
+import json
+import os
+
+import numpy as np
+
+from pipeline import *
+from sample import *
+
+# Edge length of a tile in pixels
+DEFAULT_TILE = 512
+EXTENSION = '.tiles'
+
+def is_tiled(fn):
+    return fn.endswith(EXTENSION) and os.path.exists(fn + '.json')
+
+class TiledImage(object):
+    '''Read only image backed by a tile store, sliced like an (h, w, c) array'''
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn + '.json', 'rb') as f:
+            header = json.load(f)
+        if header['version'] != 1:
+            raise Exception("Unsupported tile store version %s" % (header['version'],))
+        self.width = header['width']
+        self.height = header['height']
+        self.channels = header['channels']
+        self.tile = header['tile']
+        self.tiles_x = (self.width + self.tile - 1) // self.tile
+        self.tiles_y = (self.height + self.tile - 1) // self.tile
+        self.tiles = np.memmap(fn, dtype=np.uint8, mode='r',
+                               shape=(self.tiles_y, self.tiles_x, self.tile, self.tile, self.channels))
+
+    @property
+    def shape(self):
+        return (self.height, self.width, self.channels)
+
+    def read(self, x0, y0, x1, y1):
+        '''Return a copy of pixels [y0:y1, x0:x1], clipped to the image'''
+        x0 = max(0, x0)
+        y0 = max(0, y0)
+        x1 = min(self.width, x1)
+        y1 = min(self.height, y1)
+        out = np.zeros((max(0, y1 - y0), max(0, x1 - x0), self.channels), dtype=np.uint8)
+        if x1 <= x0 or y1 <= y0:
+            return out
+        t = self.tile
+        for ty in xrange(y0 // t, (y1 - 1) // t + 1):
+            # Overlap of this tile row with the request in image coordinates
+            iy0 = max(y0, ty * t)
+            iy1 = min(y1, (ty + 1) * t)
+            for tx in xrange(x0 // t, (x1 - 1) // t + 1):
+                ix0 = max(x0, tx * t)
+                ix1 = min(x1, (tx + 1) * t)
+                out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = \
+                    self.tiles[ty, tx, iy0 - ty * t:iy1 - ty * t, ix0 - tx * t:ix1 - tx * t]
+        return out
+
+    def __getitem__(self, key):
+        '''Support img[y0:y1, x0:x1] like a numpy array'''
+        ys, xs = key[0], key[1]
+        y0, y1, _step = ys.indices(self.height)
+        x0, x1, _step = xs.indices(self.width)
+        return self.read(x0, y0, x1, y1)
+
+def write_tiled(img, fn, tile=DEFAULT_TILE):
+    '''
+    Write img to a tile store at fn
+
+    img only needs to support img[y0:y1, x0:x1] and .shape so a
+    memory mapped source is converted one strip of tiles at a time
+    '''
+    height, width = img.shape[0], img.shape[1]
+    channels = img.shape[2] if len(img.shape) > 2 else 1
+    tiles_x = (width + tile - 1) // tile
+    tiles_y = (height + tile - 1) // tile
+    tiles = np.memmap(fn, dtype=np.uint8, mode='w+',
+                      shape=(tiles_y, tiles_x, tile, tile, channels))
+    for ty in xrange(tiles_y):
+        strip = np.asarray(img[ty * tile:(ty + 1) * tile, 0:width])
+        strip = strip.reshape(strip.shape[0], strip.shape[1], channels)
+        for tx in xrange(tiles_x):
+            chunk = strip[:, tx * tile:(tx + 1) * tile]
+            tiles[ty, tx, :chunk.shape[0], :chunk.shape[1]] = chunk
+    tiles.flush()
+    del tiles
+    header = {
+        'version': 1,
+        'width': width,
+        'height': height,
+        'channels': channels,
+        'tile': tile,
+        }
+    with open(fn + '.json', 'wb') as f:
+        json.dump(header, f, indent=4, sort_keys=True)
+
+def coord_blocks(coords, block):
+    '''Split coords into index slices that fall in the same block sized window'''
+    coords = np.asarray(coords, dtype=np.intp)
+    if not len(coords):
+        return []
+    splits = np.flatnonzero(np.diff(coords // block)) + 1
+    starts = [0] + list(splits)
+    ends = list(splits) + [len(coords)]
+    return [slice(start, end) for start, end in zip(starts, ends)]
+
+def region_aperture_sums(source, config, xs, ys, radius, block=DEFAULT_TILE):
+    '''
+    aperture_sums() equivalent that never holds more than about one block
+    (plus aperture and dilate / erode margins) of preprocessed image
+
+    Result is indexed [column, row]
+    '''
+    xs = np.asarray(xs, dtype=np.intp)
+    ys = np.asarray(ys, dtype=np.intp)
+    h, w = source.shape[0], source.shape[1]
+    half = int(radius) // 2
+    sums = np.zeros((len(xs), len(ys)), dtype=np.int64)
+    for xsl in coord_blocks(xs, block):
+        bxs = xs[xsl]
+        x0 = max(0, bxs.min() - half)
+        x1 = min(w, bxs.max() + half)
+        if x1 <= x0:
+            continue
+        for ysl in coord_blocks(ys, block):
+            bys = ys[ysl]
+            y0 = max(0, bys.min() - half)
+            y1 = min(h, bys.max() + half)
+            if y1 <= y0:
+                continue
+            target = preprocess_region(source, config, x0, y0, x1, y1)
+            sums[xsl, ysl] = aperture_sums(integral_image(target), bxs - x0, bys - y0, radius)
+    return sums
+
+def render_viewport(source, config, rect, original=False):
+    '''Return the (x, y, w, h) region of source, preprocessed unless original is set'''
+    x, y, w, h = rect
+    if original:
+        return source[y:y + h, x:x + w]
+    return preprocess_region(source, config, x, y, x + w, y + h)
@@ -0,0 +1,119 @@
+'''
+Per stage timing for the interactive loop
+
+Stages are functions wrapped with @timed('name').  While disabled (the
+default) a wrapped call costs one global test on top of the call itself.
+Once enable()d each call records a rolling latency sample and optionally a
+Chrome trace event (load the written file in chrome://tracing or Perfetto).
+Only the last TRACE_EVENTS trace events are kept so a long session stays
+bounded.
+'''
+
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque
+
+# Samples kept per stage for the rolling summary
+ROLLING = 100
+# Most recent trace events kept, older ones are dropped
+TRACE_EVENTS = 100000
+
+_recorder = None
+
+class Recorder(object):
+    def __init__(self, trace_fn=None):
+        self.tstart = time.time()
+        self.trace_fn = trace_fn
+        # name: deque of recent durations in seconds
+        self.samples = {}
+        # name: total calls
+        self.counts = {}
+        # (name, start, duration, thread) of the latest calls
+        self.events = deque(maxlen=TRACE_EVENTS) if trace_fn else None
+        self.dropped = 0
+
+    def add(self, name, tstart, dt):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=ROLLING)
+            self.counts[name] = 0
+        samples.append(dt)
+        self.counts[name] += 1
+        if self.events is not None:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((name, tstart, dt, threading.current_thread().ident))
+
+    def summary(self):
+        '''[(name, calls, last, mean, max)] over the rolling window, seconds'''
+        ret = []
+        for name in sorted(self.samples):
+            samples = self.samples[name]
+            ret.append((name, self.counts[name], samples[-1],
+                        sum(samples) / len(samples), max(samples)))
+        return ret
+
+    def write_trace(self, fn=None):
+        fn = fn or self.trace_fn
+        pid = os.getpid()
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (tstart - self.tstart) * 1e6,
+            'dur': dt * 1e6,
+            'pid': pid,
+            'tid': tid,
+            } for name, tstart, dt, tid in list(self.events)]
+        with open(fn, 'wb') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print 'Wrote trace %s (%d events, %d older dropped)' % (fn, len(events), self.dropped)
+
+def enable(trace_fn=None):
+    '''Start recording, also keeping trace events if trace_fn is given'''
+    global _recorder
+    _recorder = Recorder(trace_fn)
+    return _recorder
+
+def disable():
+    global _recorder
+    _recorder = None
+
+def enabled():
+    return _recorder is not None
+
+def recorder():
+    return _recorder
+
+def timed(name):
+    '''Decorator recording the wrapped function's latency as stage name'''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return f(*args, **kwargs)
+            tstart = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                # Recorder may be swapped out mid call
+                if _recorder is not None:
+                    _recorder.add(name, tstart, time.time() - tstart)
+        return wrapper
+    return decorator
+
+def print_timing():
+    if _recorder is None:
+        print 'Timing disabled'
+        return
+    print 'Stage timing (last %d calls, ms):' % ROLLING
+    print '  %-14s %7s %9s %9s %9s' % ('stage', 'calls', 'last', 'mean', 'max')
+    for name, calls, last, mean, peak in _recorder.summary():
+        print '  %-14s %7d %9.2f %9.2f %9.2f' % (name, calls, last * 1e3, mean * 1e3, peak * 1e3)
+
+def finish():
+    '''Write the trace file, if any'''
+    if _recorder is not None and _recorder.events is not None:
+        _recorder.write_trace()